@@ -67,7 +67,7 @@ def gen_sbatch(exp, results_dir):
 
     with open(log_file, "w") as f:
         f.write(
-            "Seeks, peak memory (B), read time (s),  write time (s), elapsed time (s)\n"
+            "Seeks, peak memory (B), read time (s),  write time (s), elapsed time (s), peak measured memory (B), memory overhead factor\n"
         )
 
     # create sbatch file for launching script
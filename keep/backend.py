@@ -0,0 +1,330 @@
+import os
+import threading
+import time
+
+
+class Backend():
+    '''
+    An abstract storage backend where block files are read and written
+
+    Derived classes must implement the following methods:
+
+    def exists(self, file_name):
+        # Return True if file_name exists
+        raise Exception('Implement in sub-class')
+
+    def open(self, file_name, mode):
+        # Return a file object for file_name, with methods read, write,
+        # seek, tell, truncate, flush and close, usable as a context
+        # manager. mode is 'rb' to read, 'r+b' to update (the file is
+        # created if it doesn't exist) or 'wb' to overwrite.
+        raise Exception('Implement in sub-class')
+
+    def remove(self, file_name):
+        # Remove file_name if it exists
+        raise Exception('Implement in sub-class')
+
+    def mtime(self, file_name):
+        # Return a value that changes when file_name is modified, such
+        # as its modification time, or None if it doesn't exist
+        raise Exception('Implement in sub-class')
+
+    Attributes:
+        shared: True if files are visible to other processes, so that
+                blocks can be generated or checksummed in parallel
+        sieve: data sieving threshold suggested to partitions, in bytes
+        durable_flush: True if data is stored when files are flushed, so
+                       that repartitions can be journaled
+    '''
+    shared = True
+    sieve = 0
+    durable_flush = True
+
+
+class LocalBackend(Backend):
+    '''
+    Block files are files of the local file system
+    '''
+
+    def __str__(self):
+        return 'Local backend'
+
+    def exists(self, file_name):
+        return os.path.isfile(file_name)
+
+    def open(self, file_name, mode):
+        if mode == 'r+b':
+            try:
+                return open(file_name, 'r+b')
+            except FileNotFoundError:
+                return open(file_name, 'w+b')
+        return open(file_name, mode)
+
+    def remove(self, file_name):
+        if os.path.isfile(file_name):
+            os.remove(file_name)
+
+    def mtime(self, file_name):
+        try:
+            stat = os.stat(file_name)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+
+class MemoryFile():
+    '''
+    A file object of a MemoryBackend, reading and writing a bytearray.
+    modified, if not None, is called when the file is written or truncated.
+    '''
+
+    def __init__(self, data, mode, modified=None):
+        self.data = data
+        self.mode = mode
+        self.position = 0
+        self.modified = modified
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def read(self, size=-1):
+        end = len(self.data)
+        if size >= 0:
+            end = min(self.position + size, end)
+        data = bytes(self.data[self.position:end])
+        self.position = max(end, self.position)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        if whence == os.SEEK_END:
+            offset += len(self.data)
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def truncate(self, size=None):
+        if self.modified is not None:
+            self.modified()
+        if size is None:
+            size = self.position
+        if size < len(self.data):
+            del self.data[size:]
+        else:
+            self.data.extend(bytes(size - len(self.data)))
+        return size
+
+    def write(self, data):
+        assert(self.mode != 'rb'), 'File is open for reading only'
+        if self.modified is not None:
+            self.modified()
+        if self.position > len(self.data):
+            self.data.extend(bytes(self.position - len(self.data)))
+        self.data[self.position:self.position + len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class MemoryBackend(Backend):
+    '''
+    Block files are bytearrays stored in memory, for fast tests. Files are
+    lost when the backend is deleted, and they aren't visible to other
+    processes.
+
+    Attributes:
+        files: a dictionary. Key is the file name, value is the file
+               content.
+        mtimes: a dictionary. Key is the file name, value is the value of
+                modifications when the file was last opened for writing,
+                written or truncated, used as modification time.
+        modifications: number of file modifications
+    '''
+    shared = False
+
+    def __init__(self):
+        self.files = {}
+        self.mtimes = {}
+        self.modifications = 0
+
+    def __str__(self):
+        return (f'Memory backend: {len(self.files)} files, '
+                f'{sum(len(f) for f in self.files.values())}B')
+
+    def exists(self, file_name):
+        return file_name in self.files
+
+    def open(self, file_name, mode):
+        if mode == 'rb':
+            if file_name not in self.files:
+                raise FileNotFoundError(file_name)
+            return MemoryFile(self.files[file_name], mode)
+        if mode == 'wb':
+            self.files[file_name] = bytearray()
+        self.touch(file_name)
+        return MemoryFile(self.files.setdefault(file_name, bytearray()),
+                          mode, lambda: self.touch(file_name))
+
+    def remove(self, file_name):
+        self.files.pop(file_name, None)
+        self.mtimes.pop(file_name, None)
+
+    def mtime(self, file_name):
+        if file_name not in self.files:
+            return None
+        return self.mtimes.get(file_name, 0)
+
+    def touch(self, file_name):
+        '''
+        Update the modification time of file_name
+        '''
+        self.modifications += 1
+        self.mtimes[file_name] = self.modifications
+
+
+class SimulatedFile():
+    '''
+    A file object of a SimulatedBackend. Reads and writes are delegated to
+    a file of the wrapped backend, and charged to the simulated device.
+    '''
+
+    def __init__(self, f, file_name, device):
+        self.f = f
+        self.file_name = file_name
+        self.device = device
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def read(self, size=-1):
+        offset = self.f.tell()
+        data = self.f.read(size)
+        self.device.request(self.file_name, offset, len(data))
+        return data
+
+    def write(self, data):
+        offset = self.f.tell()
+        n = self.f.write(data)
+        self.device.request(self.file_name, offset, n)
+        return n
+
+
+class SimulatedBackend(Backend):
+    '''
+    A backend injecting the latency and bandwidth of a storage device into
+    the requests of another backend. The device has a single head: a
+    request that doesn't start where the previous one ended costs a seek.
+
+    Attributes:
+        backend: the backend storing the data
+        latency: seek latency, in seconds
+        bandwidth: bandwidth, in bytes per second. None for infinite
+                   bandwidth.
+        sleep: if True, requests wait for the simulated time. Otherwise,
+               time is only accumulated in clock.
+        clock: simulated time spent in requests, in seconds
+        seeks: number of seeks done
+    '''
+
+    def __init__(self, backend=None, latency=0, bandwidth=None, sleep=True):
+        '''
+        Constructor. The local backend is wrapped if backend is None.
+        '''
+        assert(latency >= 0), f'Invalid latency: {latency}'
+        assert(bandwidth is None or bandwidth > 0), (f'Invalid bandwidth: '
+                                                     f'{bandwidth}')
+        self.backend = backend if backend is not None else LocalBackend()
+        self.shared = self.backend.shared
+        self.durable_flush = self.backend.durable_flush
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.sleep = sleep
+        self.clock = 0
+        self.seeks = 0
+        self.head = None  # (file name, offset) where the last request ended
+        self.lock = threading.Lock()  # requests come from I/O threads
+
+    def __getstate__(self):
+        # locks can't be sent to other processes
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return (f'Simulated backend ({self.latency}s seeks, '
+                f'{self.bandwidth}B/s): {self.seeks} seeks, '
+                f'{round(self.clock, 3)}s')
+
+    def exists(self, file_name):
+        return self.backend.exists(file_name)
+
+    def open(self, file_name, mode):
+        return SimulatedFile(self.backend.open(file_name, mode), file_name,
+                             self)
+
+    def remove(self, file_name):
+        self.backend.remove(file_name)
+
+    def mtime(self, file_name):
+        # metadata requests aren't charged to the device
+        return self.backend.mtime(file_name)
+
+    def request(self, file_name, offset, nbytes):
+        '''
+        Charge a request of nbytes bytes at offset in file_name
+        '''
+        delay = 0
+        if self.bandwidth is not None:
+            delay += nbytes / self.bandwidth
+        with self.lock:
+            if self.head != (file_name, offset):
+                delay += self.latency
+                self.seeks += 1
+            self.head = (file_name, offset + nbytes)
+            self.clock += delay
+        if self.sleep and delay > 0:
+            time.sleep(delay)
+
+
+# Rough (seek latency in s, bandwidth in B/s) of simulated devices
+PROFILES = {
+    'hdd': (8e-3, 150e6),
+    'lustre': (1e-3, 1e9),
+}
+
+LOCAL = LocalBackend()
+
+
+def get_backend(name):
+    '''
+    Return a backend from its name: 'local', 'memory' or a simulated device
+    profile in PROFILES, wrapping the local backend
+    '''
+    if name == 'local':
+        return LOCAL
+    if name == 'memory':
+        return MemoryBackend()
+    assert(name in PROFILES), f'Unknown backend: {name}'
+    latency, bandwidth = PROFILES[name]
+    return SimulatedBackend(LOCAL, latency, bandwidth)
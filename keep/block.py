@@ -1,8 +1,53 @@
+import itertools
 import math
 import os
 import time
+from keep.backend import LOCAL
+from keep.files import open_block_file
 from keep.log import log
 
+# memoryview formats of unsigned integers, by size in bytes
+FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
+
+
+def coalesce(offsets, gap=0):
+    '''
+    Merge the segments in offsets that are separated by at most gap bytes.
+
+    Arguments:
+        offsets: sorted segments, as returned by Block.block_offsets:
+                 (start_0, end_0, start_1, end_1, ...), ends included.
+        gap: max number of bytes between two merged segments
+
+    Return the merged segments, in the same format as offsets
+    '''
+    if len(offsets) == 0:
+        return ()
+    merged = [offsets[0], offsets[1]]
+    for i in range(2, len(offsets), 2):
+        if offsets[i] - merged[-1] - 1 <= gap:
+            merged[-1] = offsets[i+1]
+        else:
+            merged += [offsets[i], offsets[i+1]]
+    return tuple(merged)
+
+
+def extract(offsets, spans, span_data):
+    '''
+    Return the list of data segments at offsets, extracted from span_data,
+    the data read at spans. spans are the segments returned by
+    coalesce(offsets, gap).
+    '''
+    segments = []
+    j = 0
+    for i in range(0, len(offsets), 2):
+        while offsets[i] > spans[j+1]:
+            j += 2
+        start = offsets[i] - spans[j]
+        end = start + offsets[i+1] - offsets[i] + 1
+        segments += [memoryview(span_data[j//2])[start:end]]
+    return segments
+
 
 class Data():
     '''
@@ -29,6 +74,18 @@ class Data():
             self.merge_dict()
         return self.data[0][1][start_offset:end_offset]
 
+    def buffer(self):
+        '''
+        Return the data as a single bytearray, that can be modified in place
+        '''
+        if len(self.data) > 1:
+            self.merge_dict()
+        if len(self.data) == 0:
+            return bytearray()
+        if not isinstance(self.data[0][1], bytearray):
+            self.data = [(0, bytearray(self.data[0][1]))]
+        return self.data[0][1]
+
     def clear(self):
         '''
         Clear the buffer content
@@ -78,15 +135,30 @@ class Block():
     A block of a partition.
 
     '''
-    def __init__(self, origin, shape, data=None, file_name=None, fill=None):
+    def __init__(self, origin, shape, data=None, file_name=None, fill=None,
+                 file_offset=None, codec=None, backend=None, itemsize=1,
+                 order=None):
         '''
         Attributes:
-            origin: the origin of the block. Example: (10, 5, 10)
-            shape: the block shape. Example: (5, 10, 5)
+            origin: the origin of the block, in elements. Example: (10, 5, 10)
+            shape: the block shape, in elements. Example: (5, 10, 5)
             data: bytearray to initialize the data buffer
             file_name: file name where to read and write the block
             fill: the pattern to initialize the data buffer: 'zeros' or
                   'random'
+            file_offset: offset of the block in file_name, if file_name is
+                         a container file storing multiple blocks. None if
+                         file_name contains the block and only the block.
+            codec: the Codec compressing the block file, or None. Compressed
+                   blocks are read and written whole.
+            backend: the Backend storing the block file. Defaults to the
+                     local file system.
+            itemsize: size of the array elements, in bytes. Offsets and
+                      data are in bytes.
+            order: the axes of the block data, from the slowest to the
+                   fastest varying. Defaults to C order, (0, 1, ...,
+                   ndim - 1). Origin and shape are always in array axes.
+            nbytes: size of the block, in bytes
         '''
         assert(len(shape) >= 1), f'Invalid shape: {shape}'
         assert(all(x >= 0 for x in shape)), f"Invalid shape: {shape}"
@@ -98,14 +170,27 @@ class Block():
                                             "{shape} don't match")
         self.origin = tuple(origin)
         self.shape = tuple(shape)
-        self.end = tuple(origin[i] + shape[i] - 1 for i in (0, 1, 2))
+        self.end = tuple(origin[i] + shape[i] - 1 for i in range(len(shape)))
+        assert(itemsize >= 1), f'Invalid itemsize: {itemsize}'
+        self.itemsize = itemsize
+        self.nbytes = math.prod(self.shape) * itemsize
+        self.order = (tuple(order) if order is not None
+                      else tuple(range(len(shape))))
+        assert(sorted(self.order) == list(range(len(shape)))), (
+            f'Invalid axis order: {order}')
         self.file_name = file_name
+        self.file_offset = file_offset
+        self.codec = codec
+        self.backend = backend if backend is not None else LOCAL
+        assert(codec is None or file_offset is None), ('Compressed blocks '
+                                                       'cannot be stored in '
+                                                       'containers')
 
         # Create data buffer
         if fill == 'zeros':
-            data = bytearray(math.prod(self.shape))
+            data = bytearray(self.nbytes)
         if fill == 'random':
-            data = bytearray(os.urandom(math.prod(self.shape)))
+            data = bytearray(os.urandom(self.nbytes))
         if data is None:
             data = bytearray()
         self.data = Data(data)
@@ -122,11 +207,20 @@ class Block():
                 f' data in mem: {s}B')
         if self.file_name is not None:
             desc += f'; file_name: {self.file_name}'
+        if self.file_offset is not None:
+            desc += f'; file_offset: {self.file_offset}'
+        if self.codec is not None:
+            desc += f'; codec: {self.codec.name}'
+        if self.order != tuple(range(len(self.shape))):
+            desc += f'; order: {self.order}'
         return desc
 
     def block_offsets(self, block):
         '''
         Return the offsets in self of contiguous data segments of block.
+        Segments are in the order of self. Offsets in block are those of
+        the segments if block has the same order, otherwise those of
+        their first elements only.
         '''
 
         # If self and block don't overlap then don't bother
@@ -134,60 +228,34 @@ class Block():
             return (), (), ()
 
         # Origin and end + 1 of the intersection between self and block
-        origin = (max(block.origin[0], self.origin[0]),
-                  max(block.origin[1], self.origin[1]),
-                  max(block.origin[2], self.origin[2]))
+        ndim = len(self.shape)
+        origin = tuple(max(block.origin[i], self.origin[i])
+                       for i in range(ndim))
         end = tuple(min(block.origin[i] + block.shape[i],
-                    self.origin[i] + self.shape[i]) for i in (0, 1, 2))
-
-        delta_2 = end[2] - origin[2]
-        delta_1 = self.shape[2] - (end[2] - origin[2])
-        delta_1_block = block.shape[2] - (end[2] - origin[2])
-        delta_0 = (self.shape[1] - (end[1] - origin[1]))*self.shape[2]
-        delta_0_block = (block.shape[1] - (end[1] - origin[1]))*block.shape[2]
-
-        current_offset = self.offset(origin)
-        current_offset_block = block.offset(origin)
-        read_points = []  # start new segment
+                    self.origin[i] + self.shape[i]) for i in range(ndim))
+        shape = tuple(end[i] - origin[i] for i in range(ndim))
+
+        # Segments are contiguous in self along the axes after the last
+        # one, in the order of self, where the intersection doesn't span
+        # self
+        order = self.order
+        k = max([j for j in range(ndim)
+                 if shape[order[j]] != self.shape[order[j]]], default=0)
+        length = math.prod(shape[a] for a in order[k:]) * self.itemsize
+        read_points = []
         read_points_block = []
-        n = 0
-        start_seg = current_offset
-        start_seg_block = current_offset_block
-        for i in range(end[0]-origin[0]):
-            for j in range(end[1]-origin[1]):
-                if delta_2 != 0:
-                    current_offset += delta_2  # extend segment
-                    current_offset_block += delta_2
-                if delta_1 != 0:
-                    end_seg = current_offset - 1
-                    end_seg_block = current_offset_block - 1
-                    read_points += [start_seg, end_seg]
-                    read_points_block += [start_seg_block, end_seg_block]
-                    n += 2
-                    current_offset += delta_1
-                    current_offset_block += delta_1_block
-                    start_seg = current_offset
-                    start_seg_block = current_offset_block
-            if delta_0 != 0:
-                if delta_1 == 0:
-                    end_seg = current_offset - 1
-                    end_seg_block = current_offset_block - 1
-                    read_points += [start_seg, end_seg]
-                    read_points_block += [start_seg_block, end_seg_block]
-                    n += 2
-                current_offset += delta_0
-                current_offset_block += delta_0_block
-                start_seg = current_offset
-                start_seg_block = current_offset_block
-
-        end_seg = current_offset - 1
-        end_seg_block = current_offset_block - 1
-        if read_points == []:
-            read_points += [start_seg, end_seg]
-            read_points_block += [start_seg_block, end_seg_block]
-            n += 2
-        return (origin, tuple(end[i]-origin[i] for i in (0, 1, 2)),
-                tuple(read_points), tuple(read_points_block), n)
+        for index in itertools.product(*[range(shape[a])
+                                         for a in order[:k]]):
+            point = list(origin)
+            for a, x in zip(order[:k], index):
+                point[a] += x
+            start_seg = self.offset(point)
+            start_seg_block = block.offset(point)
+            read_points += [start_seg, start_seg + length - 1]
+            read_points_block += [start_seg_block,
+                                  start_seg_block + length - 1]
+        return (origin, shape, tuple(read_points), tuple(read_points_block),
+                len(read_points))
 
     def clear(self):
         '''
@@ -195,19 +263,26 @@ class Block():
         '''
         self.data.clear()
 
+    def contains(self, block):
+        '''
+        Return True if block is entirely contained in self
+        '''
+        return all(self.origin[i] <= block.origin[i] and
+                   block.end[i] <= self.end[i]
+                   for i in range(len(self.shape)))
+
     def delete(self):
         '''
         Delete the block from disk
         '''
-        if os.path.isfile(self.file_name):
-            os.remove(self.file_name)
+        self.backend.remove(self.file_name)
 
     def complete(self):
         '''
         Return True if buffer contains data for the entire
         region covered by block
         '''
-        return self.data.mem_usage() == math.prod(self.shape)
+        return self.data.mem_usage() == self.nbytes
 
     def empty(self):
         '''
@@ -226,13 +301,15 @@ class Block():
         '''
 
         if not self.overlap(block):
-            return Block((-1, -1, -1), (0, 0, 0))
+            return Block((-1,) * len(self.shape), (0,) * len(self.shape),
+                         itemsize=self.itemsize)
 
         origin, shape, self_offsets, _, lb = self.block_offsets(block)
 
         data = b''.join([self.data.get(self_offsets[i], (self_offsets[i+1]+1))
                          for i in range(0, lb, 2)])
-        return Block(origin, shape, data)
+        return Block(origin, shape, data, itemsize=self.itemsize,
+                     order=self.order)
 
     def mem_usage(self):
         '''
@@ -242,12 +319,12 @@ class Block():
 
     def offset(self, point):
         '''
-        Return offset of point in self
+        Return offset of point in self, in bytes
         '''
-        offset = (point[2]-self.origin[2] +
-                  self.shape[2]*(point[1]-self.origin[1]) +
-                  self.shape[2]*self.shape[1]*(point[0]-self.origin[0]))
-        return offset
+        offset = 0
+        for i in self.order:
+            offset = offset*self.shape[i] + point[i] - self.origin[i]
+        return offset * self.itemsize
 
     def overlap(self, block):
         '''
@@ -257,19 +334,19 @@ class Block():
                     block.origin[i] <= self.end[i])
                    or (self.origin[i] >= block.origin[i] and
                        self.origin[i] <= block.end[i])
-                   for i in (0, 1, 2)
+                   for i in range(len(self.shape))
                    )
 
     def point_from_offset(self, offset):
         '''
-        Return point coordinates from offset
+        Return point coordinates from offset, in bytes
         '''
-        a = self.shape[2]*self.shape[1]
-        x = self.origin[0] + (offset // a)
-        b = offset % a
-        y = self.origin[1] + (b // self.shape[2])
-        z = self.origin[2] + (b % self.shape[2])
-        return (x, y, z)
+        offset //= self.itemsize
+        point = list(self.origin)
+        for i in reversed(self.order):
+            point[i] += offset % self.shape[i]
+            offset //= self.shape[i]
+        return tuple(point)
 
     def put_data_block(self, block):
         '''
@@ -277,9 +354,12 @@ class Block():
 
         Similar to get_data_block but to copy from block to self
         '''
-        # assert(self.data.mem_usage() <= math.prod(self.shape)), message
+        # assert(self.data.mem_usage() <= self.nbytes), message
         if not self.overlap(block):
             return
+        assert(block.order == self.order), (f'Cannot copy data in order '
+                                            f'{block.order} to order '
+                                            f'{self.order}')
 
         _, _, self_offsets, _, lb = self.block_offsets(block)
 
@@ -295,41 +375,115 @@ class Block():
 
         message = (f'Block {self} of shape {self.shape} uses '
                    f'{self.data.mem_usage()}B of memory')
-        assert(self.data.mem_usage() <= math.prod(self.shape)), message
+        assert(self.data.mem_usage() <= self.nbytes), message
         message = (f'Block is {block.data.mem_usage()}B but only {data_offset}'
                    ' were copied')
         assert(data_offset == block.data.mem_usage()), message
 
+    def transpose(self, order=None):
+        '''
+        Return a Block with the data of self, with axes in order. Defaults
+        to C order. Return self if its data is already in order. self has to
+        be complete.
+
+        Data is copied by rows along the fastest axis of order.
+        '''
+        ndim = len(self.shape)
+        order = tuple(order) if order is not None else tuple(range(ndim))
+        if order == self.order:
+            return self
+        assert(self.complete()), f'Cannot transpose incomplete block {self}'
+        itemsize = self.itemsize
+        axis = order[-1]
+        # distance between two elements of a row, in elements of self
+        stride = math.prod(self.shape[a]
+                           for a in self.order[self.order.index(axis)+1:])
+        n = self.shape[axis]
+        data = memoryview(self.data.get())
+        if itemsize in FORMATS:
+            data = data.cast(FORMATS[itemsize])
+        rows = []
+        for index in itertools.product(*[range(self.shape[a])
+                                         for a in order[:-1]]):
+            point = list(self.origin)
+            for a, x in zip(order[:-1], index):
+                point[a] += x
+            start = self.offset(point) // itemsize
+            if itemsize in FORMATS:
+                rows += [data[start:start + (n - 1) * stride + 1:stride]]
+            else:
+                rows += [data[(start + i*stride) * itemsize:
+                              (start + i*stride + 1) * itemsize]
+                         for i in range(n)]
+        return Block(self.origin, self.shape,
+                     bytearray(b''.join(r.tobytes() for r in rows)),
+                     itemsize=itemsize, order=order)
+
     def read(self):
         '''
         Read the block from argument file_name. File file_name has to contain
-        the block and only the block
+        the block and only the block, unless file_offset is set
 
         Return number of bytes read
 
         Similar to write but for reading
         '''
-        if self.data.mem_usage() == math.prod(self.shape):
+        if self.data.mem_usage() == self.nbytes:
             # don't read the block again if it was already read
             # TODO: investigate why this is happening
             return self.data.mem_usage()
 
         log(f'<< Reading {self.file_name}', 0)
+        if self.codec is not None:
+            data, read_time = self.read_compressed()
+            self.data.put(0, data, len(data))
+            return self.data.mem_usage(), read_time
         start = time.time()
-        with open(self.file_name, 'rb') as f:
-            data = f.read()
+        with self.backend.open(self.file_name, 'rb') as f:
+            if self.file_offset is None:
+                data = f.read()
+            else:
+                f.seek(self.file_offset)
+                data = f.read(self.nbytes)
         read_time = time.time() - start
         self.data.put(0, data, len(data))
         message = (f'Block contains {self.data.mem_usage()}B but shape is '
-                   f' {math.prod(self.shape)}B')
-        assert(self.data.mem_usage() == math.prod(self.shape)), message
+                   f' {self.nbytes}B')
+        assert(self.data.mem_usage() == self.nbytes), message
         return self.data.mem_usage(), read_time
 
-    def read_from(self, block):
+    def read_compressed(self):
+        '''
+        Read and decompress the compressed block file. Doesn't modify self,
+        so that multiple blocks can be read concurrently.
+
+        Return the block data and the read time, including decompression
+        '''
+        start = time.time()
+        with self.backend.open(self.file_name, 'rb') as f:
+            data = self.codec.decompress(f.read())
+        message = (f'{self.file_name} contains {len(data)}B but shape is '
+                   f'{self.nbytes}B')
+        assert(len(data) == self.nbytes), message
+        return data, time.time() - start
+
+    def read_from(self, block, sieve=0, files=None, data=None):
         '''
         Read the relevant data sections of self from block's file name.
         In general, block doesn't have the same origin or shape as self.
 
+        Arguments:
+            block: the block to read from
+            sieve: data sieving threshold, in bytes. Segments of block
+                   separated by at most sieve bytes are read in a single
+                   request covering the gap, and extracted in memory.
+            files: a FilePool to get the file object of block from. If
+                   None, the file is opened and closed.
+            data: the data of block, decompressed, if it was already read
+                  whole, for instance with read_compressed or from a
+                  BlockCache. Otherwise, a compressed block is read whole
+                  and other blocks are read by segments.
+
         Return: (total_bytes, seeks), the total number of bytes read and the
         number of seeks required in block.
 
@@ -339,33 +493,50 @@ class Block():
         if not self.overlap(block):
             return 0, 0
 
-        data = bytearray()
-        origin, shape, _, _, lb = block.block_offsets(self)
-        nbytes = math.prod(shape)
+        # Segments of the intersection between self and block, in block
+        origin, shape, block_offsets, _, lb = block.block_offsets(self)
+        nbytes = math.prod(shape) * self.itemsize
         if lb == 0:
             return 0, 0  # nothing to read
 
-        data_block = Block(origin=origin, shape=shape)
-        _, _, self_offsets, block_offsets, lc = self.block_offsets(data_block)
-
-        # Read in block
-        seeks = lb/2
-
-        def foo(i):
-            f.seek(block_offsets[i])
-            return (self_offsets[i],
-                    f.read(block_offsets[i+1] - block_offsets[i]+1))
+        if block.codec is not None or data is not None:
+            # compressed blocks are read whole, in a single request
+            read_time = 0
+            if data is None:
+                log(f'<< Reading from {block.file_name} (1 seeks)', 1)
+                data, read_time = block.read_compressed()
+            data = b''.join(extract(block_offsets, (0, len(data) - 1),
+                                    [data]))
+            data_block = Block(origin=origin, shape=shape,
+                               itemsize=self.itemsize, order=block.order)
+            data_block.data.put(0, data, len(data))
+            self.put_data_block(data_block.transpose(self.order))
+            return nbytes, 1, read_time
+
+        spans = coalesce(block_offsets, sieve)
+        seeks = len(spans)/2
 
         log(f'<< Reading from {block.file_name}'
             f' ({seeks} seeks)', 1)
-        with open(block.file_name, 'rb') as f:
-            datatuples = [(self_offsets[i],
-                           f.read(block_offsets[i+1] - block_offsets[i]+1))
-                          for i in range(0, lc, 2)
-                          if f.seek(block_offsets[i]) >= 0]
-        self.data.put_all(datatuples, nbytes)
-
-        return nbytes, seeks, -1
+        start = time.time()
+        base = block.file_offset or 0
+        with open_block_file(block.file_name, 'rb', files,
+                             block.backend) as f:
+            span_data = [f.read(spans[i+1] - spans[i] + 1)
+                         for i in range(0, len(spans), 2)
+                         if f.seek(base + spans[i]) >= 0]
+        read_time = time.time() - start
+        if len(spans) == lb:
+            data = b''.join(span_data)
+        else:
+            data = b''.join(extract(block_offsets, spans, span_data))
+        data_block = Block(origin=origin, shape=shape,
+                           itemsize=self.itemsize, order=block.order)
+        data_block.data.put(0, data, len(data))
+        # data is transposed if block and self have different orders
+        self.put_data_block(data_block.transpose(self.order))
+
+        return nbytes, seeks, read_time
 
     def write(self):
         '''
@@ -375,18 +546,47 @@ class Block():
         Return the number of bytes written to file
         '''
         assert(self.data.mem_usage() > 0), 'Cannot write block with no data'
-        assert(self.data.mem_usage() ==
-               math.prod(self.shape)), ("Block shape"
-                                        " doesn't match data size")
+        assert(self.data.mem_usage() == self.nbytes), (
+            "Block shape doesn't match data size")
         start = time.time()
-        with open(self.file_name, 'wb+') as f:
-            b = f.write(self.data.get(0, math.prod(self.shape)))
+        if self.codec is not None:
+            self.write_compressed(self.data.get())
+            return self.nbytes, time.time() - start
+        if self.file_offset is None:
+            with self.backend.open(self.file_name, 'wb') as f:
+                b = f.write(self.data.get(0, self.nbytes))
+            return b, time.time() - start
+        # block is part of a container file, other blocks are preserved
+        with self.backend.open(self.file_name, 'r+b') as f:
+            f.seek(self.file_offset)
+            b = f.write(self.data.get(0, self.nbytes))
         return b, time.time() - start
 
-    def write_to(self, block):
+    def write_compressed(self, data):
+        '''
+        Compress data, the whole block, and write it to the block file
+
+        Return the size of the compressed file
+        '''
+        assert(len(data) == self.nbytes), ("Block shape doesn't "
+                                           "match data size")
+        with self.backend.open(self.file_name, 'wb') as f:
+            return f.write(self.codec.compress(data))
+
+    def write_to(self, block, files=None):
         '''
         Write relevant data sections of self to block's file name
 
+        If self covers block entirely, block is written with a single
+        sequential write. Otherwise, segments that are contiguous in block
+        are written together. Compressed blocks are always written whole:
+        the data already in block is read and updated first.
+
+        Arguments:
+            block: the block to write to
+            files: a FilePool to get the file object of block from. If
+                   None, the file is opened and closed.
+
         Return: (total_bytes, seeks), the total number of bytes written and the
         number of seeks required in block.
 
@@ -397,37 +597,93 @@ class Block():
 
         assert(block.file_name), f"Block {block} has no file name"
 
-        data_b = self.get_data_block(block)
-        data = data_b.data
-
-        _, _, block_offsets, _, lb = block.block_offsets(data_b)
-        # block offsets are now the offsets in the block to be written
+        if block.codec is not None:
+            return self.__write_compressed_to(block)
+
+        if self.contains(block):
+            # Fast path: block is written entirely, in one write
+            if self.origin == block.origin and self.shape == block.shape:
+                data = self.transpose(block.order).data.get()
+            else:
+                data = self.get_data_block(block).transpose(
+                    block.order).data.get()
+            log(f'>> Writing to {block.file_name} (1 seeks)', 1)
+            start = time.time()
+            if block.file_offset is None:
+                with open_block_file(block.file_name, 'wb', files,
+                                     block.backend) as f:
+                    total_bytes = f.write(data)
+            else:
+                with open_block_file(block.file_name, 'r+b', files,
+                                     block.backend) as f:
+                    f.seek(block.file_offset)
+                    total_bytes = f.write(data)
+            write_time = time.time() - start
+            log(f'  Wrote {total_bytes} bytes to {block.file_name} '
+                f'(1 seeks)', 0)
+            return total_bytes, 1, write_time
+
+        # data is written in the order of block
+        data_b = self.get_data_block(block).transpose(block.order)
+        data = memoryview(data_b.data.get())
+
+        _, _, block_offsets, _, _ = block.block_offsets(data_b)
+        # block offsets are now the offsets in the block to be written.
+        # Data is in the same order as the segments, so contiguous segments
+        # are also contiguous in data.
+        block_offsets = coalesce(block_offsets)
+        lb = len(block_offsets)
 
         data_offset = 0
         seeks = lb / 2
-        mode = 'wb'
-        if os.path.exists(block.file_name):
-            # if file already exists, open in r+b mode
-            #  to modify without overwriting
-            mode = 'r+b'
         write_time = 0
+        base = block.file_offset or 0
 
         log(f'>> Writing to {block.file_name} ({seeks} seeks)', 1)
-        with open(block.file_name, mode) as f:
+        # if file already exists, it is opened in r+b mode
+        # to modify without overwriting
+        with open_block_file(block.file_name, 'r+b', files,
+                             block.backend) as f:
             total_bytes = 0
             for i in range(0, lb, 2):
                 next_data_offset = (data_offset +
                                     block_offsets[i+1] -
                                     block_offsets[i] + 1)
                 start = time.time()
-                f.seek(block_offsets[i])
-                wrote_bytes = f.write(data.get(data_offset,
-                                               next_data_offset))
+                f.seek(base + block_offsets[i])
+                wrote_bytes = f.write(data[data_offset:next_data_offset])
                 write_time += time.time() - start
                 total_bytes += wrote_bytes
                 data_offset = next_data_offset
             if total_bytes != 0:
                 log(f'  Wrote {total_bytes} bytes to {block.file_name} '
                     f'({seeks} seeks)', 0)
-        f.close()
         return total_bytes, seeks, write_time
+
+    def __write_compressed_to(self, block):
+        '''
+        Write relevant data sections of self to compressed block block. See
+        write_to.
+        '''
+        start = time.time()
+        data_b = self.get_data_block(block).transpose(block.order)
+        seeks = 1
+        if self.contains(block):
+            content = data_b.data.get()
+        else:
+            content = bytearray(block.nbytes)
+            if block.backend.exists(block.file_name):
+                content[:] = block.read_compressed()[0]
+                seeks = 2
+            _, _, block_offsets, _, lb = block.block_offsets(data_b)
+            data = memoryview(data_b.data.get())
+            data_offset = 0
+            for i in range(0, lb, 2):
+                n = block_offsets[i+1] - block_offsets[i] + 1
+                content[block_offsets[i]:block_offsets[i+1]+1] = (
+                    data[data_offset:data_offset + n])
+                data_offset += n
+        log(f'>> Writing to {block.file_name} ({seeks} seeks)', 1)
+        size = block.write_compressed(content)
+        log(f'  Wrote {size} compressed bytes to {block.file_name}', 0)
+        return data_b.mem_usage(), seeks, time.time() - start
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+from keep.log import log
+
+
+class BlockCache():
+    '''
+    A least recently used cache of the data of block files, decompressed,
+    for repeated reads of the same blocks, for instance by
+    Partition.read_region. Blocks are read whole on a miss, and kept until
+    the cache exceeds its budget. An entry is invalidated when the
+    modification time of its block file changes. The cache may be shared
+    by partitions and threads.
+
+    Attributes:
+        budget: max number of bytes of data in the cache
+        blocks: an ordered dictionary. Key is (backend, file name, file
+                offset), value is (modification time, data), least
+                recently used first.
+        nbytes: number of bytes of data in the cache
+        hits: number of reads served from the cache
+        misses: number of reads from the block files
+        evictions: number of blocks evicted to respect the budget
+        invalidations: number of blocks dropped because their file was
+                       modified or they were written
+        read_time: time spent reading block files
+    '''
+
+    def __init__(self, budget):
+        '''
+        Constructor
+        '''
+        assert(budget >= 0), f'Invalid block cache budget: {budget}'
+        self.budget = budget
+        self.blocks = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.read_time = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        '''
+        Return a string representation for the cache
+        '''
+        return (f'Block cache: {len(self.blocks)} blocks, '
+                f'{self.nbytes}/{self.budget}B, {self.hits} hits, '
+                f'{self.misses} misses, {self.evictions} evictions, '
+                f'{self.invalidations} invalidations')
+
+    def hit_ratio(self):
+        '''
+        Return the fraction of the reads served from the cache
+        '''
+        reads = self.hits + self.misses
+        return self.hits / reads if reads > 0 else 0
+
+    def get(self, block):
+        '''
+        Return the data of block, decompressed, and True if it was found
+        in the cache or False if it was read from the block file
+        '''
+        key = (id(block.backend), block.file_name, block.file_offset)
+        mtime = block.backend.mtime(block.file_name)
+        with self.lock:
+            if key in self.blocks:
+                cached_mtime, data = self.blocks[key]
+                if mtime is not None and cached_mtime == mtime:
+                    self.blocks.move_to_end(key)
+                    self.hits += 1
+                    return data, True
+                log(f'Block cache: {block.file_name} was modified', 0)
+                self.__remove(key)
+                self.invalidations += 1
+            self.misses += 1
+        start = time.time()
+        if block.codec is not None:
+            data, _ = block.read_compressed()
+        else:
+            with block.backend.open(block.file_name, 'rb') as f:
+                f.seek(block.file_offset or 0)
+                data = f.read(block.nbytes)
+        with self.lock:
+            self.read_time += time.time() - start
+            if mtime is None or len(data) > self.budget:
+                return data, False
+            if key in self.blocks:
+                # read by another thread meanwhile
+                self.__remove(key)
+            while self.nbytes + len(data) > self.budget:
+                self.__remove(next(iter(self.blocks)))
+                self.evictions += 1
+            self.blocks[key] = (mtime, data)
+            self.nbytes += len(data)
+        return data, False
+
+    def invalidate(self, block):
+        '''
+        Remove the data of block from the cache, when block is written
+        '''
+        key = (id(block.backend), block.file_name, block.file_offset)
+        with self.lock:
+            if key in self.blocks:
+                self.__remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        '''
+        Remove all the blocks from the cache
+        '''
+        with self.lock:
+            self.blocks.clear()
+            self.nbytes = 0
+
+    def __remove(self, key):
+        '''
+        Remove the block at key from the cache. The lock must be held.
+        '''
+        _, data = self.blocks.pop(key)
+        self.nbytes -= len(data)
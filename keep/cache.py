@@ -1,5 +1,6 @@
 import os
 from keep import keep
+from keep.block import Block
 from keep.log import log
 
 
@@ -9,11 +10,26 @@ class Cache():
 
     Derived classes must implement the following methods:
 
-    def insert(self, read_block, dry_run):
+    def insert(self, read_block, parent=None):
+        # Insert read_block in the cache and return the list of blocks
+        # that are complete and ready to be written. read_block may be a
+        # sub-block of read block parent, when the read was split to
+        # respect the memory constraint.
         raise Exception('Implement in sub-class')
 
     def mem_usage(self):
         raise Exception('Implement in sub-class')
+
+    def destinations(self, read_block):
+        # Return the set of origins of the write blocks that read_block
+        # contributes to. Write blocks that are always written when
+        # read_block is inserted may be omitted.
+        raise Exception('Implement in sub-class')
+
+    def exclude(self, origins):
+        # Ignore the data inserted for the write blocks at origins, for
+        # instance because they were already written
+        raise Exception('Implement in sub-class')
     '''
 
 
@@ -25,21 +41,39 @@ class KeepCache(Cache):
         '''
         self.out_blocks = out_blocks
         self.match = match
-
-    def insert(self, read_block):
-        f_blocks = keep.get_F_blocks(read_block, self.out_blocks,
-                                     get_data=True)
+        self.excluded = set()
+
+    def insert(self, read_block, parent=None):
+        if parent is None:
+            parent = read_block
+        # F blocks are defined on the complete read block. A sub-block
+        # contributes its intersection with each of them.
+        f_blocks = keep.get_F_blocks(parent, self.out_blocks,
+                                     get_data=False)
         complete_blocks = []
-        for i in range(8):
-            if f_blocks[i] is None or f_blocks[i].empty():
+        for i in range(len(f_blocks)):
+            if f_blocks[i] is None or not f_blocks[i].overlap(read_block):
+                continue
+            f_block = read_block.get_data_block(f_blocks[i])
+            if f_block.empty():
+                continue
+            dest_block = self.match[(parent.origin, i)]
+            if dest_block.origin in self.excluded:
                 continue
-            dest_block = self.match[(read_block.origin, i)]
-            dest_block.put_data_block(f_blocks[i])  # in-memory copy
+            dest_block.put_data_block(f_block)  # in-memory copy
             if dest_block.complete():
                 complete_blocks += [dest_block]
         # return the list of write blocks that are ready to be written
         return complete_blocks
 
+    def destinations(self, read_block):
+        return {self.match[(read_block.origin, i)].origin
+                for i in range(2**len(read_block.shape))
+                if (read_block.origin, i) in self.match}
+
+    def exclude(self, origins):
+        self.excluded |= set(origins)
+
     def mem_usage(self):
         blocks = {self.match[b] for b in self.match}
         return sum([b.mem_usage() for b in blocks])
@@ -65,9 +99,119 @@ class BaselineCache(Cache):
     def __init__(self):
         self.block = None
 
-    def insert(self, read_block):
+    def insert(self, read_block, parent=None):
         self.block = read_block
         return [read_block]  # read block is just returned, to be written
 
+    def destinations(self, read_block):
+        # read blocks are the write blocks, and Partition.repartition
+        # records them in the journal once they are written
+        return set()
+
+    def exclude(self, origins):
+        pass
+
     def mem_usage(self):
+        if self.block is None:
+            return 0
         return self.block.mem_usage()
+
+
+class TwoPhaseCache(Cache):
+    '''
+    Aggregation buffers of two-phase collective buffering: data read is
+    shuffled to one buffer per output block, and output blocks are written
+    whole when their buffer is complete.
+    '''
+
+    def __init__(self, out_blocks):
+        '''
+        out_blocks: a partition
+        '''
+        self.out_blocks = out_blocks
+        self.buffers = {}  # out block origin -> buffer being filled
+        self.complete = []  # buffers returned by insert, until cleared
+        self.excluded = set()
+
+    def insert(self, read_block, parent=None):
+        self.complete = [b for b in self.complete if b.mem_usage() > 0]
+        complete_blocks = []
+        for origin in self.destinations(read_block):
+            if origin in self.excluded:
+                continue
+            out_block = self.out_blocks.blocks[origin]
+            if origin not in self.buffers:
+                self.buffers[origin] = Block(origin, out_block.shape,
+                                             data=bytearray(),
+                                             itemsize=out_block.itemsize)
+            buffer = self.buffers[origin]
+            buffer.put_data_block(read_block.get_data_block(out_block))
+            if buffer.complete():
+                complete_blocks += [self.buffers.pop(origin)]
+        self.complete += complete_blocks
+        return complete_blocks
+
+    def destinations(self, read_block):
+        return {o for o in self.out_blocks.blocks
+                if self.out_blocks.blocks[o].overlap(read_block)}
+
+    def exclude(self, origins):
+        self.excluded |= set(origins)
+
+    def mem_usage(self):
+        return sum([b.mem_usage()
+                    for b in list(self.buffers.values()) + self.complete])
+
+    def __str__(self):
+        return (f'Two-phase cache: {len(self.buffers)} buffers, '
+                f'{self.mem_usage()}B')
+
+
+class FanOutCache(Cache):
+    '''
+    The caches of several output partitions written from the same read
+    blocks. Read blocks are inserted in every cache, so that the input is
+    read only once, and the caches share the memory constraint.
+    '''
+
+    def __init__(self, caches, out_blocks):
+        '''
+        caches: a list of caches
+        out_blocks: a list of partitions, the output partition of each cache
+        '''
+        assert(len(caches) == len(out_blocks)), ('Expected one cache per '
+                                                 'output partition')
+        self.caches = caches
+        self.out_blocks = out_blocks
+        self.outputs = {}  # id of a complete block -> output partition
+
+    def insert(self, read_block, parent=None):
+        complete_blocks = []
+        for cache, out_blocks in zip(self.caches, self.out_blocks):
+            blocks = cache.insert(read_block, parent)
+            for b in blocks:
+                self.outputs[id(b)] = out_blocks
+            complete_blocks += blocks
+        return complete_blocks
+
+    def destinations(self, read_block):
+        # write blocks are identified by output index and origin
+        return {(i, o) for i, cache in enumerate(self.caches)
+                for o in cache.destinations(read_block)}
+
+    def exclude(self, origins):
+        for i, cache in enumerate(self.caches):
+            cache.exclude({o for j, o in origins if j == i})
+
+    def mem_usage(self):
+        return sum([cache.mem_usage() for cache in self.caches])
+
+    def output(self, block):
+        '''
+        Return the output partition of block, a block returned by insert
+        '''
+        return self.outputs.pop(id(block))
+
+    def __str__(self):
+        return (f'Fan-out cache: {len(self.caches)} caches, '
+                f'{self.mem_usage()}B')
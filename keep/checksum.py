@@ -0,0 +1,248 @@
+import itertools
+import math
+from multiprocessing import Pool
+from keep.backend import LOCAL
+from keep.block import Block
+from keep.codec import get_codec
+from keep.log import log
+
+# Checksums are computed modulo this Mersenne prime
+MODULUS = 2 ** 61 - 1
+# Block files are read by chunks of at most this size, in bytes
+CHUNK_SIZE = 64 * 1024 ** 2
+
+
+class Checksum():
+    '''
+    Checksums of the planes of an array along dimension 0.
+
+    The checksum of a plane is the value of its bytes, in C order, read as
+    a big-endian integer, modulo MODULUS. It depends on the position of
+    every byte in the plane, but it can be computed from any set of blocks
+    covering the plane, in any order: every row segment of a block
+    contributes its own value, shifted by its position in the plane.
+    Checksums of the same array stored in different partitions are
+    therefore equal.
+
+    Attributes:
+        shape: the shape of the array
+        itemsize: size of the array elements, in bytes
+        planes: a dictionary. Key is the index of a plane along dimension
+                0, value is its checksum.
+    '''
+
+    def __init__(self, shape, itemsize=1):
+        '''
+        Constructor
+        '''
+        self.shape = tuple(shape)
+        self.itemsize = itemsize
+        self.planes = {}
+
+    def __eq__(self, other):
+        '''
+        Return True if self and other have the same plane checksums
+        '''
+        return self.diff(other) == []
+
+    def __str__(self):
+        '''
+        Return a string representation for the checksum
+        '''
+        return (f'Checksum of array of shape {self.shape}: '
+                f'{len(self.planes)} planes')
+
+    def add(self, origin, shape, data):
+        '''
+        Add the contribution of the block of data at origin, of given
+        shape, to the plane checksums. data is a bytes-like object in C
+        order.
+        '''
+        itemsize = self.itemsize
+        assert(len(data) == math.prod(shape) * itemsize), (
+            f'Block of shape {shape} has {len(data)}B')
+        if len(data) == 0:
+            return
+        data = memoryview(data)
+        ndim = len(self.shape)
+        plane_size = math.prod(self.shape[1:]) * itemsize
+        row_size = shape[-1] * itemsize
+        # weight of the last byte of each row of the block, in a plane
+        weights = [pow(256, plane_size - row_size - origin[-1] * itemsize -
+                       sum((origin[d] + j[d-1]) * itemsize *
+                           math.prod(self.shape[d+1:])
+                           for d in range(1, ndim - 1)), MODULUS)
+                   for j in itertools.product(*[range(x)
+                                                for x in shape[1:-1]])]
+        offset = 0
+        for i in range(shape[0]):
+            value = 0
+            for weight in weights:
+                row = int.from_bytes(data[offset:offset + row_size], 'big')
+                value += row * weight
+                offset += row_size
+            x = origin[0] + i
+            self.planes[x] = (self.planes.get(x, 0) + value) % MODULUS
+
+    def diff(self, other):
+        '''
+        Return the sorted list of planes whose checksums differ in self and
+        other
+        '''
+        planes = set(self.planes) | set(other.planes)
+        return sorted(x for x in planes
+                      if self.planes.get(x, 0) != other.planes.get(x, 0))
+
+    def merge(self, planes):
+        '''
+        Add plane checksums, a dictionary as in self.planes
+        '''
+        for x in planes:
+            self.planes[x] = (self.planes.get(x, 0) + planes[x]) % MODULUS
+
+
+class InlineChecksum():
+    '''
+    Checksums recorded by Partition.repartition while it runs: input
+    checksums are computed from the read blocks, output checksums from the
+    blocks written. Both are equal if all the data read was written, which
+    is checked without reading the output blocks again.
+
+    Attributes:
+        input: a Checksum of the data read
+        outputs: a Checksum of the data written, for each output partition
+        output: the Checksum of the first output partition
+    '''
+
+    def __init__(self, shape, itemsize=1, outputs=1):
+        '''
+        Constructor
+
+        Arguments:
+            shape: the shape of the array
+            itemsize: size of the array elements, in bytes
+            outputs: number of output partitions written from the data read
+        '''
+        self.input = Checksum(shape, itemsize)
+        self.outputs = [Checksum(shape, itemsize) for _ in range(outputs)]
+        self.output = self.outputs[0]
+
+    def diff(self):
+        '''
+        Return the sorted list of planes where input and an output differ
+        '''
+        return sorted(set().union(*[self.input.diff(o)
+                                    for o in self.outputs]))
+
+    def read(self, block):
+        '''
+        Record the data of block, just read
+        '''
+        self.input.add(block.origin, block.shape, block.data.get())
+
+    def write(self, block, output=0):
+        '''
+        Record the data of block, about to be written to output partition
+        output
+        '''
+        self.outputs[output].add(block.origin, block.shape, block.data.get())
+
+
+def block_checksum(array_shape, origin, shape, file_name, file_offset=None,
+                   codec=None, backend=LOCAL, itemsize=1, order=None,
+                   core=None):
+    '''
+    Return the plane checksums of a block stored in file_name, at
+    file_offset if file_name is a container file, as a dictionary. The file
+    is read from backend by chunks of whole block planes along the slowest
+    axis of order, the axis order of the file (C order if None), unless it
+    is compressed with codec, the name of a codec. Array elements are
+    itemsize bytes. If core, the (origin, shape) of a region of the block,
+    is set, only the data in core is checksummed, for instance to exclude
+    the halo of the block.
+    '''
+    checksum = Checksum(array_shape, itemsize)
+    order = tuple(order) if order is not None else tuple(range(len(shape)))
+
+    def add(origin, shape, data):
+        # data is in order, checksums are computed in C order
+        block = None
+        if order != tuple(range(len(shape))) or core is not None:
+            block = Block(origin, shape, bytearray(data), itemsize=itemsize,
+                          order=order)
+        if core is not None:
+            block = block.get_data_block(Block(*core))
+            if block.empty():
+                return
+        if block is not None:
+            origin, shape = block.origin, block.shape
+            data = block.transpose().data.get()
+        checksum.add(origin, shape, data)
+
+    if codec is not None:
+        with backend.open(file_name, 'rb') as f:
+            data = get_codec(codec).decompress(f.read())
+        add(origin, shape, data)
+        return checksum.planes
+    axis = order[0]
+    plane_size = math.prod(shape[a] for a in order[1:]) * itemsize
+    n_planes = max(CHUNK_SIZE // max(plane_size, 1), 1)
+    with backend.open(file_name, 'rb') as f:
+        f.seek(file_offset or 0)
+        for i in range(0, shape[axis], n_planes):
+            n = min(n_planes, shape[axis] - i)
+            chunk_origin = list(origin)
+            chunk_origin[axis] += i
+            chunk_shape = list(shape)
+            chunk_shape[axis] = n
+            add(tuple(chunk_origin), tuple(chunk_shape),
+                f.read(n * plane_size))
+    return checksum.planes
+
+
+def _block_checksum(args):
+    '''
+    Unpack arguments for block_checksum, for Pool.imap_unordered
+    '''
+    return block_checksum(*args)
+
+
+def partition_checksum(partition, processes=None):
+    '''
+    Return the Checksum of the array stored in partition, computed from the
+    block files in parallel. Memory usage is bounded by CHUNK_SIZE per
+    process.
+
+    Arguments:
+        partition: a partition whose blocks are on disk
+        processes: number of processes reading blocks. Defaults to the
+                   number of CPUs.
+    '''
+    checksum = Checksum(partition.array.shape, partition.itemsize)
+    codec = partition.codec.name if partition.codec is not None else None
+    tasks = [(partition.array.shape, b.origin, b.shape, b.file_name,
+              b.file_offset, codec, partition.backend, partition.itemsize,
+              partition.order,
+              (o, partition.block_shape(o)) if partition.halo > 0 else None)
+             for o, b in partition.blocks.items()]
+    if processes == 1 or not partition.backend.shared:
+        for planes in map(_block_checksum, tasks):
+            checksum.merge(planes)
+        return checksum
+    with Pool(processes) as pool:
+        for planes in pool.imap_unordered(_block_checksum, tasks):
+            checksum.merge(planes)
+    return checksum
+
+
+def verify(in_blocks, out_blocks, processes=None):
+    '''
+    Return the sorted list of planes along dimension 0 where the data stored
+    in in_blocks and out_blocks differ. An empty list means that both
+    partitions store the same array.
+    '''
+    log(f'Computing checksums of {in_blocks.name}', 1)
+    in_checksum = partition_checksum(in_blocks, processes)
+    log(f'Computing checksums of {out_blocks.name}', 1)
+    out_checksum = partition_checksum(out_blocks, processes)
+    return in_checksum.diff(out_checksum)
@@ -0,0 +1,63 @@
+import bz2
+import lzma
+import zlib
+
+
+class Codec():
+    '''
+    A compression codec for block files. Compressed blocks are stored as a
+    single compressed stream, so they have to be read and written whole.
+
+    Attributes:
+        name: the name of the codec, used to select it
+        compress: function compressing bytes
+        decompress: function decompressing bytes
+        compressor: function returning a streaming compressor, an object
+                    with methods compress(data) and flush(), as
+                    zlib.compressobj. May be None.
+    '''
+
+    def __init__(self, name, compress, decompress, compressor=None):
+        '''
+        Constructor
+        '''
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+        self.compressor = compressor
+
+    def __str__(self):
+        '''
+        Return a string representation for the codec
+        '''
+        return f'Codec {self.name}'
+
+
+# Registered codecs. Key is the codec name, value is the Codec.
+CODECS = {}
+
+
+def get_codec(name):
+    '''
+    Return the codec registered as name, or None if name is None
+    '''
+    if name is None:
+        return None
+    assert(name in CODECS), f'Unknown codec: {name}'
+    return CODECS[name]
+
+
+def register_codec(name, compress, decompress, compressor=None):
+    '''
+    Register a codec, see Codec for the arguments. A codec already
+    registered with the same name is replaced.
+
+    Return the Codec
+    '''
+    CODECS[name] = Codec(name, compress, decompress, compressor)
+    return CODECS[name]
+
+
+register_codec('zlib', zlib.compress, zlib.decompress, zlib.compressobj)
+register_codec('bz2', bz2.compress, bz2.decompress, bz2.BZ2Compressor)
+register_codec('lzma', lzma.compress, lzma.decompress, lzma.LZMACompressor)
@@ -0,0 +1,64 @@
+import struct
+from keep.backend import LOCAL
+
+# Container files start with this magic number
+MAGIC = b'KEEPCONT'
+VERSION = 1
+# Block data starts at a multiple of this size, in bytes
+ALIGNMENT = 4096
+
+
+def data_offset(ndim, n_blocks):
+    '''
+    Return the offset of the first block in a container file storing
+    n_blocks blocks of dimension ndim, that is, the size of the header
+    rounded up to ALIGNMENT.
+    '''
+    header_size = (len(MAGIC) + 8 + 2 * 8 * ndim + 8 +
+                   n_blocks * 8 * (ndim + 1))
+    return -(-header_size // ALIGNMENT) * ALIGNMENT
+
+
+def read_index(file_name, backend=LOCAL):
+    '''
+    Read the header of container file file_name, stored in backend.
+
+    Return (array_shape, shape, index), where index is a dictionary. Key
+    is a block origin, value is the offset of the block in the file.
+    '''
+    with backend.open(file_name, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        assert(magic == MAGIC), f'{file_name} is not a container file'
+        version, ndim = struct.unpack('<II', f.read(8))
+        assert(version == VERSION), (f'Unsupported container version: '
+                                     f'{version}')
+        array_shape = struct.unpack(f'<{ndim}Q', f.read(8 * ndim))
+        shape = struct.unpack(f'<{ndim}Q', f.read(8 * ndim))
+        n_blocks, = struct.unpack('<Q', f.read(8))
+        index = {}
+        for _ in range(n_blocks):
+            entry = struct.unpack(f'<{ndim + 1}Q', f.read(8 * (ndim + 1)))
+            index[entry[:-1]] = entry[-1]
+    return array_shape, shape, index
+
+
+def write_index(file_name, array_shape, shape, index, backend=LOCAL):
+    '''
+    Write the header of container file file_name, stored in backend. The
+    file is created if it doesn't exist, and block data is left untouched.
+
+    Arguments:
+        array_shape: the shape of the array
+        shape: the shape of the blocks
+        index: a dictionary. Key is a block origin, value is the offset of
+               the block in the file.
+    '''
+    ndim = len(shape)
+    header = [MAGIC, struct.pack('<II', VERSION, ndim),
+              struct.pack(f'<{ndim}Q', *array_shape),
+              struct.pack(f'<{ndim}Q', *shape),
+              struct.pack('<Q', len(index))]
+    header += [struct.pack(f'<{ndim + 1}Q', *origin, index[origin])
+               for origin in index]
+    with backend.open(file_name, 'r+b') as f:
+        f.write(b''.join(header))
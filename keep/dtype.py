@@ -0,0 +1,77 @@
+import sys
+
+# Type names and the corresponding type codes: kind and itemsize
+NAMES = {
+    'int8': 'i1', 'uint8': 'u1',
+    'int16': 'i2', 'uint16': 'u2',
+    'int32': 'i4', 'uint32': 'u4',
+    'int64': 'i8', 'uint64': 'u8',
+    'float16': 'f2', 'float32': 'f4', 'float64': 'f8',
+    'complex64': 'c8', 'complex128': 'c16',
+}
+# Byte order of the machine
+NATIVE = '<' if sys.byteorder == 'little' else '>'
+
+
+class DType():
+    '''
+    The type of the elements of an array. Shapes and origins are counted in
+    elements, so that offsets, memory and seeks are computed from the
+    itemsize. Data is repartitioned as bytes: the byte order is recorded,
+    but elements are never swapped.
+
+    Attributes:
+        kind: 'i' (signed integer), 'u' (unsigned integer), 'f' (floating
+              point) or 'c' (complex)
+        itemsize: size of an element, in bytes
+        byteorder: '<' for little-endian, '>' for big-endian, '|' if not
+                   applicable (1-byte elements)
+        name: the type string, as in numpy, for instance '<i2'
+    '''
+
+    def __init__(self, kind, itemsize, byteorder='='):
+        '''
+        Constructor. byteorder '=' is the byte order of the machine.
+        '''
+        assert(kind in ('i', 'u', 'f', 'c')), f'Invalid kind: {kind}'
+        assert(itemsize >= 1), f'Invalid itemsize: {itemsize}'
+        assert(byteorder in ('<', '>', '=', '|')), (f'Invalid byte order: '
+                                                    f'{byteorder}')
+        if itemsize == 1:
+            byteorder = '|'
+        elif byteorder in ('=', '|'):
+            byteorder = NATIVE
+        self.kind = kind
+        self.itemsize = itemsize
+        self.byteorder = byteorder
+        self.name = f'{byteorder}{kind}{itemsize}'
+
+    def __eq__(self, other):
+        return isinstance(other, DType) and self.name == other.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def __str__(self):
+        '''
+        Return a string representation for the type
+        '''
+        return f'DType {self.name}'
+
+
+def get_dtype(dtype):
+    '''
+    Return the DType of dtype: a DType, a type name such as 'int16' or a
+    type string such as '>f4'. Defaults to unsigned bytes if dtype is None.
+    '''
+    if isinstance(dtype, DType):
+        return dtype
+    if dtype is None:
+        dtype = 'u1'
+    code = NAMES.get(dtype, dtype)
+    byteorder = '='
+    if code[:1] in ('<', '>', '=', '|'):
+        byteorder, code = code[0], code[1:]
+    assert(code[:1] in ('i', 'u', 'f', 'c') and code[1:].isdigit()), (
+        f'Unknown type: {dtype}')
+    return DType(code[0], int(code[1:]), byteorder)
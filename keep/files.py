@@ -0,0 +1,271 @@
+import math
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from keep.backend import LOCAL
+from keep.log import log
+
+# Default number of files kept open by a FilePool
+POOL_SIZE = 128
+
+
+class FilePool():
+    '''
+    A bounded pool of open block files. When the pool is full, the least
+    recently used file is closed.
+
+    Attributes:
+        size: max number of open files
+        files: an ordered dictionary. Key is the file name, value is
+               (mode, file object), least recently used first.
+        opens: number of files opened by the pool
+    '''
+
+    def __init__(self, size=POOL_SIZE):
+        '''
+        Constructor
+        '''
+        assert(size >= 1), f'Invalid file pool size: {size}'
+        self.size = size
+        self.files = OrderedDict()
+        self.opens = 0
+
+    def __str__(self):
+        '''
+        Return a string representation for the pool
+        '''
+        return (f'File pool: {len(self.files)}/{self.size} files open, '
+                f'{self.opens} opens')
+
+    def close(self, file_name=None):
+        '''
+        Close file_name if it is open, or all the files if file_name is None
+        '''
+        names = list(self.files) if file_name is None else [file_name]
+        for name in names:
+            if name in self.files:
+                _, f = self.files.pop(name)
+                f.close()
+
+    def flush(self, file_name=None):
+        '''
+        Flush file_name if it is open for writing, or all the files open for
+        writing if file_name is None
+        '''
+        names = list(self.files) if file_name is None else [file_name]
+        for name in names:
+            if name in self.files and self.files[name][0] != 'rb':
+                self.files[name][1].flush()
+
+    def open(self, file_name, write=False, backend=LOCAL):
+        '''
+        Return a file object for file_name in backend, open for reading,
+        and for writing if write is True. Files open for writing are
+        created if they don't exist.
+        '''
+        if file_name in self.files:
+            mode, f = self.files[file_name]
+            if not write or mode != 'rb':
+                self.files.move_to_end(file_name)
+                return f
+            self.close(file_name)  # reopen for writing
+        if len(self.files) >= self.size:
+            _, (_, f) = self.files.popitem(last=False)
+            f.close()
+        mode = 'r+b' if write else 'rb'
+        f = backend.open(file_name, mode)
+        log(f'File pool: opened {file_name} ({mode})', 0)
+        self.files[file_name] = (mode, f)
+        self.opens += 1
+        return f
+
+
+@contextmanager
+def open_block_file(file_name, mode, files=None, backend=LOCAL):
+    '''
+    Context manager returning a file object for file_name.
+
+    Arguments:
+        file_name: the file to open
+        mode: 'rb' to read, 'r+b' to update (the file is created if it
+              doesn't exist) or 'wb' to overwrite
+        files: a FilePool, or None. If not None, the file object comes from
+               the pool and remains open on exit. In mode 'wb', the file is
+               truncated on exit, at the current position.
+        backend: the Backend storing the file
+    '''
+    if files is not None:
+        f = files.open(file_name, write=mode != 'rb', backend=backend)
+        if mode == 'wb':
+            f.seek(0)
+        yield f
+        if mode == 'wb':
+            f.truncate()
+        return
+    with backend.open(file_name, mode) as f:
+        yield f
+
+
+def device(file_name):
+    '''
+    Return an identifier of the device storing file_name: the device
+    number of its directory, or the directory itself if it doesn't exist
+    '''
+    directory = os.path.dirname(os.path.abspath(file_name))
+    try:
+        return os.stat(directory).st_dev
+    except FileNotFoundError:
+        return directory
+
+
+class IOQueues():
+    '''
+    The queues where Partition.repartition writes complete blocks.
+
+    Synchronous queues write blocks immediately, in the calling thread.
+    Asynchronous queues have one I/O thread per device, each with its own
+    FilePool, so that writes to a device proceed while blocks are read from
+    or written to other devices. Blocks remain in memory until done()
+    returns them.
+
+    The file of a partition block is closed as soon as the block is
+    complete, so that backends buffering writes, such as object stores,
+    store it right away rather than when the pool evicts it.
+
+    Attributes:
+        files: the FilePool used for synchronous writes
+        asynchronous: True if blocks are written by the device threads
+        queues: a dictionary. Key is a device, value is (executor,
+                FilePool) of the device.
+        pending: list of (block, results) of the writes not returned by
+                 done() yet. Results are futures of the write_to calls if
+                 queues are asynchronous.
+        remaining: a dictionary. Key is the file of a partition block
+                   being written, value is the number of bytes of the
+                   block not written yet.
+    '''
+
+    def __init__(self, files, asynchronous=False):
+        '''
+        Constructor
+        '''
+        self.files = files
+        self.asynchronous = asynchronous
+        self.queues = {}
+        self.devices = {}  # directory -> device
+        self.pending = []
+        self.remaining = {}
+
+    def __str__(self):
+        '''
+        Return a string representation for the queues
+        '''
+        if not self.asynchronous:
+            return 'Synchronous writes'
+        return f'{len(self.queues)} device queues'
+
+    def close(self):
+        '''
+        Wait for pending writes and close the files of the device queues
+        '''
+        for executor, files in self.queues.values():
+            executor.shutdown(wait=True)
+            files.close()
+
+    def done(self):
+        '''
+        Wait for the pending writes
+
+        Return a list of (block, total_bytes, seeks, write_time) of the
+        written blocks
+        '''
+        done = []
+        for block, results in self.pending:
+            if self.asynchronous:
+                results = [future.result() for future in results]
+            done += [(block, sum(r[0] for r in results),
+                      sum(r[1] for r in results),
+                      sum(r[2] for r in results))]
+        self.pending = []
+        return done
+
+    def flush(self):
+        '''
+        Flush the files open for writing
+        '''
+        if not self.asynchronous:
+            return self.files.flush()
+        futures = [executor.submit(files.flush)
+                   for executor, files in self.queues.values()]
+        for future in futures:
+            future.result()
+
+    def write(self, block, partition):
+        '''
+        Write block to the blocks of partition that it overlaps
+        '''
+        complete = self.__complete(block, partition)
+        if not self.asynchronous:
+            self.pending += [(block, [partition.write_block(block,
+                                                            self.files)])]
+            for file_name in complete:
+                self.files.close(file_name)
+            return
+        block.data.get()  # merge data before threads read it
+        futures = [self.__queue(b.file_name).submit(block.write_to, b,
+                                                    self.__files(b.file_name))
+                   for b in partition.blocks.values() if b.overlap(block)]
+        # closed after the writes, by the thread of the device
+        futures += [self.__queue(f).submit(self.__close, self.__files(f), f)
+                    for f in complete]
+        self.pending += [(block, futures)]
+
+    def writing(self, block):
+        '''
+        Return True if block is waiting to be written
+        '''
+        return any(b is block for b, _ in self.pending)
+
+    def __close(self, files, file_name):
+        files.close(file_name)
+        return 0, 0, 0  # bytes written, seeks and time of a write
+
+    def __complete(self, block, partition):
+        '''
+        Count the bytes of block written to the blocks of partition
+
+        Return the files of the partition blocks completed by block
+        '''
+        complete = []
+        for b in partition.blocks.values():
+            if b.file_offset is not None or not b.overlap(block):
+                # blocks of a container share their file
+                continue
+            overlap = math.prod(
+                min(b.end[i], block.end[i]) - max(b.origin[i],
+                                                  block.origin[i]) + 1
+                for i in range(len(b.shape))) * b.itemsize
+            left = self.remaining.get(b.file_name, b.nbytes) - overlap
+            self.remaining[b.file_name] = left
+            if left == 0:
+                del self.remaining[b.file_name]
+                complete += [b.file_name]
+        return complete
+
+    def __device(self, file_name):
+        directory = os.path.dirname(os.path.abspath(file_name))
+        if directory not in self.devices:
+            self.devices[directory] = device(file_name)
+        d = self.devices[directory]
+        if d not in self.queues:
+            log(f'I/O queue: new queue for device {d} ({directory})', 0)
+            self.queues[d] = (ThreadPoolExecutor(1),
+                              FilePool(self.files.size))
+        return d
+
+    def __files(self, file_name):
+        return self.queues[self.__device(file_name)][1]
+
+    def __queue(self, file_name):
+        return self.queues[self.__device(file_name)][0]
@@ -0,0 +1,166 @@
+import hashlib
+import math
+import os
+import random
+import time
+from multiprocessing import Pool
+from keep.backend import LOCAL
+from keep.codec import get_codec
+from keep.log import log
+
+# Blocks are generated and written by chunks of at most this size, in bytes
+CHUNK_SIZE = 64 * 1024 ** 2
+
+
+def random_chunk(seed, block_index, chunk_index, size):
+    '''
+    Return size pseudo-random bytes for chunk chunk_index of block
+    block_index, generated from seed. SHAKE-128 is used as a fast seeded
+    generator: chunks are reproducible and independent of each other.
+    '''
+    key = f'{seed}:{block_index}:{chunk_index}'.encode()
+    return hashlib.shake_128(key).digest(size)
+
+
+def generate_block(file_name, size, block_index, fill, seed,
+                   allocate=False, file_offset=None, codec=None,
+                   backend=LOCAL):
+    '''
+    Write a block file of size bytes
+
+    Arguments:
+        file_name: the block file
+        size: size of the block, in bytes
+        block_index: index of the block in its partition
+        fill: 'random' or 'zeros'
+        seed: seed of the random data
+        allocate: if True, zero blocks are allocated on disk with
+                  posix_fallocate, for local files. Otherwise, they are
+                  created as sparse files.
+        file_offset: offset of the block in file_name, if file_name is a
+                     container file. The container has to be allocated
+                     already.
+        codec: the name of the codec compressing the block file, or None
+        backend: the Backend storing the block file
+
+    Return the number of bytes written and the write time
+    '''
+    start = time.time()
+    if file_offset is not None:
+        return write_chunks(file_name, size, block_index, fill, seed,
+                            allocate, file_offset, start, backend)
+    if codec is not None:
+        return write_compressed(file_name, size, block_index, fill, seed,
+                                get_codec(codec), start, backend)
+    with backend.open(file_name, 'wb') as f:
+        if fill == 'zeros':
+            f.truncate(size)
+            if allocate and size > 0 and hasattr(f, 'fileno'):
+                os.posix_fallocate(f.fileno(), 0, size)
+            return size, time.time() - start
+        assert(fill == 'random'), f'Unknown fill pattern: {fill}'
+        written = 0
+        for i in range(math.ceil(size / CHUNK_SIZE)):
+            chunk = random_chunk(seed, block_index, i,
+                                 min(CHUNK_SIZE, size - i * CHUNK_SIZE))
+            written += f.write(chunk)
+    return written, time.time() - start
+
+
+def write_chunks(file_name, size, block_index, fill, seed, allocate,
+                 file_offset, start, backend):
+    '''
+    Write a block in container file file_name, at file_offset. See
+    generate_block.
+    '''
+    with backend.open(file_name, 'r+b') as f:
+        if fill == 'zeros':
+            # the container was extended with zeros already
+            if allocate and size > 0 and hasattr(f, 'fileno'):
+                os.posix_fallocate(f.fileno(), file_offset, size)
+            return size, time.time() - start
+        assert(fill == 'random'), f'Unknown fill pattern: {fill}'
+        f.seek(file_offset)
+        written = 0
+        for i in range(math.ceil(size / CHUNK_SIZE)):
+            chunk = random_chunk(seed, block_index, i,
+                                 min(CHUNK_SIZE, size - i * CHUNK_SIZE))
+            written += f.write(chunk)
+    return written, time.time() - start
+
+
+def write_compressed(file_name, size, block_index, fill, seed, codec,
+                     start, backend):
+    '''
+    Write a block compressed with codec, by chunks if the codec has a
+    streaming compressor. See generate_block.
+    '''
+    assert(fill in ('random', 'zeros')), f'Unknown fill pattern: {fill}'
+    chunks = (random_chunk(seed, block_index, i,
+                           min(CHUNK_SIZE, size - i * CHUNK_SIZE))
+              if fill == 'random' else
+              bytes(min(CHUNK_SIZE, size - i * CHUNK_SIZE))
+              for i in range(math.ceil(size / CHUNK_SIZE)))
+    with backend.open(file_name, 'wb') as f:
+        if codec.compressor is None:
+            f.write(codec.compress(b''.join(chunks)))
+            return size, time.time() - start
+        compressor = codec.compressor()
+        for chunk in chunks:
+            f.write(compressor.compress(chunk))
+        f.write(compressor.flush())
+    return size, time.time() - start
+
+
+def _generate_block(args):
+    '''
+    Unpack arguments for generate_block, for Pool.imap_unordered
+    '''
+    return generate_block(*args)
+
+
+def generate(partition, fill='random', seed=None, processes=None,
+             allocate=False):
+    '''
+    Write all the block files of partition in parallel. Unlike
+    Partition(fill=...), block data is never held in memory entirely.
+
+    Arguments:
+        partition: the partition to write
+        fill: 'random' or 'zeros'
+        seed: seed of the random data. The same seed always produces the
+              same data, regardless of the number of processes. A random
+              seed is drawn if None.
+        processes: number of processes writing blocks. Defaults to the
+                   number of CPUs.
+        allocate: argument passed to generate_block
+
+    Return the seed
+    '''
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(64)
+    codec = partition.codec.name if partition.codec is not None else None
+    tasks = [(b.file_name, b.nbytes, i, fill, seed, allocate,
+              b.file_offset, codec, partition.backend)
+             for i, b in enumerate(partition.blocks.values())]
+    if partition.layout == 'container':
+        # processes write their blocks concurrently in the container, which
+        # is sized before so that no write is lost to a truncation
+        partition.delete()
+        partition.write_index()
+        size = max(b.file_offset + b.nbytes
+                   for b in partition.blocks.values())
+        with partition.backend.open(partition.file_name, 'r+b') as f:
+            f.truncate(size)
+    log(f'Generating {len(tasks)} blocks of {partition.name} ({fill}, '
+        f'seed {seed})', 1)
+    if processes == 1 or not partition.backend.shared:
+        results = [_generate_block(t) for t in tasks]
+    else:
+        with Pool(processes) as pool:
+            results = list(pool.imap_unordered(_generate_block, tasks))
+    total_bytes = sum(r[0] for r in results)
+    array_bytes = math.prod(partition.array.shape) * partition.itemsize
+    assert(total_bytes == array_bytes), (f'Generated {total_bytes}B instead '
+                                         f'of {array_bytes}B')
+    return seed
@@ -0,0 +1,136 @@
+import os
+from ast import literal_eval as make_tuple
+from keep.log import log
+
+
+class Journal():
+    '''
+    A journal of the read blocks processed and of the write blocks written
+    by Partition.repartition, used to resume an interrupted repartitioning.
+
+    The journal is a text file with one entry per line:
+        plan <description of the repartitioning plan>
+        read <origin of a read block whose data was all inserted in the cache>
+        write <origin of a write block written to the output blocks>
+
+    Entries are flushed to disk as soon as they are recorded.
+
+    Attributes:
+        file_name: the journal file
+        plan: the plan recorded in the journal, None if not started
+        reads: origins of the read blocks recorded in the journal
+        writes: origins of the write blocks recorded in the journal
+        resumed: True if the journal contained entries for the current plan
+    '''
+
+    def __init__(self, file_name, resume=False):
+        '''
+        Constructor
+
+        Arguments:
+            file_name: the journal file
+            resume: if True, load the entries found in file_name. Otherwise,
+                    file_name is deleted.
+        '''
+        self.file_name = file_name
+        self.plan = None
+        self.reads = set()
+        self.writes = set()
+        self.resumed = False
+        self.file = None
+        if resume and os.path.isfile(file_name):
+            self.load()
+        else:
+            self.delete()
+
+    def __str__(self):
+        '''
+        Return a string representation for the journal
+        '''
+        return (f'Journal {self.file_name}: {len(self.reads)} read blocks, '
+                f'{len(self.writes)} write blocks')
+
+    def close(self):
+        '''
+        Close the journal file
+        '''
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def delete(self):
+        '''
+        Delete the journal from disk and forget its entries
+        '''
+        self.close()
+        if os.path.isfile(self.file_name):
+            os.remove(self.file_name)
+        self.plan = None
+        self.reads = set()
+        self.writes = set()
+        self.resumed = False
+
+    def done(self, origin, destinations):
+        '''
+        Return True if the read block at origin doesn't need to be read
+        again: it was processed and all the write blocks it contributes
+        to, given by destinations, were written.
+        '''
+        return origin in self.reads and destinations <= self.writes
+
+    def load(self):
+        '''
+        Load the journal entries from disk. An incomplete last line, left by
+        an interruption, is ignored.
+        '''
+        with open(self.file_name) as f:
+            for line in f:
+                if not line.endswith(os.linesep):
+                    break
+                kind, _, value = line.strip().partition(' ')
+                if kind == 'plan':
+                    self.plan = value
+                if kind == 'read':
+                    self.reads.add(make_tuple(value))
+                if kind == 'write':
+                    self.writes.add(make_tuple(value))
+        log(f'Loaded {self}', 1)
+
+    def record(self, kind, value):
+        '''
+        Append entry kind value to the journal and flush it to disk
+        '''
+        self.file.write(f'{kind} {value}{os.linesep}')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def record_read(self, origin):
+        '''
+        Record that all the data of the read block at origin was inserted in
+        the cache, and that the complete blocks were written
+        '''
+        self.reads.add(origin)
+        self.record('read', origin)
+
+    def record_write(self, origin):
+        '''
+        Record that the write block at origin was written
+        '''
+        self.writes.add(origin)
+        self.record('write', origin)
+
+    def start(self, plan):
+        '''
+        Open the journal for repartitioning plan, a string. Entries recorded
+        for another plan are discarded.
+        '''
+        if self.plan is not None and self.plan != plan:
+            log(f'Journal {self.file_name} is for plan {self.plan}, not '
+                f'{plan}. Starting over.', 1)
+            self.delete()
+        self.resumed = len(self.reads) + len(self.writes) > 0
+        new = self.plan is None
+        self.plan = plan
+        self.file = open(self.file_name, 'a')
+        if new:
+            self.record('plan', plan)
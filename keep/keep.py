@@ -1,8 +1,9 @@
+import itertools
 import math
 import collections
 from keep.partition import Partition
 from keep.block import Block
-from keep.cache import KeepCache, BaselineCache
+from keep.cache import KeepCache, BaselineCache, TwoPhaseCache, FanOutCache
 from keep.log import log
 
 
@@ -24,10 +25,12 @@ def baseline(in_blocks, out_blocks, m, array):
     '''
     # TODO: creating a new partition makes memory estimates correct,
     # but it adds an in-memory copy, this could be fixed
+    # The cache holds a read block, with the elements of the output
+    # partition when the read blocks are transformed
     return (Partition(in_blocks.shape, 'read_blocks', array),
             BaselineCache(),
             baseline_seek_count(in_blocks, out_blocks),
-            math.prod(in_blocks.shape))
+            math.prod(in_blocks.shape) * out_blocks.itemsize)
 
 
 def keep(in_blocks, out_blocks, m, array):
@@ -54,6 +57,95 @@ def keep(in_blocks, out_blocks, m, array):
     return read_blocks, cache, seeks, peak_mem
 
 
+def fan_out(in_blocks, out_blocks, m, array):
+    '''
+    Implements get_read_blocks_and_cache(in_blocks, out_blocks, m, array)
+    used in Partition.repartition, for a list of output partitions written
+    in a single pass. The keep heuristic is applied with read blocks chosen
+    jointly for all the output partitions: every read block is read once
+    and inserted in the cache of each output partition, and the caches
+    share memory constraint m.
+
+    Arguments:
+        in_blocks: input partition, to be repartitioned
+        out_blocks: list of output partitions, to be written to disk
+        m: max memory to be used by the repartitioning, by all the caches.
+           If None, memory constraint is ignored.
+        array: partitioned array. Doesn't need to contain data, used just
+               to get total dimensions of the array.
+    '''
+    r, peak_mem = find_shape_with_constraint(in_blocks, out_blocks, m)
+    read_blocks = Partition(r, 'read_blocks', array=array)
+    seeks = seek_count(read_blocks, in_blocks, in_blocks.sieve)
+    caches = []
+    for o in out_blocks:
+        write_blocks, cache = create_write_blocks(read_blocks, o)
+        seeks += seek_count(write_blocks, o, write=True)
+        caches += [cache]
+    return read_blocks, FanOutCache(caches, out_blocks), seeks, peak_mem
+
+
+def two_phase(in_blocks, out_blocks, m, array):
+    '''
+    Implements get_read_blocks_and_cache(in_blocks, out_blocks, m, array)
+    used in Partition.repartition. Implements two-phase collective
+    buffering: read blocks are the thickest slabs of complete planes that
+    respect memory constraint m, so that they are contiguous in the array,
+    and their data is shuffled to one buffer per output block. Output
+    blocks are written whole.
+
+    Arguments:
+        in_blocks: input partition, to be repartitioned
+        out_blocks: output partition, to be written to disk
+        m: max memory to be used by the repartitioning. If None, the array
+           is read in a single slab.
+        array: partitioned array. Doesn't need to contain data, used just
+               to get total dimensions of the array.
+    '''
+    assert(out_blocks.halo == 0), ('Two-phase buffers cannot assemble '
+                                   'blocks with halos')
+    shape = array.shape
+    # slabs aligned with the rows of output blocks don't split them
+    candidates = set(divisors(shape[0])) | set(range(out_blocks.shape[0],
+                                                     shape[0] + 1,
+                                                     out_blocks.shape[0]))
+    for r0 in sorted(candidates, reverse=True):
+        peak_mem = two_phase_peak_memory(r0, out_blocks)
+        log(f'two-phase: slabs of {r0} planes need {peak_mem}B', 0)
+        if m is None or peak_mem <= m:
+            break
+    else:
+        assert(False), ('Cannot find slab thickness that satisfies memory '
+                        'constraint')
+    read_blocks = Partition((r0,) + tuple(shape[1:]), 'read_blocks',
+                            array=array)
+    seeks = keep_seek_count(in_blocks, read_blocks, out_blocks, out_blocks)
+    return read_blocks, TwoPhaseCache(out_blocks), seeks, peak_mem
+
+
+def two_phase_peak_memory(r0, out_blocks):
+    '''
+    Return the peak memory of two-phase collective buffering with slabs of
+    r0 planes. Output blocks in the same row along dimension 0 are filled
+    at the same pace, so the simulation is done by rows.
+    '''
+    shape = out_blocks.array.shape
+    plane_size = math.prod(shape[1:]) * out_blocks.itemsize
+    o0 = out_blocks.shape[0]
+    buffered = {}  # row of output blocks -> planes buffered
+    peak_mem = 0
+    for x in range(0, shape[0], r0):
+        end = min(x + r0, shape[0])
+        for row in range(x // o0, (end - 1) // o0 + 1):
+            planes = min(end, (row + 1) * o0) - max(x, row * o0)
+            buffered[row] = buffered.get(row, 0) + planes
+        peak_mem = max(peak_mem, sum(buffered.values()) * plane_size)
+        # rows are complete when they reach o0 planes or the array edge
+        buffered = {row: p for row, p in buffered.items()
+                    if p < min(o0, shape[0] - row * o0)}
+    return peak_mem
+
+
 '''
     Utils
 '''
@@ -75,7 +167,7 @@ def create_write_blocks(read_blocks, out_blocks):
 
         moved_f_blocks[i] += [f_blocks[0]]  # don't move F0
         match[(r, 0)] = i
-        for f in range(1, 8):
+        for f in range(1, len(f_blocks)):
             if not f_blocks[f] is None:
                 destF0 = destination_F0(read_blocks, i, f)
                 moved_f_blocks[destF0] += [f_blocks[f]]
@@ -88,7 +180,7 @@ def create_write_blocks(read_blocks, out_blocks):
     # Warning: write_blocks are a partition but a non-uniform one
     # This may have side effects. This is also the reason for the
     # weird create_blocks param
-    write_blocks = Partition((1, 1, 1),
+    write_blocks = Partition((1,) * read_blocks.ndim,
                              name='write_blocks',
                              array=read_blocks.array, create_blocks=False)
     write_blocks.blocks = blocks
@@ -102,25 +194,18 @@ def destination_F0(read_blocks, read_block_ind, F_ind):
         read_blocks: partition
         read_block_ind: read block index
         F_ind: the i in Fi
+
+    Return the index of the read block whose F0 receives Fi. Bit
+    ndim - 1 - d of i is set if Fi is after F0 along dimension d, and Fi
+    goes to the neighbor of the read block along all these dimensions.
     '''
-    neighbor_x0 = read_blocks.get_neighbor_block_ind(read_block_ind, 0)
-    neighbor_x1 = read_blocks.get_neighbor_block_ind(read_block_ind, 1)
-    neighbor_x2 = read_blocks.get_neighbor_block_ind(read_block_ind, 2)
-    assert(F_ind < 8 and F_ind > 0)
-    if F_ind == 1:
-        return neighbor_x2
-    if F_ind == 2:
-        return neighbor_x1
-    if F_ind == 3:
-        return destination_F0(read_blocks, neighbor_x1, 1)
-    if F_ind == 4:
-        return neighbor_x0
-    if F_ind == 5:
-        return destination_F0(read_blocks, neighbor_x0, 1)
-    if F_ind == 6:
-        return destination_F0(read_blocks, neighbor_x0, 2)
-    if F_ind == 7:
-        return destination_F0(read_blocks, neighbor_x0, 3)
+    ndim = read_blocks.ndim
+    assert(F_ind < 2**ndim and F_ind > 0)
+    for d in range(ndim):
+        if F_ind & (1 << (ndim - 1 - d)):
+            read_block_ind = read_blocks.get_neighbor_block_ind(
+                read_block_ind, d)
+    return read_block_ind
 
 
 def divisors(n):
@@ -129,17 +214,14 @@ def divisors(n):
 
 def find_shape_with_constraint(in_blocks, out_blocks, m):
     '''
-    Search for a read block shape that respects memory constraint m
+    Search for a read block shape that respects memory constraint m.
+    out_blocks is a partition, or a list of partitions written from the
+    same read blocks.
     '''
 
-    assert(in_blocks.ndim == 3), 'Only supports dimension 3'
-
     # r_hat is the best shape, if it fits in memory or there is no memory
     # constraint, return it
     r_hat = get_r_hat(in_blocks, out_blocks)
-    # TODO: this ignores the memory constraint alltogether
-    return r_hat, -1
-
     log(f'keep: rhat is {r_hat}')
     if m is None:
         return r_hat, -1
@@ -149,14 +231,21 @@ def find_shape_with_constraint(in_blocks, out_blocks, m):
 
     array = in_blocks.array
 
-    # evaluate nmax shapes of the form (divs0[i], r_hat[1], r_hat[2])
-    divs0 = sorted([x for x in divisors(array.shape[0]) if x <= r_hat[0]],
+    # evaluate nmax shapes of the form (divs0[i], r_hat[1], ...). Besides
+    # the divisors of the array, multiples of the input blocks don't cut
+    # input blocks even if the array has ragged edges.
+    divs0 = sorted([x for x in range(1, r_hat[0] + 1)
+                    if array.shape[0] % x == 0 or x % in_blocks.shape[0] == 0],
                    reverse=True)
+    if in_blocks.codec is not None:
+        # compressed input blocks are read whole: read blocks that cut them
+        # would decompress them multiple times
+        divs0 = [x for x in divs0 if x % in_blocks.shape[0] == 0]
     nmax = len(divs0)
     ind = None
 
     for i in range(min(nmax, len(divs0))):
-        shape = (divs0[i], r_hat[1], r_hat[2])
+        shape = (divs0[i],) + tuple(r_hat[1:])
         log(f'Evaluating shape {shape}, memory constraint is {m}', 1)
         mc = peak_memory(shape, in_blocks, out_blocks)
         log(f'Memory estimate: {mc}B', 1)
@@ -164,20 +253,27 @@ def find_shape_with_constraint(in_blocks, out_blocks, m):
             ind = i
             break
     if ind is not None:
-        return (divs0[ind], r_hat[1], r_hat[2]), mc
+        return (divs0[ind],) + tuple(r_hat[1:]), mc
 
     # We're going to have to seek in the second dimension, let's just give up
     assert(False), "Cannot find read shape that satisfies memory constraint"
 
 
 def get_r_hat(in_blocks, out_blocks):
+    '''
+    Return r hat, the smallest multiple of the input block shape that is
+    larger than the output block shape. If r hat doesn't divide the array,
+    read blocks at the edges are ragged. If out_blocks is a list of
+    partitions, r hat is larger than all the output block shapes.
+    '''
     from math import ceil as c
+    if isinstance(out_blocks, list):
+        r_hats = [get_r_hat(in_blocks, o) for o in out_blocks]
+        return tuple(max(r[i] for r in r_hats)
+                     for i in range(in_blocks.ndim))
     inb = in_blocks
     r_hat = tuple([inb.shape[i]*(c(out_blocks.shape[i]/in_blocks.shape[i]))
                   for i in range(in_blocks.ndim)])
-    array = in_blocks.array
-    message = 'Cannot find r hat'
-    assert(all(array.shape[i] % r_hat[i] == 0 for i in (0, 1, 2))), message
     return r_hat
 
 
@@ -191,75 +287,37 @@ def get_F_blocks(write_block, out_blocks, get_data=False):
     shape = write_block.shape
     out_ends = partition_to_end_coords(out_blocks)
 
-    shape = tuple(max([o for o in out_ends[d] if o > origin[d]
-                       and o <= origin[d] + shape[d] - 1]) - origin[d] + 1
-                  for d in (0, 1, 2))
-
-    F0 = Block(origin, shape)
-    if get_data:
-        F0 = write_block.get_data_block(F0)
-
-    # F1
-    origin = (F0.origin[0], F0.origin[1], F0.origin[2] + F0.shape[2])
-    shape = [F0.shape[0], F0.shape[1], write_block.shape[2] - F0.shape[2]]
-    F1 = Block(origin, shape)
-    if get_data:
-        F1 = write_block.get_data_block(F1)
-
-    # F2
-    origin = (F0.origin[0], F0.origin[1] + F0.shape[1], F0.origin[2])
-    shape = [F0.shape[0], write_block.shape[1] - F0.shape[1], F0.shape[2]]
-    F2 = Block(origin, shape)
-    if get_data:
-        F2 = write_block.get_data_block(F2)
-
-    # F3
-    origin = (F0.origin[0], F0.origin[1] + F0.shape[1],
-              F0.origin[2] + F0.shape[2])
-    shape = [F0.shape[0], write_block.shape[1] - F0.shape[1],
-             write_block.shape[2] - F0.shape[2]]
-    F3 = Block(origin, shape)
-    if get_data:
-        F3 = write_block.get_data_block(F3)
-
-    # F4
-    origin = (F0.origin[0] + F0.shape[0], F0.origin[1], F0.origin[2])
-    shape = [write_block.shape[0] - F0.shape[0], F0.shape[1], F0.shape[2]]
-    F4 = Block(origin, shape)
-    if get_data:
-        F4 = write_block.get_data_block(F4)
-
-    # F5
-    origin = (F0.origin[0] + F0.shape[0], F0.origin[1],
-              F0.origin[2] + F0.shape[2])
-    shape = [write_block.shape[0] - F0.shape[0], F0.shape[1],
-             write_block.shape[2] - F0.shape[2]]
-    F5 = Block(origin, shape)
-    if get_data:
-        F5 = write_block.get_data_block(F5)
-
-    # F6
-    origin = (F0.origin[0] + F0.shape[0], F0.origin[1] + F0.shape[1],
-              F0.origin[2])
-    shape = [write_block.shape[0] - F0.shape[0],
-             write_block.shape[1] - F0.shape[1], F0.shape[2]]
-    F6 = Block(origin, shape)
-    if get_data:
-        F6 = write_block.get_data_block(F6)
-
-    # F7
-    origin = (F0.origin[0] + F0.shape[0], F0.origin[1] + F0.shape[1],
-              F0.origin[2] + F0.shape[2])
-    shape = [write_block.shape[0] - F0.shape[0],
-             write_block.shape[1] - F0.shape[1],
-             write_block.shape[2] - F0.shape[2]]
-    F7 = Block(origin, shape)
-    if get_data:
-        F7 = write_block.get_data_block(F7)
+    # If write_block doesn't contain any out block end in a dimension, it
+    # is contained in a single out block along this dimension and F0
+    # spans it entirely
+    shape = tuple(max([o for o in out_ends[d] if o >= origin[d]
+                       and o <= origin[d] + shape[d] - 1],
+                      default=origin[d] + shape[d] - 1) - origin[d] + 1
+                  for d in range(len(shape)))
+
+    # F blocks hold the elements of out_blocks, which may differ from the
+    # elements read when read blocks are transformed
+    itemsize = out_blocks.itemsize
+    F0 = Block(origin, shape, itemsize=itemsize)
+
+    # Fi is after F0 along the dimensions d where bit ndim - 1 - d of i is
+    # set, and aligned with F0 along the other ones. In 3D, F1 is after F0
+    # along dimension 2, F2 along dimension 1 and F4 along dimension 0.
+    ndim = len(shape)
+    f_blocks = []
+    for f in range(2**ndim):
+        after = [f & (1 << (ndim - 1 - d)) for d in range(ndim)]
+        origin = tuple(F0.origin[d] + F0.shape[d] if after[d]
+                       else F0.origin[d] for d in range(ndim))
+        shape = tuple(write_block.shape[d] - F0.shape[d] if after[d]
+                      else F0.shape[d] for d in range(ndim))
+        F = Block(origin, shape, itemsize=itemsize)
+        if get_data:
+            F = write_block.get_data_block(F)
+        f_blocks += [F]
 
     # Remove empty blocks and return
-    f_blocks = [f if not f.empty() else None
-                for f in [F0, F1, F2, F3, F4, F5, F6, F7]]
+    f_blocks = [f if not f.empty() else None for f in f_blocks]
     return f_blocks
 
 
@@ -271,36 +329,65 @@ def merge_blocks(block_list):
     '''
     message = 'Cannot merge non-empty blocks'
     assert(all(b.data.mem_usage() == 0 for b in block_list)), message
-    origin = tuple(min([b.origin[i] for b in block_list]) for i in (0, 1, 2))
+    ndim = len(block_list[0].shape)
+    origin = tuple(min([b.origin[i] for b in block_list])
+                   for i in range(ndim))
     end = tuple(max([b.origin[i] + b.shape[i]
-                for b in block_list]) for i in (0, 1, 2))
-    shape = tuple(end[i] - origin[i] for i in (0, 1, 2))
-    b = Block(origin, shape, data=bytearray())
+                for b in block_list]) for i in range(ndim))
+    shape = tuple(end[i] - origin[i] for i in range(ndim))
+    b = Block(origin, shape, data=bytearray(),
+              itemsize=block_list[0].itemsize)
     return b
 
 
 def peak_memory(read_shape, in_blocks, out_blocks):
     '''
     Return the estimated amount of memory required to repartition in_blocks
-    into out_blocks, using read_blocks and write_blocks.
+    into out_blocks, using read_blocks and write_blocks. If out_blocks is a
+    list of partitions written from the same read blocks, the memory of all
+    their caches is added.
+    '''
+    read_blocks = Partition(read_shape, 'read_blocks', array=in_blocks.array)
+    if not isinstance(out_blocks, list):
+        out_blocks = [out_blocks]
+    profiles = [memory_profile(read_blocks, o) for o in out_blocks]
+    return max(sum(mem) for mem in zip(*profiles))
+
+
+def memory_profile(read_blocks, out_blocks):
+    '''
+    Return the list of the estimated cache memory after the insertion of
+    each read block, when repartitioning read_blocks into out_blocks.
     '''
 
-    # To estimate the amount of memory required, we run a dry run of the
-    # repartitioning
+    # To estimate the amount of memory required, we simulate the
+    # repartitioning without data: the cache receives the F blocks of
+    # every read block, and write blocks leave it when they are complete.
+    # This is the logical memory reported by Partition.repartition.
 
-    read_blocks = Partition(read_shape, 'read_blocks', array=in_blocks.array)
     _, cache = create_write_blocks(read_blocks, out_blocks)
 
-    def local_get_read_blocks_and_cache(in_blocks, out_blocks, m, array):
-        return read_blocks, cache, None, None
-
-    (_, _, peak_mem,
-     _, _) = in_blocks.repartition(out_blocks, None,
-                                   local_get_read_blocks_and_cache,
-                                   dry_run=True)
-    in_blocks.clear()
-    out_blocks.clear()
-    return peak_mem
+    filled = {}  # write block origin -> bytes in cache
+    mem = 0
+    profile = []
+    for r in read_blocks.blocks:
+        f_blocks = get_F_blocks(read_blocks.blocks[r], out_blocks,
+                                get_data=False)
+        dest_blocks = []
+        for i in range(len(f_blocks)):
+            if f_blocks[i] is None:
+                continue
+            dest_block = cache.match[(r, i)]
+            size = f_blocks[i].nbytes
+            filled[dest_block.origin] = (filled.get(dest_block.origin, 0) +
+                                         size)
+            mem += size
+            dest_blocks += [dest_block]
+        profile += [mem]
+        for b in dest_blocks:
+            if filled.get(b.origin) == b.nbytes:
+                mem -= filled.pop(b.origin)
+    return profile
 
 
 '''
@@ -313,62 +400,139 @@ def baseline_seek_count(in_blocks, out_blocks):
 
 
 def keep_seek_count(in_blocks, read_blocks, write_blocks, out_blocks):
-    return (seek_count(read_blocks, in_blocks) +
-            seek_count(write_blocks, out_blocks))
+    return (seek_count(read_blocks, in_blocks, in_blocks.sieve) +
+            seek_count(write_blocks, out_blocks, write=True))
 
 
 def partition_to_end_coords(p):
     '''
     p: a partition
-    Return: end coordinates of the blocks, in each dimension.
+    Return: end coordinates of the blocks, in each dimension. The ends of
+    the block cores if p has halos.
     Example: ([500, 1000, 1500, 2000, 2500, 3000, 3500],
               [500, 1000, 1500, 2000, 2500, 3000, 3500],
               [500, 1000, 1500, 2000, 2500, 3000, 3500])
     '''
 
+    if p.halo > 0:
+        return tuple(sorted(set([o[i] + p.block_shape(o)[i] - 1
+                                 for o in p.blocks]))
+                     for i in range(len(p.shape)))
     return tuple(  # this isn't so efficient...
             sorted(set([p.blocks[b].origin[i] + p.blocks[b].shape[i] - 1
                         for b in p.blocks]))
-            for i in (0, 1, 2)
+            for i in range(len(p.shape))
     )
 
 
-def seek_count(memory_blocks, disk_blocks):
+def seek_count(memory_blocks, disk_blocks, sieve=0, write=False):
     '''
     memory_blocks: a partition representing blocks stored in memory, to be
                    written to disk_blocks or to be read from disk_blocks.
     disk_blocks: a partition representing blocks to be written to disk from
                  memory_blocks, or to be read from disk into memory_blocks
+    sieve: data sieving threshold used to read disk_blocks, in bytes.
+    write: True if memory_blocks are written to disk_blocks. Only matters
+           for compressed disk blocks.
     Returns: number of seeks required to write memory_blocks into disk_blocks.
              This number is also the number of seeks
              to read disk_blocks into memory_blocks.
     '''
 
     M = partition_to_end_coords(memory_blocks)
-    s = sum([seek_count_block(disk_blocks.blocks[b], M)
-            for b in disk_blocks.blocks])
+    blocks = list(disk_blocks.blocks.values())
+    order = disk_blocks.order
+    if order != tuple(range(len(M))):
+        # the model assumes C order: count in the axes of disk_blocks,
+        # where segments are contiguous along the last ones
+        M = tuple(M[a] for a in order)
+        blocks = [Block(tuple(b.origin[a] for a in order),
+                        tuple(b.shape[a] for a in order),
+                        itemsize=b.itemsize) for b in blocks]
+    if disk_blocks.codec is not None:
+        return sum([compressed_seek_count_block(b, M, write)
+                    for b in blocks])
+    s = sum([seek_count_block(b, M, sieve) for b in blocks])
     return s
 
 
-def seek_count_block(block, M):
+def compressed_seek_count_block(block, M, write=False):
+    '''
+    Return the number of seeks required to read M from compressed block,
+    or to write block from M. Compressed blocks are read whole, once for
+    each memory block that intersects them. Writes after the first one
+    also read the block, to update it.
+    '''
+    pieces = math.prod(1 + len([m for m in M[d]
+                                if (block.origin[d] <= m and
+                                    m < block.origin[d] + block.shape[d] - 1)])
+                       for d in range(len(block.shape)))
+    if write:
+        return 2*pieces - 1
+    return pieces
+
+
+def seek_count_block(block, M, sieve=0):
     '''
     Return the number of seeks required to write block from M, or to read M
-    from block.
+    from block. With data sieving, segments separated by at most sieve bytes
+    are read with a single request.
     '''
 
     # Cuts
     c = tuple(len([m for m in M[d]
                    if (block.origin[d] <= m
                    and m < block.origin[d] + block.shape[d] - 1)])
-              for d in (0, 1, 2))
+              for d in range(len(block.shape)))
     shape = block.shape
-    if c[2] != 0:
-        return (c[2] + 1)*shape[0]*shape[1]
-
-    if c[1] != 0:
-        return (c[1] + 1)*shape[0]
+    if sieve > 0 and any(x != 0 for x in c[1:]):
+        return sieved_seek_count_block(block, M, sieve)
 
-    if c[0] != 0:
-        return c[0] + 1
+    # The last cut dimension splits each row of the dimensions before it
+    for d in reversed(range(len(shape))):
+        if c[d] != 0:
+            return (c[d] + 1)*math.prod(shape[:d])
 
     return 1
+
+
+def sieved_seek_count_block(block, M, sieve):
+    '''
+    Return the number of requests required to read M from block, when
+    segments separated by at most sieve bytes are read together. Block is
+    read separately for each memory block that intersects it.
+    '''
+
+    # Shapes of the intersections with the memory blocks, in each dimension
+    ndim = len(block.shape)
+    pieces = []
+    for d in range(ndim):
+        ends = ([block.origin[d] - 1] +
+                [m for m in M[d] if (block.origin[d] <= m and
+                                     m < block.origin[d] + block.shape[d] - 1)]
+                + [block.origin[d] + block.shape[d] - 1])
+        pieces += [[ends[i+1] - ends[i] for i in range(len(ends) - 1)]]
+
+    shape = block.shape
+    requests = 0
+    for p in itertools.product(*pieces):
+        # the intersection is made of contiguous segments spanning the
+        # dimensions after k, the last one where it doesn't span block
+        k = max([d for d in range(ndim) if p[d] < shape[d]], default=None)
+        if k is None:
+            requests += 1
+            continue
+        # gap[d]: bytes between the last segment of a row along dimension
+        # d - 1 and the first segment of the next row, for d <= k.
+        # Segments are merged up to the first dimension where gaps exceed
+        # sieve.
+        gap = 0
+        merged = 0
+        for d in reversed(range(1, k + 1)):
+            gap += ((shape[d] - p[d])*math.prod(shape[d+1:]) *
+                    block.itemsize)
+            if gap > sieve:
+                merged = d
+                break
+        requests += math.prod(p[:merged])
+    return requests
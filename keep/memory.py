@@ -0,0 +1,128 @@
+import os
+import tracemalloc
+
+
+def rss():
+    '''
+    Return the current resident set size of the process, in bytes.
+
+    Uses /proc/self/statm when available (Linux). Elsewhere, falls back
+    to the peak RSS reported by getrusage, which is an upper bound.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def calibrate(m, overhead):
+    '''
+    Return the logical memory budget corresponding to real memory budget m,
+    given an overhead factor (real memory / logical memory) measured by a
+    MemoryTracker.
+
+    Arguments:
+        m: real memory budget, in bytes. May be None (no constraint).
+        overhead: overhead factor. 1 means no overhead.
+    '''
+    if m is None:
+        return None
+    assert(overhead > 0), f'Invalid memory overhead factor: {overhead}'
+    return int(m / overhead)
+
+
+class MemoryTracker():
+    '''
+    Measure the memory used by Partition.repartition, alongside the logical
+    cache occupancy computed from Data.mem_usage.
+
+    Attributes:
+        trace: if True, measure Python allocations with tracemalloc.
+               Otherwise, measure the increase of the resident set size.
+               tracemalloc is more accurate but slows down allocations.
+        steps: list of (logical, measured) tuples in bytes, one per
+               repartition step.
+        peak_logical: peak logical memory, in bytes.
+        peak_measured: peak measured memory, in bytes.
+        budget: measured memory that Partition.repartition must not exceed,
+                in bytes. None means no budget.
+    '''
+
+    def __init__(self, trace=False, budget=None):
+        '''
+        Constructor
+        '''
+        self.trace = trace
+        self.budget = budget
+        self.steps = []
+        self.peak_logical = 0
+        self.peak_measured = 0
+        self.started_tracing = False
+        self.start_mem = 0
+
+    def __str__(self):
+        '''
+        Return a string representation for the tracker
+        '''
+        source = 'tracemalloc' if self.trace else 'RSS'
+        return (f'Memory: peak logical {self.peak_logical}B; peak measured'
+                f' ({source}) {self.peak_measured}B; overhead factor '
+                f'{self.overhead()}')
+
+    def measured(self):
+        '''
+        Return the memory currently used since start(), in bytes
+        '''
+        if self.trace:
+            return tracemalloc.get_traced_memory()[0] - self.start_mem
+        return max(rss() - self.start_mem, 0)
+
+    def overhead(self):
+        '''
+        Return the ratio between peak measured and peak logical memory, or
+        None if no logical memory was used.
+        '''
+        if self.peak_logical == 0:
+            return None
+        return self.peak_measured / self.peak_logical
+
+    def sample(self, logical):
+        '''
+        Record a repartition step where the cache used logical bytes
+
+        Return the measured memory, in bytes
+        '''
+        measured = self.measured()
+        self.steps += [(logical, measured)]
+        peak = measured
+        if self.trace:
+            # tracemalloc also records peaks reached between two samples
+            peak = max(peak,
+                       tracemalloc.get_traced_memory()[1] - self.start_mem)
+        self.peak_logical = max(self.peak_logical, logical)
+        self.peak_measured = max(self.peak_measured, peak)
+        return measured
+
+    def start(self):
+        '''
+        Start measuring. Memory already in use is not accounted for.
+        '''
+        if self.trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.started_tracing = True
+            self.start_mem = tracemalloc.get_traced_memory()[0]
+        else:
+            self.start_mem = rss()
+
+    def stop(self):
+        '''
+        Stop measuring
+        '''
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
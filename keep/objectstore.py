@@ -0,0 +1,482 @@
+import collections
+import datetime
+import hashlib
+import hmac
+import http.client
+import queue
+import re
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.etree import ElementTree
+from keep.backend import Backend, MemoryFile
+from keep.log import log
+
+# Objects larger than this size, in bytes, are uploaded in parts
+PART_SIZE = 8 * 1024 ** 2
+# Default data sieving threshold of object stores, in bytes: a ranged GET
+# costs about as much as transferring this many bytes
+SIEVE = 1024 ** 2
+
+
+def sign(method, host, path, query, headers, payload_hash, credentials,
+         region, now=None):
+    '''
+    Add AWS Signature Version 4 headers to headers, a dictionary with
+    lower-case keys, for a request to an S3-compatible object store.
+
+    Arguments:
+        method: HTTP method
+        host: host header of the request
+        path: path of the request, not URL-encoded
+        query: list of (name, value) query parameters
+        headers: headers of the request, modified in place
+        payload_hash: hex SHA-256 of the request body
+        credentials: (access key, secret key)
+        region: region of the object store
+        now: datetime of the request. Defaults to the current time.
+    '''
+    access_key, secret_key = credentials
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date = now.strftime('%Y%m%d')
+    headers.update({'host': host, 'x-amz-date': amz_date,
+                    'x-amz-content-sha256': payload_hash})
+    signed = sorted(headers)
+    quote = urllib.parse.quote
+    canonical = '\n'.join([
+        method,
+        quote(path),
+        '&'.join(sorted(f'{quote(k, safe="-_.~")}={quote(v, safe="-_.~")}'
+                        for k, v in query)),
+        ''.join(f'{k}:{str(headers[k]).strip()}\n' for k in signed),
+        ';'.join(signed),
+        payload_hash])
+    scope = f'{date}/{region}/s3/aws4_request'
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256', amz_date, scope,
+        hashlib.sha256(canonical.encode()).hexdigest()])
+    key = f'AWS4{secret_key}'.encode()
+    for message in (date, region, 's3', 'aws4_request'):
+        key = hmac.new(key, message.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(),
+                         hashlib.sha256).hexdigest()
+    headers['authorization'] = (f'AWS4-HMAC-SHA256 Credential={access_key}/'
+                                f'{scope}, SignedHeaders={";".join(signed)}'
+                                f', Signature={signature}')
+
+
+class ConnectionPool():
+    '''
+    A pool of persistent HTTP connections to a host, shared by threads
+
+    Attributes:
+        host: host name
+        port: port number
+        size: max number of connections
+        connections: the idle connections
+        created: number of connections created
+    '''
+
+    def __init__(self, host, port, size):
+        '''
+        Constructor
+        '''
+        assert(size >= 1), f'Invalid connection pool size: {size}'
+        self.host = host
+        self.port = port
+        self.size = size
+        self.connections = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.created = 0
+
+    def close(self):
+        '''
+        Close the idle connections
+        '''
+        while not self.connections.empty():
+            self.connections.get().close()
+
+    def request(self, method, path, headers, body=None):
+        '''
+        Send a request on an idle connection, opening one if needed and
+        waiting if size connections are busy. The request is sent again on
+        a new connection if an idle connection was closed by the server.
+
+        Return (status, headers, body) of the response
+        '''
+        with self.slots:
+            try:
+                connection = self.connections.get_nowait()
+                reused = True
+            except queue.Empty:
+                connection = self.__connect()
+                reused = False
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if not reused:
+                    raise
+                connection = self.__connect()
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+            data = response.read()
+            self.connections.put(connection)
+        return response.status, dict(response.getheaders()), data
+
+    def __connect(self):
+        self.created += 1
+        return http.client.HTTPConnection(self.host, self.port)
+
+
+class ObjectReader():
+    '''
+    A file object of an ObjectStoreBackend open for reading. Every read is
+    a ranged GET.
+    '''
+
+    def __init__(self, backend, file_name):
+        self.backend = backend
+        self.file_name = file_name
+        self.position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def read(self, size=-1):
+        if size == 0:
+            return b''
+        end = '' if size < 0 else self.position + size - 1
+        status, _, data = self.backend.request(
+            'GET', self.file_name,
+            headers={'range': f'bytes={self.position}-{end}'})
+        if status == 416:  # range starts after the end of the object
+            return b''
+        if status == 404:
+            raise FileNotFoundError(self.file_name)
+        assert(status in (200, 206)), (f'GET {self.file_name} failed with '
+                                       f'status {status}')
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        assert(whence == 0), 'Only absolute seeks are supported'
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+
+class ObjectWriter(MemoryFile):
+    '''
+    A file object of an ObjectStoreBackend open for writing. Objects can
+    only be written whole: writes are buffered in memory, and the object is
+    uploaded on close if it was modified. Flushing doesn't upload the
+    object, as every flush of a partially written object would upload it
+    whole again.
+    '''
+
+    def __init__(self, backend, file_name, data, mode):
+        super().__init__(data, mode)
+        self.backend = backend
+        self.file_name = file_name
+        self.dirty = mode == 'wb'
+
+    def close(self):
+        if self.dirty:
+            self.backend.put(self.file_name, self.data)
+            self.dirty = False
+
+    def flush(self):
+        pass
+
+    def truncate(self, size=None):
+        self.dirty = True
+        return super().truncate(size)
+
+    def write(self, data):
+        self.dirty = True
+        return super().write(data)
+
+
+class ObjectStoreBackend(Backend):
+    '''
+    Block files are objects of an S3-compatible object store. Reads are
+    ranged GETs, so the seek model of the keep heuristic counts GET
+    requests; reads are coalesced by data sieving, with the sieve
+    threshold of the backend by default. Objects are written whole: files
+    open for writing are buffered and uploaded when they are closed, in
+    parts if they are larger than part_size. A FilePool keeps output blocks
+    open, so that each block is uploaded once, when complete. As buffered
+    writes aren't durable until the file is closed, repartitions into an
+    object store can't be journaled.
+
+    Attributes:
+        url: URL of the bucket, followed by an optional key prefix.
+             Example: http://localhost:9000/bucket/prefix
+        pool_size: max number of connections to the object store
+        part_size: size of the uploaded parts, in bytes
+        sieve: data sieving threshold suggested to partitions, in bytes
+        credentials: (access key, secret key) to sign requests, or None to
+                     send unsigned requests
+        region: region of the object store, used to sign requests
+        requests: number of requests sent, by method
+    '''
+    durable_flush = False
+
+    def __init__(self, url, pool_size=8, part_size=PART_SIZE, sieve=SIEVE,
+                 credentials=None, region='us-east-1'):
+        '''
+        Constructor
+        '''
+        parsed = urllib.parse.urlsplit(url)
+        assert(parsed.scheme == 'http'), f'Unsupported URL: {url}'
+        assert(part_size >= 1), f'Invalid part size: {part_size}'
+        self.url = url
+        self.host = parsed.netloc
+        self.prefix = parsed.path.rstrip('/')
+        self.pool_size = pool_size
+        self.part_size = part_size
+        self.sieve = sieve
+        self.credentials = credentials
+        self.region = region
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.connections = ConnectionPool(parsed.hostname, parsed.port,
+                                          pool_size)
+
+    def __getstate__(self):
+        # connections and locks can't be sent to other processes
+        state = self.__dict__.copy()
+        del state['connections']
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        parsed = urllib.parse.urlsplit(self.url)
+        self.connections = ConnectionPool(parsed.hostname, parsed.port,
+                                          self.pool_size)
+
+    def __str__(self):
+        return (f'Object store {self.url}: '
+                f'{sum(self.requests.values())} requests '
+                f'({dict(self.requests)}), '
+                f'{self.connections.created} connections')
+
+    def exists(self, file_name):
+        status, _, _ = self.request('HEAD', file_name)
+        return status == 200
+
+    def mtime(self, file_name):
+        status, headers, _ = self.request('HEAD', file_name)
+        if status != 200:
+            return None
+        headers = {k.lower(): v for k, v in headers.items()}
+        return headers.get('last-modified'), headers.get('etag')
+
+    def open(self, file_name, mode):
+        if mode == 'rb':
+            return ObjectReader(self, file_name)
+        data = bytearray()
+        if mode == 'r+b':
+            status, _, body = self.request('GET', file_name)
+            if status == 200:
+                data = bytearray(body)
+        return ObjectWriter(self, file_name, data, mode)
+
+    def put(self, file_name, data):
+        '''
+        Upload object file_name with content data, in parts if data is
+        larger than part_size
+        '''
+        if len(data) <= self.part_size:
+            status, _, _ = self.request('PUT', file_name, body=bytes(data))
+            assert(status == 200), (f'PUT {file_name} failed with status '
+                                    f'{status}')
+            return
+        status, _, body = self.request('POST', file_name,
+                                       query=[('uploads', '')])
+        assert(status == 200), (f'Upload of {file_name} failed with status '
+                                f'{status}')
+        upload_id = re.search(rb'<UploadId>(.*)</UploadId>', body).group(1)
+        upload_id = upload_id.decode()
+        etags = []
+        data = memoryview(data)
+        for i, start in enumerate(range(0, len(data), self.part_size)):
+            part = bytes(data[start:start + self.part_size])
+            status, headers, _ = self.request(
+                'PUT', file_name, body=part,
+                query=[('partNumber', str(i + 1)), ('uploadId', upload_id)])
+            assert(status == 200), (f'Upload of part {i + 1} of {file_name} '
+                                    f'failed with status {status}')
+            etags += [{k.lower(): v for k, v in headers.items()}['etag']]
+        parts = ''.join(f'<Part><PartNumber>{i + 1}</PartNumber>'
+                        f'<ETag>{etag}</ETag></Part>'
+                        for i, etag in enumerate(etags))
+        body = (f'<CompleteMultipartUpload>{parts}'
+                '</CompleteMultipartUpload>').encode()
+        status, _, _ = self.request('POST', file_name, body=body,
+                                    query=[('uploadId', upload_id)])
+        assert(status == 200), (f'Upload of {file_name} failed with status '
+                                f'{status}')
+        log(f'Uploaded {file_name} in {len(etags)} parts', 0)
+
+    def remove(self, file_name):
+        self.request('DELETE', file_name)
+
+    def request(self, method, file_name, headers=None, body=None,
+                query=()):
+        '''
+        Send a request for object file_name
+
+        Return (status, headers, body) of the response
+        '''
+        path = f'{self.prefix}/{file_name}'
+        body = body if body is not None else b''
+        headers = dict(headers or {})
+        headers['content-length'] = str(len(body))
+        if self.credentials is not None:
+            sign(method, self.host, path, query, headers,
+                 hashlib.sha256(body).hexdigest(), self.credentials,
+                 self.region)
+        url = urllib.parse.quote(path)
+        if query:
+            url += '?' + '&'.join(f'{k}={v}' if v else k for k, v in query)
+        with self.lock:
+            self.requests[method] += 1
+        return self.connections.request(method, url, headers, body)
+
+
+class ObjectStoreHandler(BaseHTTPRequestHandler):
+    '''
+    Request handler of ObjectStoreServer
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_DELETE(self):
+        path, _ = self.__parse()
+        self.server.objects.pop(path, None)
+        self.__reply(204)
+
+    def do_GET(self):
+        path, _ = self.__parse()
+        if path not in self.server.objects:
+            return self.__reply(404)
+        data = self.server.objects[path]
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('range', ''))
+        if match is None:
+            return self.__reply(200, data)
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(data) - 1
+        if start >= len(data):
+            return self.__reply(416)
+        self.__reply(206, data[start:end + 1])
+
+    def do_HEAD(self):
+        path, _ = self.__parse()
+        if path not in self.server.objects:
+            return self.__reply(404)
+        data = self.server.objects[path]
+        self.send_response(200)
+        self.send_header('Content-Length', len(data))
+        self.send_header('ETag', f'"{hashlib.md5(data).hexdigest()}"')
+        self.end_headers()
+
+    def do_POST(self):
+        path, query = self.__parse()
+        body = self.__body()
+        if 'uploads' in query:
+            upload_id = str(len(self.server.uploads))
+            self.server.uploads[upload_id] = {}
+            return self.__reply(200, (
+                f'<InitiateMultipartUploadResult><UploadId>{upload_id}'
+                '</UploadId></InitiateMultipartUploadResult>').encode())
+        parts = self.server.uploads.pop(query['uploadId'][0])
+        numbers = [int(e.text) for e in
+                   ElementTree.fromstring(body).iter('PartNumber')]
+        self.server.objects[path] = b''.join(parts[n] for n in numbers)
+        self.__reply(200, b'<CompleteMultipartUploadResult/>')
+
+    def do_PUT(self):
+        path, query = self.__parse()
+        body = self.__body()
+        if 'uploadId' in query:
+            number = int(query['partNumber'][0])
+            self.server.uploads[query['uploadId'][0]][number] = body
+            etag = hashlib.md5(body).hexdigest()
+            return self.__reply(200, headers={'ETag': f'"{etag}"'})
+        self.server.objects[path] = body
+        self.__reply(200)
+
+    def log_message(self, format, *args):
+        headers = {k.lower(): v for k, v in self.headers.items()}
+        self.server.log += [(self.command, self.path, headers)]
+
+    def __body(self):
+        return self.rfile.read(int(self.headers.get('content-length', 0)))
+
+    def __parse(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        return urllib.parse.unquote(url.path), query
+
+    def __reply(self, status, body=b'', headers={}):
+        self.send_response(status)
+        for name in headers:
+            self.send_header(name, headers[name])
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+
+class ObjectStoreServer(ThreadingHTTPServer):
+    '''
+    A local stand-in for an S3-compatible object store, storing objects in
+    memory, for tests and benchmarks. Supports ranged GETs, PUT, HEAD,
+    DELETE and multipart uploads. Requests aren't authenticated.
+
+    Attributes:
+        objects: a dictionary. Key is the object path, value is the object.
+        uploads: the multipart uploads in progress
+        log: list of (method, path, headers) of the requests received.
+             Header names are lower case.
+    '''
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        '''
+        Constructor. Port 0 picks a free port.
+        '''
+        super().__init__((host, port), ObjectStoreHandler)
+        self.objects = {}
+        self.uploads = {}
+        self.log = []
+
+    def start(self):
+        '''
+        Serve requests in a background thread
+
+        Return the URL of the server
+        '''
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def stop(self):
+        '''
+        Stop serving requests
+        '''
+        self.shutdown()
+        self.server_close()
@@ -1,7 +1,21 @@
+import itertools
 import math
 import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import numpy
+except ImportError:
+    # numpy is only required by Partition.read_region
+    numpy = None
+from keep.backend import LOCAL
 from keep.block import Block
-from keep.cache import Cache
+from keep.cache import Cache, FanOutCache
+from keep.codec import get_codec
+from keep.container import data_offset, read_index, write_index
+from keep.dtype import get_dtype
+from keep.files import POOL_SIZE, FilePool, IOQueues
 from keep.log import log
 
 
@@ -23,27 +37,110 @@ class Partition():
               Warning: this allocates memory.
         create_blocks: if set to False, don't create the blocks in the
               partition.
+        sieve: data sieving threshold used when reading from the blocks, in
+               bytes. Segments separated by at most sieve bytes are read in
+               a single request. 0 disables data sieving. Defaults to the
+               threshold suggested by the backend.
+        layout: 'files' to store each block in its own file, 'container' to
+                store all the blocks in a single container file, with a
+                header indexing the block offsets.
+        codec: the name of the codec compressing the block files, or None.
+               Compressed blocks are read and written whole, and only
+               with the 'files' layout.
+        threads: number of threads compressing or decompressing blocks
+                 while others are read or written. Defaults to the
+                 ThreadPoolExecutor default.
+        backend: the Backend storing the block files. Defaults to the
+                 local file system.
+        dirs: list of directories where the block files are striped, for
+              instance on different devices. Files are in the current
+              directory if None.
+        stripe: 'round-robin' to assign blocks to dirs in turn, in block
+                index order, or 'hash' to assign them by a hash of their
+                index.
+        dtype: the type of the array elements, a DType or a type string
+               such as 'int16' or '>f4'. Shapes are in elements. Defaults
+               to the type of array, or to bytes.
+        order: the axis order of the data in the block files, from the
+               slowest to the fastest varying axis: 'C' (default), 'F'
+               (reversed axes) or a permutation of the axes, for instance
+               (1, 0, 2). Data is transposed when blocks are written or
+               read.
+        halo: width of the ghost region around each block, in elements.
+              Blocks are extended by halo elements on each side, clipped
+              at the edges of the array, so that neighbouring blocks
+              overlap. Keys of blocks are still the origins of the block
+              cores, which partition the array. Only for output
+              partitions.
+        block_cache: a BlockCache where read_block and read_region_block
+                     find the blocks already read. Blocks are read whole
+                     when they are missing from the cache. May be None.
     '''
 
-    def __init__(self, shape, name, array=None, fill=None, create_blocks=True):
+    def __init__(self, shape, name, array=None, fill=None, create_blocks=True,
+                 sieve=None, layout='files', codec=None, threads=None,
+                 backend=None, dirs=None, stripe='round-robin', dtype=None,
+                 order=None, halo=0, block_cache=None):
         '''
         Constructor
         '''
         assert(all(x >= 0 for x in shape)), f"Invalid shape: {shape}"
+        assert(layout in ('files', 'container')), f"Invalid layout: {layout}"
+        assert(codec is None or layout == 'files'), ("Compressed blocks "
+                                                     "require the 'files' "
+                                                     "layout")
+        assert(dirs is None or len(dirs) >= 1), 'No directory to stripe on'
+        assert(dirs is None or layout == 'files' or len(dirs) == 1), (
+            "Striping requires the 'files' layout")
+        assert(stripe in ('round-robin', 'hash')), f"Invalid stripe: {stripe}"
         self.shape = tuple(shape)
         self.ndim = len(shape)
         self.name = name
         self.array = self
+        self.layout = layout
+        self.codec = get_codec(codec)
+        self.threads = threads
+        self.backend = backend if backend is not None else LOCAL
+        self.sieve = sieve if sieve is not None else self.backend.sieve
+        assert(self.sieve >= 0), f"Invalid sieving threshold: {sieve}"
+        self.dirs = list(dirs) if dirs is not None else None
+        self.stripe = stripe
+        self.file_name = None  # container file
+        if layout == 'container':
+            self.file_name = self.__file_path(0, f'{name}_container.bin')
 
-        # check that block shape is compatible with array dimension
+        self.dtype = get_dtype(dtype)
+        self.itemsize = self.dtype.itemsize
+        if order is None or order == 'C':
+            order = tuple(range(self.ndim))
+        elif order == 'F':
+            order = tuple(reversed(range(self.ndim)))
+        assert(sorted(order) == list(range(self.ndim))), (f'Invalid axis '
+                                                          f'order: {order}')
+        self.order = tuple(order)
+        assert(halo >= 0), f'Invalid halo: {halo}'
+        self.halo = halo
+        self.block_cache = block_cache
+
+        # check that block shape is compatible with array dimension. Blocks
+        # at the edges of the array are smaller than shape if the array
+        # dimensions aren't multiples of shape.
         if array is not None:
             self.array = array
+            if dtype is None:
+                self.dtype = array.dtype
+                self.itemsize = array.itemsize
+            assert(self.dtype == array.dtype), (f'{self.dtype} differs from '
+                                                f'array type {array.dtype}')
             assert(array.ndim == self.ndim)
-            assert(all(array.shape[i] % self.shape[i] == 0
-                       for i in range(array.ndim)))
+            assert(all(x > 0 for x in self.shape)), (f'Invalid shape: '
+                                                     f'{self.shape}')
+        assert(halo == 0 or array is not None), 'Arrays cannot have halos'
 
         if create_blocks:
             self.blocks = self.__get_blocks(fill)
+            if fill is not None and layout == 'container':
+                self.write_index()
 
     def __get_blocks(self, fill):
         '''
@@ -58,20 +155,68 @@ class Partition():
         shape = self.array.shape
         # Warning: read order of blocks in repartition
         # depends on this key order...
-        ni = int(shape[0]/self.shape[0])
-        nj = int(shape[1]/self.shape[1])
-        nk = int(shape[2]/self.shape[2])
-        size = math.prod(self.shape)
-        blocks = {(i*self.shape[0], j*self.shape[1], k*self.shape[2]):
-                  Block((i*self.shape[0], j*self.shape[1], k*self.shape[2]),
-                        self.shape, fill=fill,
-                        file_name=(f'{self.name}_block_'
-                                   f'{size*(k+j*nk+i*nj*nk)}.bin'))
-                  for i in range(ni)
-                  for j in range(nj)
-                  for k in range(nk)}
+        origins = self.__get_origins()
+        size = math.prod(self.shape) * self.itemsize
+        if self.layout == 'container':
+            index = self.__get_index(len(origins))
+            return {origin: Block(*self.block_extent(origin), fill=fill,
+                                  file_name=self.file_name,
+                                  file_offset=index[origin],
+                                  backend=self.backend,
+                                  itemsize=self.itemsize, order=self.order)
+                    for origin in index}
+        blocks = {origin: Block(*self.block_extent(origin), fill=fill,
+                                file_name=self.__file_path(
+                                    n, f'{self.name}_block_{size*n}.bin'),
+                                codec=self.codec, backend=self.backend,
+                                itemsize=self.itemsize, order=self.order)
+                  for n, origin in enumerate(origins)}
         return blocks
 
+    def __get_origins(self):
+        '''
+        Return the list of block origins, in C order
+        '''
+        return list(itertools.product(*[range(0, n, x) for n, x in
+                                        zip(self.array.shape, self.shape)]))
+
+    def __file_path(self, index, file_name):
+        '''
+        Return the path of file_name, the file of the block of given index,
+        in the directory where the block is striped
+        '''
+        if self.dirs is None:
+            return file_name
+        if self.stripe == 'hash':
+            d = zlib.crc32(str(index).encode()) % len(self.dirs)
+        else:
+            d = index % len(self.dirs)
+        return os.path.join(self.dirs[d], file_name)
+
+    def __get_index(self, n_blocks):
+        '''
+        Return the offsets of the blocks in the container file, as a
+        dictionary. Key is the block origin, value is the offset. Offsets
+        are read from the container file if it exists and was written for
+        this partition, otherwise blocks are stored in the same order as in
+        the 'files' layout, after the header.
+        '''
+        if self.backend.exists(self.file_name):
+            array_shape, shape, index = read_index(self.file_name,
+                                                   self.backend)
+            if (array_shape == self.array.shape and shape == self.shape and
+                    len(index) == n_blocks):
+                return index
+            log(f'Container {self.file_name} is for blocks of shape '
+                f'{shape} of array of shape {array_shape}, ignoring its '
+                'index', 1)
+        index = {}
+        offset = data_offset(self.ndim, n_blocks)
+        for origin in self.__get_origins():
+            index[origin] = offset
+            offset += math.prod(self.block_extent(origin)[1]) * self.itemsize
+        return index
+
     def __str__(self):
         '''
         Return a string representation for the partition
@@ -79,7 +224,27 @@ class Partition():
         blocks = os.linesep.join([str(self.blocks[b]) for b in self.blocks])
 
         return (f'Partition of shape {self.shape} of array of shape '
-                f'{self.array.shape}. Blocks:' + os.linesep + blocks)
+                f'{self.array.shape}, axis order {self.order}. Blocks:' +
+                os.linesep + blocks)
+
+    def block_shape(self, origin):
+        '''
+        Return the shape of the block at origin: the shape of the partition,
+        clipped at the edges of the array
+        '''
+        return tuple(min(self.shape[i], self.array.shape[i] - origin[i])
+                     for i in range(self.ndim))
+
+    def block_extent(self, origin):
+        '''
+        Return the origin and shape of the block whose core is at origin,
+        halo included
+        '''
+        shape = self.block_shape(origin)
+        start = tuple(max(origin[i] - self.halo, 0) for i in range(self.ndim))
+        end = tuple(min(origin[i] + shape[i] + self.halo,
+                        self.array.shape[i]) for i in range(self.ndim))
+        return start, tuple(end[i] - start[i] for i in range(self.ndim))
 
     def clear(self):
         '''
@@ -92,6 +257,9 @@ class Partition():
         '''
         Delete all the blocks in the partition from disk
         '''
+        if self.layout == 'container':
+            self.backend.remove(self.file_name)
+            return
         for b in self.blocks:
             self.blocks[b].delete()
 
@@ -102,98 +270,466 @@ class Partition():
 
         Arguments:
             block_ind: index of a block in the partition
-            dim: 0, 1 or 2 (3D partition)
+            dim: a dimension of the partition, between 0 and ndim - 1
         '''
         array_shape = self.array.shape
-        n_blocks = [int(array_shape[i]/self.shape[i])
+        n_blocks = [math.ceil(array_shape[i]/self.shape[i])
                     for i in range(len(self.shape))]
-        if dim == 2:
-            neighbor_ind = block_ind + 1
-        if dim == 1:
-            neighbor_ind = block_ind + n_blocks[2]
-        if dim == 0:
-            neighbor_ind = block_ind + n_blocks[2]*n_blocks[1]
-        return neighbor_ind
+        return block_ind + math.prod(n_blocks[dim+1:])
 
-    def read_block(self, block):
+    def read_block(self, block, files=None):
         '''
         Read block from partition. Shape of block may or may not match shape of
         partition.
 
+        Arguments:
+            block: the block to read
+            files: a FilePool to get the block files from, or None
+
         Similar to write_block but for reads
         '''
         seeks = 0
         total_bytes = 0
         read_time = 0
+        if self.block_cache is not None:
+            return self.__read_cached_block(block)
+        if self.codec is not None:
+            return self.__read_compressed_block(block)
         for b in self.blocks:
             if not self.blocks[b].overlap(block):
                 continue
             # block may be read from multiple blocks of self
-            t, s, rt = block.read_from(self.blocks[b])
+            t, s, rt = block.read_from(self.blocks[b], self.sieve, files)
             seeks += s
             total_bytes += t
             read_time += rt
         return total_bytes, seeks, read_time
 
-    def repartition(self, out_blocks, m, get_read_blocks_and_cache):
+    def __read_compressed_block(self, block):
+        '''
+        Read block from the compressed blocks of the partition. Blocks are
+        read and decompressed by a pool of threads, so that decompression
+        overlaps with reads. Read time is the elapsed time.
+        '''
+        seeks = 0
+        total_bytes = 0
+        start = time.time()
+        blocks = [self.blocks[b] for b in self.blocks
+                  if self.blocks[b].overlap(block)]
+        with ThreadPoolExecutor(self.threads) as pool:
+            futures = [pool.submit(b.read_compressed) for b in blocks]
+            for b, future in zip(blocks, futures):
+                data, _ = future.result()
+                t, s, _ = block.read_from(b, data=data)
+                seeks += s
+                total_bytes += t
+        return total_bytes, seeks, time.time() - start
+
+    def __read_cached_block(self, block):
+        '''
+        Read block from the blocks of the partition in the block cache.
+        Blocks missing from the cache are read whole, in one seek.
+        '''
+        seeks = 0
+        total_bytes = 0
+        read_time = 0
+        for b in self.blocks.values():
+            if not b.overlap(block):
+                continue
+            start = time.time()
+            data, hit = self.block_cache.get(b)
+            read_time += time.time() - start
+            t, _, _ = block.read_from(b, data=data)
+            seeks += 0 if hit else 1
+            total_bytes += t
+        return total_bytes, seeks, read_time
+
+    def overlapping(self, origin, shape):
+        '''
+        Return the keys of the blocks whose cores overlap the region of the
+        array at origin, of given shape. Keys are computed from the block
+        grid, without testing every block of the partition.
+        '''
+        return list(itertools.product(*[
+            range(origin[i] - origin[i] % self.shape[i],
+                  origin[i] + shape[i], self.shape[i])
+            for i in range(self.ndim)]))
+
+    def read_region_block(self, origin, shape):
+        '''
+        Return the region of the array at origin, of given shape, as a Block
+        in C order. The blocks overlapping the region are found with
+        overlapping, and read by a pool of threads, one block file per
+        thread, with coalesced segments and data sieving, or from the block
+        cache. Data in the halos of the blocks is ignored.
+        '''
+        assert(len(origin) == self.ndim and len(shape) == self.ndim), (
+            f'Region {origin}, {shape} has not {self.ndim} dimensions')
+        assert(all(origin[i] >= 0 and shape[i] >= 0 and
+                   origin[i] + shape[i] <= self.array.shape[i]
+                   for i in range(self.ndim))), (f'Region {origin}, {shape} '
+                                                 f'is not in the array')
+        region = Block(origin, shape, itemsize=self.itemsize)
+        keys = self.overlapping(origin, shape)
+        parts = []
+        for key in keys:
+            core_shape = self.block_shape(key)
+            start = tuple(max(origin[i], key[i]) for i in range(self.ndim))
+            end = tuple(min(origin[i] + shape[i], key[i] + core_shape[i])
+                        for i in range(self.ndim))
+            parts += [Block(start, tuple(end[i] - start[i]
+                                         for i in range(self.ndim)),
+                            itemsize=self.itemsize)]
+
+        def read(key, part):
+            data = None
+            if self.block_cache is not None:
+                data, _ = self.block_cache.get(self.blocks[key])
+            part.read_from(self.blocks[key], self.sieve, data=data)
+            return part
+
+        with ThreadPoolExecutor(self.threads) as pool:
+            for part in pool.map(read, keys, parts):
+                region.put_data_block(part)
+        return region
+
+    def read_region(self, origin, shape):
+        '''
+        Return the region of the array at origin, of given shape, as a numpy
+        array of the type of the partition, in C order. See
+        read_region_block. Requires numpy.
+        '''
+        assert(numpy is not None), 'read_region requires numpy'
+        block = self.read_region_block(origin, shape)
+        return numpy.frombuffer(block.data.buffer(),
+                                dtype=self.dtype.name).reshape(block.shape)
+
+    def repartition(self, out_blocks, m, get_read_blocks_and_cache,
+                    tracker=None, journal=None, checksum=None,
+                    max_open_files=POOL_SIZE, pyramid=None, transform=None):
         '''
         Write data from self in files of partition out_blocks. Implements
         Algorithm 1 in the paper.
 
+        out_blocks may also be a list of partitions, all written in a single
+        pass: each read block is read once and inserted in the cache of
+        every output partition. get_read_blocks_and_cache must then return
+        a FanOutCache, as keep.fan_out.
+
+        Memory constraint m is also enforced at runtime: when the next read
+        block doesn't fit in the memory left by the cache, it is read in
+        slabs along dimension 0, and complete write blocks are written
+        between two slabs.
+
         Arguments:
-            out_blocks: a partition. The blocks of this partition are written.
-            m: memory constraint.
+            out_blocks: a partition, or a list of partitions. The blocks of
+                        these partitions are written.
+            m: memory constraint, shared by all the output partitions.
             get_read_blocks_and_cache: function that returns read blocks and
                                        an initialized cache from
                                        (in_blocks, out_blocks, m, array)
+            tracker: a MemoryTracker measuring real memory usage at each
+                     step, alongside the logical cache occupancy. If the
+                     tracker has a budget, measured memory is also kept
+                     under this budget at runtime. May be None.
+            journal: a Journal where processed read blocks and written
+                     write blocks are recorded. Read blocks found in the
+                     journal are skipped if all the write blocks they
+                     contribute to were written, otherwise they are read
+                     again, for the write blocks that weren't written only.
+                     May be None. Only for a single output partition.
+            checksum: an InlineChecksum recording the checksums of the data
+                      read and written, with one output checksum per output
+                      partition. May be None.
+            max_open_files: max number of block files kept open between
+                            reads and writes.
+            pyramid: a Pyramid whose levels are computed from the blocks
+                     of the (first) output partition as they are written.
+                     May be None. Not with a resumed journal, as skipped
+                     blocks would be missing from the levels. Buffers of
+                     the levels count in the memory used, and their writes
+                     in the returned counts.
+            transform: a Transform applied to the read blocks before they
+                       are inserted in the cache, or to the write blocks
+                       before they are written, depending on its stage.
+                       The output partitions have the type of the
+                       transformed elements. checksum is computed on the
+                       data between the two stages. May be None.
 
         Return number of bytes read or written, and number of seeks done
         '''
+        outputs = out_blocks if isinstance(out_blocks, list) else [out_blocks]
         log('')
-        log(f'repartition: # Repartitioning {self.name} in {out_blocks.name}')
+        log(f'repartition: # Repartitioning {self.name} in '
+            f'{", ".join(o.name for o in outputs)}')
+        assert(journal is None or len(outputs) == 1), ('Journals require a '
+                                                       'single output '
+                                                       'partition')
+        assert(journal is None or
+               all(o.backend.durable_flush for o in outputs)), (
+            'Cannot journal writes buffered by the output backend')
+        assert(self.halo == 0), f'Cannot repartition {self.name}, it has halos'
+        dtype = self.dtype
+        if transform is not None:
+            log(f'repartition: {transform}', 1)
+            dtype = transform.output_dtype(self.dtype)
+            assert(transform.stage == 'read' or
+                   dtype.itemsize == self.itemsize), (
+                f'{transform} cannot change the element size')
+        for o in outputs:
+            assert(o.dtype == dtype), (f'{o.dtype} of {o.name} differs from '
+                                       f'{dtype}')
+        # size of the elements inserted in the cache
+        itemsize = dtype.itemsize
         r, c, e, p = get_read_blocks_and_cache(self, out_blocks, m, self.array)
         read_blocks, cache, expected_seeks, est_peak_mem = (r, c, e, p)
+        assert(len(outputs) == 1 or isinstance(cache, FanOutCache)), (
+            f'Cannot write {len(outputs)} partitions with {cache}')
         seeks = 0
         peak_mem = 0
+        peak_cache = 0  # peak memory of the cache, without the pyramid
         total_bytes = 0
         bytes_in_cache = 0
         read_time = 0
         write_time = 0
-        for read_block in read_blocks.blocks:
-            log(f'repartition: reading block: {read_block}', 0)
-            t, s, rt = self.read_block(read_blocks.blocks[read_block])
-            bytes_in_cache += t
+        split = False  # True if a read block was split at runtime
+        # read blocks processed, recorded in the journal once their writes
+        # are done
+        reads = []
+        files = FilePool(max_open_files)
+        # Writes to striped partitions go to one queue per device, and
+        # proceed while the next block is read
+        queues = IOQueues(files, asynchronous=any(o.dirs is not None
+                                                  for o in outputs))
+        if journal is not None:
+            destinations = ', '.join(f'{o.name} {o.shape}' for o in outputs)
+            journal.start(f'{self.name} {self.shape} -> {destinations}, '
+                          f'read blocks {read_blocks.shape}')
+            cache.exclude(journal.writes)
+            assert(pyramid is None or not journal.resumed), (
+                'Cannot resume a repartitioning with a pyramid')
+        for o in outputs:
+            if o.layout == 'container':
+                o.write_index()
+        if tracker is not None:
+            tracker.start()
+        try:
+            for read_block in read_blocks.blocks:
+                parent = read_blocks.blocks[read_block]
+                if (journal is not None and
+                        journal.done(read_block, cache.destinations(parent))):
+                    log(f'repartition: skipping block {parent}, found in '
+                        'journal', 0)
+                    continue
+                free = self.__free_memory(cache, m, tracker, pyramid)
+                if (free is not None and
+                        math.prod(parent.shape) * itemsize > free):
+                    # wait for the pending writes rather than splitting
+                    r, t, s, wt = self.__written(queues, journal, reads)
+                    bytes_in_cache -= r
+                    total_bytes += t
+                    seeks += s
+                    write_time += wt
+                for block in self.__sub_reads(parent, cache, m, tracker,
+                                              itemsize, pyramid):
+                    if block is not parent:
+                        split = True
+                    log(f'repartition: reading block: {block}', 0)
+                    t, s, rt = self.read_block(block, files)
+                    if transform is not None and transform.stage == 'read':
+                        transform.apply(block)
+                    if checksum is not None:
+                        checksum.read(block)
+                    # the data read is copied to the cache of each output
+                    bytes_in_cache += block.mem_usage() * len(outputs)
+                    total_bytes += t
+                    seeks += s
+                    read_time += rt
+                    r, t, s, wt = self.__written(queues, journal, reads)
+                    bytes_in_cache -= r
+                    total_bytes += t
+                    seeks += s
+                    write_time += wt
+                    log(f'repartition: inserting read block of size '
+                        f'{block.mem_usage()}B to cache')
+                    complete_blocks = cache.insert(block, parent)
+                    if journal is not None and journal.resumed:
+                        # data for write blocks already written was dropped
+                        bytes_in_cache = cache.mem_usage()
+                    log(f'repartition: Cache: {str(cache)}', 0)
+                    peak_cache = max(peak_cache, cache.mem_usage())
+                    mem = self.__mem_usage(cache, pyramid)
+                    peak_mem = max(peak_mem, mem)
+                    if tracker is not None:
+                        tracker.sample(mem)
+                    for b in complete_blocks:
+                        log(f'repartition: Writing complete block {b}', 0)
+                        out = outputs[0]
+                        if isinstance(cache, FanOutCache):
+                            out = cache.output(b)
+                        if checksum is not None:
+                            checksum.write(b, outputs.index(out))
+                        if (transform is not None and
+                                transform.stage == 'write'):
+                            transform.apply(b)
+                        if pyramid is not None and out is outputs[0]:
+                            pyramid.add(b)
+                            # b is still in the cache
+                            peak_mem = max(peak_mem,
+                                           self.__mem_usage(cache, pyramid))
+                        queues.write(b, out)
+                    if not queues.asynchronous:
+                        r, t, s, wt = self.__written(queues, journal, reads)
+                        bytes_in_cache -= r
+                        total_bytes += t
+                        seeks += s
+                        write_time += wt
+                    # read block data was copied to the cache or written
+                    if not queues.writing(block):
+                        block.clear()
+                    message = (f'{bytes_in_cache}, {cache.mem_usage()}')
+                    assert(bytes_in_cache == cache.mem_usage()), message
+                    if tracker is not None:
+                        tracker.sample(self.__mem_usage(cache, pyramid))
+                reads += [read_block]
+            r, t, s, wt = self.__written(queues, journal, reads)
+            bytes_in_cache -= r
             total_bytes += t
             seeks += s
-            read_time += rt
-            log(f'repartition: inserting read block of size '
-                f'{read_blocks.blocks[read_block].mem_usage()}B to cache')
-            complete_blocks = cache.insert(read_blocks.blocks[read_block])
-            log(f'repartition: Cache: {str(cache)}', 0)
-            peak_mem = max(peak_mem, cache.mem_usage())
-            for b in complete_blocks:
-                log(f'repartition: Writing complete block {b}', 0)
-                t, s, wt = out_blocks.write_block(b)
-                assert(t == b.mem_usage())
-                b.clear()
-                bytes_in_cache -= t
-                log(f'repartition: Write required {s} seeks', 0)
-                log(f'repartition: Cache: {str(cache)}', 0)
-                total_bytes += t
-                seeks += s
-                write_time += wt
-                b.clear()
-            message = (f'{bytes_in_cache}, {cache.mem_usage()}')
-            assert(bytes_in_cache == cache.mem_usage()), message
-
-        message = (f'Incorrect seek count. Expected: {expected_seeks}.'
-                   f' Real: {seeks}')
-        assert((expected_seeks == seeks)), message
-        # message = (f'Incorrect memory usage. Expected: {est_peak_mem}B.'
-        #            f' Real: {peak_mem}B.')
-        # assert(dry_run or (est_peak_mem == peak_mem)), message
+            write_time += wt
+        finally:
+            # also when interrupted, so that written data is flushed
+            queues.close()
+            log(f'repartition: {files}; {queues}', 1)
+            files.close()
+            if tracker is not None:
+                tracker.stop()
+                log(f'repartition: {tracker}', 1)
+            if journal is not None:
+                journal.close()
+        if pyramid is not None:
+            log(f'repartition: {pyramid}', 1)
+            assert(pyramid.complete()), 'Incomplete pyramid levels'
+            if m is not None and peak_mem > m:
+                # read blocks are planned for the cache only
+                log(f'repartition: peak memory {peak_mem}B exceeded the '
+                    f'memory constraint {m}B with the pyramid levels', 1)
+
+        if (split or (journal is not None and journal.resumed) or
+                self.block_cache is not None):
+            # Estimates assume that all read blocks are read in one piece,
+            # by segments of the input blocks
+            log(f'repartition: read blocks were split, skipped or cached, '
+                f'expected {expected_seeks} seeks, did {seeks}', 1)
+        else:
+            message = (f'Incorrect seek count. Expected: {expected_seeks}.'
+                       f' Real: {seeks}')
+            assert((expected_seeks == seeks)), message
+            # A negative estimate means that peak memory wasn't estimated.
+            # Estimates don't include the pyramid.
+            message = (f'Incorrect memory usage. Expected: {est_peak_mem}B.'
+                       f' Real: {peak_cache}B.')
+            assert(est_peak_mem < 0 or est_peak_mem == peak_cache), message
+        if pyramid is not None:
+            total_bytes += pyramid.total_bytes
+            seeks += pyramid.seeks
+            write_time += pyramid.write_time
         return total_bytes, seeks, peak_mem, read_time, write_time
 
+    def __mem_usage(self, cache, pyramid):
+        '''
+        Return the memory used by the cache and the levels of pyramid
+        '''
+        if pyramid is None:
+            return cache.mem_usage()
+        return cache.mem_usage() + pyramid.mem_usage()
+
+    def __free_memory(self, cache, m, tracker, pyramid=None):
+        '''
+        Return the memory that can still be used by the cache under memory
+        constraint m and tracker budget, or None if there is no constraint.
+        Blocks waiting in the I/O queues are still in the cache, and the
+        levels of pyramid use memory too.
+        '''
+        free = None
+        if m is not None:
+            free = m - self.__mem_usage(cache, pyramid)
+        if tracker is not None and tracker.budget is not None:
+            measured_free = tracker.budget - tracker.measured()
+            free = measured_free if free is None else min(free, measured_free)
+        return free
+
+    def __sub_reads(self, read_block, cache, m, tracker, itemsize,
+                    pyramid=None):
+        '''
+        Generate the blocks to read for read_block without exceeding memory
+        constraint m. This is read_block itself if it fits in memory, or
+        slabs of read_block along dimension 0 otherwise. The memory left is
+        evaluated again after each slab, once complete blocks are written.
+        itemsize is the size of the elements in the cache, after the read
+        transform.
+        '''
+        free = self.__free_memory(cache, m, tracker, pyramid)
+        if free is None or math.prod(read_block.shape) * itemsize <= free:
+            yield read_block
+            return
+
+        plane_size = math.prod(read_block.shape[1:]) * itemsize
+        start = read_block.origin[0]
+        end = read_block.origin[0] + read_block.shape[0]
+        while start < end:
+            free = self.__free_memory(cache, m, tracker, pyramid)
+            n_planes = min(max(free // plane_size, 1), end - start)
+            if n_planes * plane_size > free:
+                log(f'repartition: cannot read a plane of {read_block} in '
+                    f'{free}B, memory constraint will be exceeded', 1)
+            log(f'repartition: reading {n_planes} planes of {read_block} '
+                f'to fit in {free}B', 0)
+            yield Block((start,) + read_block.origin[1:],
+                        (n_planes,) + read_block.shape[1:],
+                        itemsize=self.itemsize)
+            start += n_planes
+
+    def __written(self, queues, journal, reads):
+        '''
+        Wait for the writes in queues, clear the written blocks and record
+        them in journal, along with the read blocks in reads, whose
+        writes are all done. reads is emptied.
+
+        Return the number of bytes released from the cache, bytes written,
+        seeks and write time. With asynchronous queues, write time is the
+        time waited for the device threads.
+        '''
+        released = 0
+        total_bytes = 0
+        seeks = 0
+        write_time = 0
+        start = time.time()
+        done = queues.done()
+        wait_time = time.time() - start
+        for b, t, s, wt in done:
+            # data in the halos of the output blocks is written more than
+            # once
+            assert(t >= b.mem_usage())
+            log(f'repartition: Write of {b} required {s} seeks', 0)
+            released += b.mem_usage()
+            b.clear()
+            total_bytes += t
+            seeks += s
+            write_time += wt
+            if journal is not None:
+                queues.flush()
+                journal.record_write(b.origin)
+        if journal is not None:
+            for origin in reads:
+                journal.record_read(origin)
+        reads.clear()
+        if queues.asynchronous:
+            # device threads write concurrently, with each other and with
+            # reads: only the time waited for them is elapsed
+            write_time = wait_time
+        return released, total_bytes, seeks, write_time
+
     def write(self):
         '''
         Write all the partition blocks to file.
@@ -201,22 +737,55 @@ class Partition():
         for b in self.blocks:
             self.blocks[b].write()
 
-    def write_block(self, block):
+    def write_block(self, block, files=None):
         '''
         Write data in block to partition blocks. Shape of block may not match
         shape of partition.
 
+        Arguments:
+            block: the block to write
+            files: a FilePool to get the block files from, or None
+
         Similar to read_block but for writes
         '''
         seeks = 0
         total_bytes = 0
         write_time = 0
-        for b in self.blocks:
-            # block may be written to multiple blocks in self
-            if not self.blocks[b].overlap(block):
-                continue
-            t, s, wt = block.write_to(self.blocks[b])
+        # block may be written to multiple blocks in self
+        blocks = [self.blocks[b] for b in self.blocks
+                  if self.blocks[b].overlap(block)]
+        if self.codec is not None:
+            # Blocks are compressed and written by a pool of threads.
+            # Block data is merged first, so that threads only read it.
+            # Write time is the elapsed time.
+            start = time.time()
+            block.data.get()
+            with ThreadPoolExecutor(self.threads) as pool:
+                results = list(pool.map(block.write_to, blocks))
+            write_time = time.time() - start
+            results = [(t, s, 0) for t, s, _ in results]
+        else:
+            results = (block.write_to(b, files) for b in blocks)
+        for t, s, wt in results:
             seeks += s
             total_bytes += t
             write_time += wt
+        if self.block_cache is not None:
+            # writes to files kept open may not be visible yet, the cached
+            # data is dropped rather than validated by modification time
+            for b in blocks:
+                if files is not None:
+                    files.flush(b.file_name)
+                self.block_cache.invalidate(b)
         return total_bytes, seeks, write_time
+
+    def write_index(self):
+        '''
+        Write the header of the container file, indexing the block offsets.
+        Only for partitions with the 'container' layout.
+        '''
+        assert(self.layout == 'container'), (f'Partition {self.name} has no '
+                                             'container file')
+        write_index(self.file_name, self.array.shape, self.shape,
+                    {b: self.blocks[b].file_offset for b in self.blocks},
+                    self.backend)
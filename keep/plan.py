@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+from keep.block import Block
+from keep.cache import BaselineCache, KeepCache, TwoPhaseCache
+from keep.log import log
+from keep.partition import Partition
+
+
+class Plan():
+    '''
+    A repartitioning plan, that is, what get_read_blocks_and_cache
+    functions compute before Partition.repartition reads any data. Plans
+    can be saved to and loaded from JSON files.
+
+    Attributes:
+        key: a string identifying the repartitioning that the plan is for
+        read_shape: shape of the read blocks
+        write_blocks: list of (origin, shape) of the write blocks, or None if
+                      the cache doesn't use write blocks
+        match: list of (read block origin, F block index, write block index)
+               tuples, matching the F blocks of the read blocks to the write
+               blocks. None if write_blocks is None.
+        seeks: expected number of seeks
+        peak_mem: expected peak memory, negative if not estimated
+        cache: 'baseline', 'keep' or 'two-phase', the type of cache
+    '''
+
+    def __init__(self, key, read_shape, write_blocks, match, seeks,
+                 peak_mem, cache='keep'):
+        '''
+        Constructor
+        '''
+        self.key = key
+        self.read_shape = tuple(read_shape)
+        self.write_blocks = write_blocks
+        self.match = match
+        self.seeks = seeks
+        self.peak_mem = peak_mem
+        self.cache = cache
+
+    def __str__(self):
+        '''
+        Return a string representation for the plan
+        '''
+        n = 0 if self.write_blocks is None else len(self.write_blocks)
+        return (f'Plan for {self.key}: read shape {self.read_shape}; '
+                f'{n} write blocks; {self.seeks} seeks; peak memory '
+                f'{self.peak_mem}B')
+
+    def get_read_blocks_and_cache(self, in_blocks, out_blocks, m, array):
+        '''
+        Implements get_read_blocks_and_cache(in_blocks, out_blocks, m, array)
+        used in Partition.repartition, from the plan.
+        '''
+        read_blocks = Partition(self.read_shape, 'read_blocks', array)
+        if self.cache == 'baseline':
+            return read_blocks, BaselineCache(), self.seeks, self.peak_mem
+        if self.cache == 'two-phase':
+            cache = TwoPhaseCache(out_blocks)
+            return read_blocks, cache, self.seeks, self.peak_mem
+        blocks = [Block(origin, shape, data=bytearray(),
+                        itemsize=out_blocks.itemsize)
+                  for origin, shape in self.write_blocks]
+        match = {(origin, f): blocks[i] for origin, f, i in self.match}
+        cache = KeepCache(out_blocks, match)
+        return read_blocks, cache, self.seeks, self.peak_mem
+
+    def save(self, file_name):
+        '''
+        Save the plan in JSON file file_name
+        '''
+        plan = {'key': self.key,
+                'read_shape': self.read_shape,
+                'write_blocks': self.write_blocks,
+                'match': self.match,
+                'seeks': self.seeks,
+                'peak_mem': self.peak_mem,
+                'cache': self.cache}
+        # Write in a temporary file first so that concurrent runs never
+        # load a partial plan
+        tmp_name = f'{file_name}.{os.getpid()}.tmp'
+        with open(tmp_name, 'w') as f:
+            json.dump(plan, f)
+        os.replace(tmp_name, file_name)
+
+
+def get_plan(key, read_blocks, cache, seeks, peak_mem):
+    '''
+    Return the Plan for the result of a get_read_blocks_and_cache function
+    '''
+    if isinstance(cache, BaselineCache):
+        return Plan(key, read_blocks.shape, None, None, seeks, peak_mem,
+                    'baseline')
+    if isinstance(cache, TwoPhaseCache):
+        return Plan(key, read_blocks.shape, None, None, seeks, peak_mem,
+                    'two-phase')
+    assert(isinstance(cache, KeepCache)), f'Cannot plan for cache {cache}'
+    blocks = []
+    index = {}  # id of write block -> index in blocks
+    for b in cache.match.values():
+        if id(b) not in index:
+            index[id(b)] = len(blocks)
+            blocks += [(b.origin, b.shape)]
+    match = [(origin, f, index[id(cache.match[(origin, f)])])
+             for origin, f in cache.match]
+    return Plan(key, read_blocks.shape, blocks, match, seeks, peak_mem)
+
+
+def load_plan(file_name):
+    '''
+    Return the Plan saved in JSON file file_name
+    '''
+    with open(file_name) as f:
+        plan = json.load(f)
+    write_blocks = plan['write_blocks']
+    match = plan['match']
+    if write_blocks is not None:
+        write_blocks = [(tuple(origin), tuple(shape))
+                        for origin, shape in write_blocks]
+        match = [(tuple(origin), f, i) for origin, f, i in match]
+    # plans saved before caches were recorded are baseline or keep plans
+    cache = plan.get('cache', 'keep' if write_blocks is not None
+                     else 'baseline')
+    return Plan(plan['key'], plan['read_shape'], write_blocks, match,
+                plan['seeks'], plan['peak_mem'], cache)
+
+
+def plan_key(array, in_blocks, out_blocks, m, method):
+    '''
+    Return a string identifying the repartitioning of in_blocks into
+    out_blocks with memory constraint m and method, a string
+    '''
+    codecs = [p.codec.name if p.codec is not None else None
+              for p in (in_blocks, out_blocks)]
+    dtypes = [p.dtype.name for p in (in_blocks, out_blocks)]
+    orders = [p.order for p in (in_blocks, out_blocks)]
+    return (f'{method}: A={array.shape}, I={in_blocks.shape}, '
+            f'O={out_blocks.shape}, m={m}, sieve={in_blocks.sieve}, '
+            f'codecs={codecs}, dtypes={dtypes}, orders={orders}, '
+            f'halo={out_blocks.halo}')
+
+
+def cached(get_read_blocks_and_cache, method, cache_dir):
+    '''
+    Return a get_read_blocks_and_cache function that loads plans from
+    directory cache_dir, and that runs get_read_blocks_and_cache and saves
+    the resulting plan in cache_dir when no plan is found.
+
+    Arguments:
+        get_read_blocks_and_cache: a function such as keep.keep
+        method: the name of the method, used in the plan keys
+        cache_dir: directory where plans are stored. Created if needed.
+    '''
+
+    def cached_get_read_blocks_and_cache(in_blocks, out_blocks, m, array):
+        key = plan_key(array, in_blocks, out_blocks, m, method)
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        file_name = os.path.join(cache_dir, f'plan_{digest}.json')
+        if os.path.isfile(file_name):
+            plan = load_plan(file_name)
+            if plan.key == key:
+                log(f'Loaded {plan}', 1)
+                return plan.get_read_blocks_and_cache(in_blocks, out_blocks,
+                                                      m, array)
+        r, c, e, p = get_read_blocks_and_cache(in_blocks, out_blocks, m,
+                                               array)
+        plan = get_plan(key, r, c, e, p)
+        os.makedirs(cache_dir, exist_ok=True)
+        plan.save(file_name)
+        log(f'Saved {plan}', 1)
+        return r, c, e, p
+
+    return cached_get_read_blocks_and_cache
@@ -0,0 +1,153 @@
+import itertools
+import math
+import time
+from keep.block import FORMATS, Block
+from keep.cache import TwoPhaseCache
+from keep.log import log
+from keep.partition import Partition
+
+
+def downsample(block):
+    '''
+    Return a Block containing the elements of block at even coordinates of
+    the array, at its position in the array downsampled 2x along every
+    dimension. Elements are copied, not interpolated, so any element type
+    can be downsampled.
+    '''
+    ndim = len(block.shape)
+    # first even coordinate of block and number of even coordinates
+    first = [block.origin[i] + block.origin[i] % 2 for i in range(ndim)]
+    counts = [max(0, (block.end[i] - first[i]) // 2 + 1)
+              for i in range(ndim)]
+    origin = tuple((block.origin[i] + 1) // 2 for i in range(ndim))
+    if 0 in counts:
+        return Block(origin, (0,) * ndim, itemsize=block.itemsize)
+    itemsize = block.itemsize
+    data = memoryview(block.data.get())
+    row_size = block.shape[-1] * itemsize
+    rows = []
+    for index in itertools.product(*[range(first[i], block.end[i] + 1, 2)
+                                     for i in range(ndim - 1)]):
+        offset = block.offset(index + (block.origin[-1],))
+        row = data[offset:offset + row_size]
+        start = first[-1] - block.origin[-1]
+        if itemsize in FORMATS:
+            rows += [row.cast(FORMATS[itemsize])[start::2].tobytes()]
+        else:
+            rows += [row[i*itemsize:(i+1)*itemsize]
+                     for i in range(start, block.shape[-1], 2)]
+    return Block(origin, counts, data=bytearray(b''.join(rows)),
+                 itemsize=itemsize)
+
+
+def level_shape(shape, level):
+    '''
+    Return the shape of an array of given shape downsampled 2^level times
+    '''
+    return tuple(math.ceil(x / 2**level) for x in shape)
+
+
+class Pyramid():
+    '''
+    Downsampled levels of an array, computed by Partition.repartition from
+    the complete blocks about to be written, while they are in memory.
+    Level k is the array downsampled 2^k times along every dimension by
+    keeping the elements at even coordinates, stored in its own partition.
+    Level k blocks are assembled from the downsampled blocks of level k - 1
+    and written as soon as they are complete, so that the output blocks
+    are never read again.
+
+    Partition.repartition counts the buffers of the levels in its memory
+    usage, and their writes in its totals.
+
+    Attributes:
+        levels: the partitions of levels 1 to n_levels
+        caches: a TwoPhaseCache assembling the blocks of each level
+        total_bytes: number of bytes written to the levels
+        seeks: number of seeks done to write the levels
+        write_time: time spent writing the levels
+    '''
+
+    def __init__(self, out_blocks, n_levels, shape=None):
+        '''
+        Constructor
+
+        Arguments:
+            out_blocks: the output partition of the repartitioning. Levels
+                        are named after it, and stored with the same
+                        backend, codec and axis order.
+            n_levels: number of levels
+            shape: shape of the blocks of the levels. Defaults to the shape
+                   of out_blocks.
+        '''
+        assert(n_levels >= 1), f'Invalid number of levels: {n_levels}'
+        shape = out_blocks.shape if shape is None else shape
+        self.levels = []
+        for k in range(1, n_levels + 1):
+            array = Partition(level_shape(out_blocks.array.shape, k),
+                              name=f'{out_blocks.name}_level{k}_array',
+                              dtype=out_blocks.dtype)
+            self.levels += [Partition(
+                tuple(min(shape[i], array.shape[i])
+                      for i in range(len(shape))),
+                name=f'{out_blocks.name}_level{k}', array=array,
+                codec=(out_blocks.codec.name if out_blocks.codec is not None
+                       else None),
+                backend=out_blocks.backend, order=out_blocks.order)]
+        self.caches = [TwoPhaseCache(level) for level in self.levels]
+        self.total_bytes = 0
+        self.seeks = 0
+        self.write_time = 0
+
+    def __str__(self):
+        '''
+        Return a string representation for the pyramid
+        '''
+        return (f'Pyramid of {len(self.levels)} levels: '
+                f'{self.total_bytes}B written, {self.seeks} seeks')
+
+    def add(self, block):
+        '''
+        Downsample block, a complete block of the output partition, in the
+        first level, and the level blocks completed in the next levels.
+        Complete level blocks are written and cleared.
+        '''
+        blocks = [block]
+        for level, cache in zip(self.levels, self.caches):
+            complete_blocks = []
+            for b in blocks:
+                d = downsample(b)
+                if not d.empty():
+                    complete_blocks += cache.insert(d)
+                if b is not block:
+                    # level block written, and downsampled in next level
+                    b.clear()
+            for b in complete_blocks:
+                log(f'pyramid: writing {b} to {level.name}', 0)
+                start = time.time()
+                t, s, _ = level.write_block(b)
+                self.write_time += time.time() - start
+                self.total_bytes += t
+                self.seeks += s
+            blocks = complete_blocks
+        for b in blocks:
+            b.clear()
+
+    def mem_usage(self):
+        '''
+        Return the memory used by the level blocks being assembled
+        '''
+        return sum(cache.mem_usage() for cache in self.caches)
+
+    def complete(self):
+        '''
+        Return True if all the level blocks were written
+        '''
+        return all(cache.mem_usage() == 0 for cache in self.caches)
+
+    def delete(self):
+        '''
+        Delete the level blocks from disk
+        '''
+        for level in self.levels:
+            level.delete()
@@ -5,8 +5,27 @@ import os
 from argparse import ArgumentParser
 from ast import literal_eval as make_tuple
 from keep import keep
+from keep.backend import PROFILES, get_backend
+from keep.checksum import InlineChecksum, verify
+from keep.codec import CODECS
+from keep.files import POOL_SIZE
+from keep.generate import generate
 from keep.partition import Partition
+from keep.journal import Journal
 from keep.log import log
+from keep.memory import MemoryTracker, calibrate
+from keep.objectstore import ObjectStoreBackend
+from keep.plan import cached
+from keep.pyramid import Pyramid
+
+
+def get_order(order):
+    """
+    Return the axis order of a partition from its command-line value
+    """
+    if order in ("C", "F"):
+        return order
+    return make_tuple(order)
 
 
 def main(args=None):
@@ -46,51 +65,322 @@ def main(args=None):
     commands.add_argument(
         "--test-data",
         action="store_true",
-        help="reconstruct array from input blocks, "
-        "reconstruct array from output blocks, "
-        "check that data is identical in both "
-        "reconstructions.",
+        help="compute checksums of the array from input blocks and "
+        "from output blocks, check that they are identical.",
     )
     parser.add_argument(
         "--max-mem", action="store", help="max memory to use, in bytes"
     )
+    parser.add_argument(
+        "--sieve",
+        action="store",
+        type=int,
+        help="data sieving threshold, in bytes: segments of an input block "
+        "separated by at most this many bytes are read in a single request. "
+        "Defaults to 0, or to the threshold of the object store.",
+    )
+    parser.add_argument(
+        "--in-layout",
+        action="store",
+        default="files",
+        choices=["files", "container"],
+        help="storage of the input blocks: one file per block, or a "
+        "single container file indexing the blocks.",
+    )
+    parser.add_argument(
+        "--out-layout",
+        action="store",
+        default="files",
+        choices=["files", "container"],
+        help="storage of the output blocks, as in --in-layout.",
+    )
+    parser.add_argument(
+        "--in-order",
+        action="store",
+        default="C",
+        help="axis order of the data in the input block files, from the "
+        "slowest to the fastest varying axis: C, F (reversed axes) or a "
+        "permutation of the axes, for instance (1, 0, 2).",
+    )
+    parser.add_argument(
+        "--out-order",
+        action="store",
+        default="C",
+        help="axis order of the output blocks, as in --in-order. Data is "
+        "transposed in memory before it is written.",
+    )
+    parser.add_argument(
+        "--halo",
+        action="store",
+        type=int,
+        default=0,
+        help="width of the ghost region of the output blocks, in elements. "
+        "Output blocks are extended by this many elements on each side, "
+        "and overlap. Not with the two-phase method.",
+    )
+    parser.add_argument(
+        "--in-codec",
+        action="store",
+        choices=sorted(CODECS),
+        help="codec compressing the input blocks. Blocks are not "
+        "compressed if not set.",
+    )
+    parser.add_argument(
+        "--out-codec",
+        action="store",
+        choices=sorted(CODECS),
+        help="codec compressing the output blocks, as in --in-codec.",
+    )
+    parser.add_argument(
+        "--backend",
+        action="store",
+        default="local",
+        choices=["local"] + sorted(PROFILES),
+        help="storage backend of the blocks: local files, or local files "
+        "accessed with the seek latency and bandwidth of a simulated "
+        "device.",
+    )
+    parser.add_argument(
+        "--object-store",
+        action="store",
+        help="URL of an S3-compatible bucket where blocks are stored, "
+        "followed by an optional key prefix. Overrides --backend. Requests "
+        "are signed if $AWS_ACCESS_KEY_ID and $AWS_SECRET_ACCESS_KEY are "
+        "set.",
+    )
+    parser.add_argument(
+        "--in-dirs",
+        action="store",
+        help="comma-separated list of directories where input blocks are "
+        "striped, for instance on different devices.",
+    )
+    parser.add_argument(
+        "--out-dirs",
+        action="store",
+        help="comma-separated list of directories where output blocks are "
+        "striped. Blocks are written by one I/O queue per device.",
+    )
+    parser.add_argument(
+        "--stripe",
+        action="store",
+        default="round-robin",
+        choices=["round-robin", "hash"],
+        help="assignment of the blocks to the directories.",
+    )
+    parser.add_argument(
+        "--fill",
+        action="store",
+        default="random",
+        choices=["random", "zeros"],
+        help="with --create, content of the input blocks. Zero blocks "
+        "are created as sparse files.",
+    )
+    parser.add_argument(
+        "--dtype",
+        action="store",
+        default="uint8",
+        help="type of the array elements, for instance int16 or >f4. "
+        "Shapes are in elements.",
+    )
+    parser.add_argument(
+        "--seed",
+        action="store",
+        type=int,
+        help="with --create, seed of the random input blocks",
+    )
+    parser.add_argument(
+        "--jobs",
+        action="store",
+        type=int,
+        help="with --create or --test-data, number of processes writing "
+        "or reading blocks. With --repartition, number of threads "
+        "compressing or decompressing blocks. Defaults to the number of "
+        "CPUs.",
+    )
+    parser.add_argument(
+        "--inline-checksum",
+        action="store_true",
+        help="with --repartition, compute checksums of the data read and "
+        "written while repartitioning, and check that they are identical.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="with --repartition, resume an interrupted repartitioning "
+        "from its journal instead of deleting the output blocks.",
+    )
+    parser.add_argument(
+        "--fan-out",
+        action="append",
+        default=[],
+        metavar="O",
+        help="shape of additional output blocks, called 'out1...', "
+        "'out2...', etc, written in the same pass as the output blocks. "
+        "Input blocks are read once. Only with the keep method, and "
+        "without --resume.",
+    )
+    parser.add_argument(
+        "--pyramid",
+        action="store",
+        type=int,
+        default=0,
+        help="number of downsampled levels of the array written while "
+        "repartitioning, in blocks called 'out_level1...', "
+        "'out_level2...', etc, of the output block shape. Level k keeps "
+        "one element in 2^k along each dimension. Not with --resume.",
+    )
+    parser.add_argument(
+        "--mem-overhead",
+        action="store",
+        type=float,
+        default=1.0,
+        help="ratio between real and logical memory usage, as "
+        "measured by a previous run. The memory constraint passed to "
+        "the read shape search is max-mem divided by this factor.",
+    )
+    parser.add_argument(
+        "--trace-mem",
+        action="store_true",
+        help="measure memory with tracemalloc instead of RSS. "
+        "More accurate but slower.",
+    )
+    parser.add_argument(
+        "--enforce-measured-mem",
+        action="store_true",
+        help="at runtime, also keep the measured memory (RSS or "
+        "tracemalloc) under max-mem, reading smaller pieces of the read "
+        "blocks when needed.",
+    )
+    parser.add_argument(
+        "--plan-cache",
+        action="store",
+        default=os.getenv("KEEP_PLAN_CACHE"),
+        help="directory where repartitioning plans are cached, to skip "
+        "planning in later runs. Defaults to $KEEP_PLAN_CACHE. Plans are "
+        "not cached if not set.",
+    )
+    parser.add_argument(
+        "--max-open-files",
+        action="store",
+        type=int,
+        default=POOL_SIZE,
+        help="max number of block files kept open during repartitioning.",
+    )
     parser.add_argument(
         "method",
         action="store",
         help="repartitioning method to use",
-        choices=["baseline", "keep"],
+        choices=["baseline", "keep", "two-phase"],
     )
 
     args, params = parser.parse_known_args(args)
     mem = args.max_mem
     if mem is not None:
         mem = int(mem)
+    budget = mem if args.enforce_measured_mem else None
+    mem = calibrate(mem, args.mem_overhead)
+
+    repart_func = {
+        "baseline": keep.baseline,
+        "keep": keep.keep,
+        "two-phase": keep.two_phase,
+    }
+    if args.plan_cache is not None:
+        repart_func = {
+            method: cached(repart_func[method], method, args.plan_cache)
+            for method in repart_func
+        }
 
-    repart_func = {"baseline": keep.baseline, "keep": keep.keep}
+    array = Partition(make_tuple(args.A), name="array", dtype=args.dtype)
+    backend = get_backend(args.backend)
+    if args.object_store is not None:
+        credentials = None
+        if os.getenv("AWS_ACCESS_KEY_ID") and os.getenv(
+            "AWS_SECRET_ACCESS_KEY"
+        ):
+            credentials = (
+                os.getenv("AWS_ACCESS_KEY_ID"),
+                os.getenv("AWS_SECRET_ACCESS_KEY"),
+            )
+        backend = ObjectStoreBackend(
+            args.object_store,
+            credentials=credentials,
+            region=os.getenv("AWS_REGION", "us-east-1"),
+        )
 
-    array = Partition(make_tuple(args.A), name="array")
+    in_blocks = Partition(
+        make_tuple(args.I),
+        name="in",
+        array=array,
+        sieve=args.sieve,
+        layout=args.in_layout,
+        codec=args.in_codec,
+        order=get_order(args.in_order),
+        threads=args.jobs,
+        backend=backend,
+        dirs=args.in_dirs.split(",") if args.in_dirs else None,
+        stripe=args.stripe,
+    )
 
     if args.create:
-        fill = "random"
         log("Creating input blocks", 1)
+        seed = generate(in_blocks, args.fill, args.seed, args.jobs)
+        log(f"Input blocks created with seed {seed}", 1)
     else:
-        fill = None
         log("Using existing input blocks", 1)
 
-    in_blocks = Partition(
-        make_tuple(args.I), name="in", array=array, fill=fill
-    )
-
-    in_blocks.clear()
-
     if not args.create:
-        out_blocks = Partition(make_tuple(args.O), name="out", array=array)
+        outputs = [
+            Partition(
+                make_tuple(shape),
+                name=f"out{i or ''}",
+                array=array,
+                layout=args.out_layout,
+                codec=args.out_codec,
+                order=get_order(args.out_order),
+                halo=args.halo,
+                threads=args.jobs,
+                backend=backend,
+                dirs=args.out_dirs.split(",") if args.out_dirs else None,
+                stripe=args.stripe,
+            )
+            for i, shape in enumerate([args.O] + args.fan_out)
+        ]
+        out_blocks = outputs[0]
+        pyramid = None
+        if args.pyramid > 0:
+            pyramid = Pyramid(out_blocks, args.pyramid)
+        journal_name = f"{out_blocks.name}_journal.txt"
 
         # Repartitioning
         if args.repartition:
             log("Repartitioning input blocks into output blocks", 1)
-            out_blocks.delete()
+            journal = Journal(journal_name, resume=args.resume)
+            if not args.resume:
+                for o in outputs:
+                    o.delete()
+                if pyramid is not None:
+                    pyramid.delete()
             out_blocks.clear()  # shouldn't be necessary but just in case
+            tracker = MemoryTracker(trace=args.trace_mem, budget=budget)
+            checksum = None
+            if args.inline_checksum:
+                checksum = InlineChecksum(
+                    array.shape, array.itemsize, len(outputs)
+                )
+            get_read_blocks_and_cache = repart_func[args.method]
+            if len(outputs) > 1:
+                # fan-out plans aren't cached, nor journaled
+                assert args.method == "keep", "--fan-out requires keep"
+                assert not args.resume, "Cannot resume with --fan-out"
+                get_read_blocks_and_cache = keep.fan_out
+                journal = None
+            if not backend.durable_flush:
+                # writes are buffered until the files are closed
+                assert not args.resume, f"Cannot resume with {backend}"
+                journal = None
+            if pyramid is not None:
+                assert not args.resume, "Cannot resume with --pyramid"
             start = time.time()
             (
                 total_bytes,
@@ -99,35 +389,60 @@ def main(args=None):
                 read_time,
                 write_time,
             ) = in_blocks.repartition(
-                out_blocks, mem, repart_func[args.method]
+                outputs if len(outputs) > 1 else out_blocks,
+                mem,
+                get_read_blocks_and_cache,
+                tracker=tracker,
+                journal=journal,
+                checksum=checksum,
+                max_open_files=args.max_open_files,
+                pyramid=pyramid,
             )
             end = time.time()
             total_time = end - start
-            assert total_time > read_time + write_time
-            assert total_bytes == 2 * math.prod(array.shape)
+            assert total_time >= read_time + write_time
+            log(f"Storage: {backend}", 1)
+            resumed = journal is not None and journal.resumed
+            # input is read once, and written to each output block, halos
+            # included, and to the pyramid levels
+            assert resumed or total_bytes == (
+                math.prod(array.shape) * array.itemsize
+                + sum(b.nbytes for o in outputs for b in o.blocks.values())
+                + (pyramid.total_bytes if pyramid is not None else 0)
+            )
+            # repartitioning is complete, nothing to resume
+            if journal is not None:
+                journal.delete()
+            if checksum is not None and not resumed:
+                # a resumed repartitioning doesn't write all the data read
+                assert checksum.diff() == [], (
+                    f"Data read and written differ in planes "
+                    f"{checksum.diff()}"
+                )
             log(
                 f"Seeks, peak memory (B), read time (s),"
-                f" write time (s), elapsed time (s):"
+                f" write time (s), elapsed time (s),"
+                f" peak measured memory (B), memory overhead factor:"
                 + os.linesep
                 + f"{seeks},{peak_mem},{round(read_time,2)},"
-                f"{round(write_time,2)},{round(total_time,2)}",
+                f"{round(write_time,2)},{round(total_time,2)},"
+                f"{tracker.peak_measured},{tracker.overhead()}",
                 2,
             )
 
         if args.test_data:
             log("Testing data", 1)
-            in_blocks.repartition(array, mem, repart_func[args.method])
-            with open(array.blocks[(0, 0, 0)].file_name, "rb") as f:
-                in_data = f.read()
-            array.delete()
-            out_blocks.repartition(array, mem, repart_func[args.method])
-            with open(array.blocks[(0, 0, 0)].file_name, "rb") as f:
-                out_data = f.read()
-            assert in_data == out_data
+            for o in outputs:
+                planes = verify(in_blocks, o, args.jobs)
+                assert planes == [], f"Data differs in planes {planes}"
 
         if args.delete:
             log("Deleting output blocks", 1)
-            out_blocks.delete()
+            for o in outputs:
+                o.delete()
+            if pyramid is not None:
+                pyramid.delete()
+            Journal(journal_name).delete()
 
 
 if __name__ == "__main__":
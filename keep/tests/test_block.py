@@ -2,7 +2,8 @@ import glob
 import math
 import os
 import pytest
-from keep.block import Block
+from keep.block import Block, coalesce
+from keep.files import FilePool, open_block_file
 
 
 @pytest.fixture
@@ -191,3 +192,117 @@ def test_write_to_read_from(cleanup_blocks):
     assert(b.data.get() == original_data)
     for fn in (c.file_name, d.file_name):
         os.remove(fn)
+
+
+def test_read_from_partial(cleanup_blocks):
+    # self covers a region inside block that doesn't start at its origin
+    b = Block((0, 0, 0), (4, 4, 4), fill='random', file_name='test.bin')
+    c = Block((2, 1, 1), (1, 2, 3))
+    by, seeks, _ = c.read_from(b)
+    assert((by, seeks) == (6, 2))
+    b.read()
+    assert(c.data.get() == b.get_data_block(c).data.get())
+
+
+def test_coalesce():
+    offsets = (0, 3, 6, 7, 20, 29)
+    assert(coalesce(offsets) == offsets)
+    assert(coalesce((0, 3, 4, 7)) == (0, 7))
+    assert(coalesce(offsets, 2) == (0, 7, 20, 29))
+    assert(coalesce(offsets, 12) == (0, 29))
+
+
+def test_read_from_sieve(cleanup_blocks):
+    b = Block((0, 0, 0), (4, 5, 6), fill='random', file_name='test.bin')
+    for sieve, expected_seeks in ((0, 8), (3, 2), (20, 1)):
+        c = Block((1, 1, 2), (2, 4, 3))
+        by, seeks, _ = c.read_from(b, sieve)
+        assert((by, seeks) == (24, expected_seeks))
+        b.read()
+        assert(c.data.get() == b.get_data_block(c).data.get())
+        b.clear()
+
+
+def test_write_to_full_cover(cleanup_blocks):
+    b = Block((0, 0, 0), (4, 5, 6), fill='random', file_name='test.bin')
+    b.read()
+    c = Block((1, 1, 2), (2, 4, 3), file_name='block1.bin')
+    # stale content is overwritten
+    with open(c.file_name, 'wb') as f:
+        f.write(bytearray(100))
+    assert(b.contains(c) and not c.contains(b))
+    by, seeks, _ = b.write_to(c)
+    assert((by, seeks) == (24, 1))
+    c.read()
+    assert(c.data.get() == b.get_data_block(c).data.get())
+
+
+def test_file_pool(cleanup_blocks):
+    files = FilePool(2)
+    for name in ('a.bin', 'b.bin', 'c.bin'):
+        with open_block_file(name, 'r+b', files) as f:
+            f.write(b'12345')
+    # a.bin was evicted
+    assert(list(files.files) == ['b.bin', 'c.bin'] and files.opens == 3)
+    with open_block_file('b.bin', 'wb', files) as f:
+        f.write(b'67')
+    with open_block_file('b.bin', 'rb', files) as f:
+        f.seek(0)
+        assert(f.read() == b'67')
+    assert(files.opens == 3)
+    files.close()
+    assert(files.files == {})
+    b = Block((0, 0, 0), (4, 5, 6), fill='random', file_name='test.bin')
+    c = Block((1, 1, 2), (2, 4, 3), file_name='block1.bin')
+    files = FilePool(1)
+    b.read()
+    b.write_to(c, files)
+    c.read_from(b, files=files)
+    files.close()
+    c.read()
+    assert(c.data.get() == b.get_data_block(c).data.get())
+
+
+def test_block_itemsize():
+    # int16 elements: offsets and segments are in bytes
+    c = Block((0, 0, 0), (4, 4, 4), itemsize=2)
+    d = Block((1, 2, 2), (4, 4, 4), itemsize=2)
+    assert(c.nbytes == 128)
+    assert(c.offset((1, 2, 3)) == 2 * (16 + 8 + 3))
+    assert(c.point_from_offset(54) == (1, 2, 3))
+    assert(c.block_offsets(d)[2][:4] == (52, 55, 60, 63))
+
+    c = Block((0, 0, 0), (2, 2, 2), data=bytearray(range(16)), itemsize=2)
+    b = c.get_data_block(Block((0, 1, 1), (2, 1, 1), itemsize=2))
+    assert(b.data.get() == bytes([6, 7, 14, 15]))
+
+
+def test_block_order(cleanup_blocks):
+    # Fortran order: axis 0 is contiguous
+    c = Block((0, 0, 0), (2, 3, 4), order=(2, 1, 0))
+    assert(c.offset((1, 2, 3)) == 1 + 2 * (2 + 3 * 3))
+    assert(c.point_from_offset(23) == (1, 2, 3))
+    # segments are contiguous along axis 0 and then 1
+    d = Block((0, 0, 1), (2, 3, 2))
+    assert(c.block_offsets(d)[2] == (6, 17))
+
+    data = bytearray(range(24))
+    b = Block((0, 0, 0), (2, 3, 4), data=data)
+    f = b.transpose((2, 1, 0))
+    assert(f.order == (2, 1, 0))
+    assert(f.data.get()[:4] == bytes([0, 12, 4, 16]))
+    assert(f.transpose().data.get() == data)
+    assert(b.transpose() is b)
+    wide = Block((0, 0), (2, 3), data=bytearray(range(18)), itemsize=3)
+    assert(wide.transpose((1, 0)).data.get()[:9] ==
+           bytes([0, 1, 2, 9, 10, 11, 3, 4, 5]))
+
+    # data is transposed when it is written and read
+    c = Block((0, 0, 0), (2, 3, 4), file_name='order_block.bin',
+              order=(1, 2, 0))
+    b.write_to(c)
+    with open('order_block.bin', 'rb') as f:
+        assert(f.read() == b.transpose((1, 2, 0)).data.get())
+    r = Block((1, 1, 0), (1, 2, 4))
+    r.read_from(c)
+    assert(r.data.get() == b.get_data_block(r).data.get())
@@ -1,7 +1,17 @@
+import glob
+import math
 import os
 import pytest
 from keep import keep
 from keep.partition import Partition
+from keep.plan import cached, get_plan, load_plan
+
+
+@pytest.fixture
+def cleanup_blocks():
+    yield
+    for f in glob.glob('*.bin'):
+        os.remove(f)
 
 
 def test_seek_model():
@@ -51,6 +61,31 @@ def test_get_f_blocks_1():
             'None', 'None', 'None', 'None', 'None', 'None', 'None'])
 
 
+def test_get_f_blocks_4d():
+    array = Partition((6, 12, 12, 12), name='array')
+    in_blocks = Partition((2, 4, 4, 4), name='in', array=array)
+    out_blocks = Partition((3, 3, 3, 3), name='out', array=array)
+
+    fblocks = keep.get_F_blocks(in_blocks.blocks[(2, 0, 0, 0)], out_blocks)
+
+    # 2^4 F blocks, F8 and above are after F0 along dimension 0
+    assert(len(fblocks) == 16)
+    assert([(b.origin, b.shape) for b in fblocks if b is not None] ==
+           [((2, 0, 0, 0), (1, 3, 3, 3)), ((2, 0, 0, 3), (1, 3, 3, 1)),
+            ((2, 0, 3, 0), (1, 3, 1, 3)), ((2, 0, 3, 3), (1, 3, 1, 1)),
+            ((2, 3, 0, 0), (1, 1, 3, 3)), ((2, 3, 0, 3), (1, 1, 3, 1)),
+            ((2, 3, 3, 0), (1, 1, 1, 3)), ((2, 3, 3, 3), (1, 1, 1, 1)),
+            ((3, 0, 0, 0), (1, 3, 3, 3)), ((3, 0, 0, 3), (1, 3, 3, 1)),
+            ((3, 0, 3, 0), (1, 3, 1, 3)), ((3, 0, 3, 3), (1, 3, 1, 1)),
+            ((3, 3, 0, 0), (1, 1, 3, 3)), ((3, 3, 0, 3), (1, 1, 3, 1)),
+            ((3, 3, 3, 0), (1, 1, 1, 3)), ((3, 3, 3, 3), (1, 1, 1, 1))])
+    read_blocks = Partition((2, 4, 4, 4), name='read', array=array)
+    # F15 goes to the neighbor along all dimensions
+    i = list(read_blocks.blocks).index((2, 0, 0, 0))
+    j = list(read_blocks.blocks).index((4, 4, 4, 4))
+    assert(keep.destination_F0(read_blocks, i, 15) == j)
+
+
 def test_r_hat():
     array = Partition((3500, 3500, 3500), name='array')
     in_blocks = Partition((875, 875, 875), array=array, name='in')
@@ -73,8 +108,11 @@ def test_r_hat_2():
     array = Partition((10, 10, 10), name='array')
     in_blocks = Partition((2, 2, 2), array=array, name='in')
     out_blocks = Partition((5, 5, 5), array=array, name='out')
-    with pytest.raises(Exception):
-        r_hat = keep.get_r_hat(in_blocks, out_blocks)
+    # r hat doesn't divide the array: read blocks at the edges are ragged
+    r_hat = keep.get_r_hat(in_blocks, out_blocks)
+    assert(r_hat == (6, 6, 6))
+    read_blocks = Partition(r_hat, name='read', array=array)
+    assert(read_blocks.blocks[(6, 0, 6)].shape == (4, 6, 4))
 
 
 def test_divisors():
@@ -82,15 +120,33 @@ def test_divisors():
     assert(sorted(keep.divisors(42)) == [1, 2, 3, 6, 7, 14, 21, 42])
 
 
-# def test_find_shape_with_constraint():
-#     array = Partition((100, 100, 100), name='array', fill='random')
-#     in_blocks = Partition((10, 10, 10), name='out', array=array)
-#     out_blocks = Partition((50, 50, 50), name='out', array=array)
-#     shape, mc = keep.find_shape_with_constraint(in_blocks, out_blocks, None)
-#     assert((shape, mc) == ((50, 50, 50), 125000))
+def test_find_shape_with_constraint():
+    array = Partition((100, 100, 100), name='array')
+    in_blocks = Partition((10, 10, 10), name='in', array=array)
+    out_blocks = Partition((50, 50, 50), name='out', array=array)
+    shape, mc = keep.find_shape_with_constraint(in_blocks, out_blocks, None)
+    assert((shape, mc) == ((50, 50, 50), -1))
+
+    shape, mc = keep.find_shape_with_constraint(in_blocks, out_blocks,
+                                                125000)
+    assert((shape, mc) == ((50, 50, 50), 125000))
 
-#     shape, mc = keep.find_shape_with_constraint(in_blocks, out_blocks, 3000)
-#     assert((shape, mc) == ((1, 50, 50), 2500))
+    shape, mc = keep.find_shape_with_constraint(in_blocks, out_blocks, 30000)
+    assert((shape, mc) == ((10, 50, 50), 25000))
+
+    with pytest.raises(Exception):
+        keep.find_shape_with_constraint(in_blocks, out_blocks, 1000)
+
+
+def test_peak_memory(cleanup_blocks):
+    array = Partition((12, 12, 12), name='array')
+    in_blocks = Partition((4, 4, 4), name='in', array=array, fill='random')
+    out_blocks = Partition((3, 3, 3), name='out', array=array)
+    mc = keep.peak_memory((4, 4, 4), in_blocks, out_blocks)
+    assert(0 < mc < math.prod(array.shape))
+    # estimate is also checked by repartition
+    _, _, peak_mem, _, _ = in_blocks.repartition(out_blocks, mc, keep.keep)
+    assert(peak_mem == mc)
 
 
 def test_partition_to_end_coords():
@@ -122,3 +178,62 @@ def test_partition_to_end_coords():
 #                 out_blocks = Partition(d, name='out', array=array)
 #                 # raises an exception if seek count doesnt match real
 #                 in_blocks.repartition(out_blocks, None, keep.baseline)
+
+
+def test_plan_cache(cleanup_blocks, tmp_path):
+    array = Partition((12, 12, 12), name='array')
+    in_blocks = Partition((4, 4, 4), name='in', array=array, fill='random')
+    out_blocks = Partition((3, 3, 3), name='out', array=array)
+
+    for method in (keep.keep, keep.baseline, keep.two_phase):
+        get_read_blocks_and_cache = cached(method, method.__name__, tmp_path)
+        r, c, seeks, peak_mem = get_read_blocks_and_cache(in_blocks,
+                                                          out_blocks, 1000,
+                                                          array)
+        assert(len(list(tmp_path.glob('plan_*.json'))) == 1)
+        # second call loads the plan
+        plan = load_plan(next(tmp_path.glob('plan_*.json')))
+        assert(plan.read_shape == r.shape)
+        assert((plan.seeks, plan.peak_mem) == (seeks, peak_mem))
+        (r_1, c_1, seeks_1,
+         peak_mem_1) = get_read_blocks_and_cache(in_blocks, out_blocks, 1000,
+                                                 array)
+        assert(r_1.shape == r.shape)
+        assert((seeks_1, peak_mem_1) == (seeks, peak_mem))
+        assert(type(c_1) is type(c))
+        in_blocks.repartition(out_blocks, 1000, get_read_blocks_and_cache)
+        for f in tmp_path.glob('plan_*.json'):
+            os.remove(f)
+
+    # write blocks and match table survive the round trip
+    r, cache, seeks, peak_mem = keep.keep(in_blocks, out_blocks, None, array)
+    plan = get_plan('key', r, cache, seeks, peak_mem)
+    _, plan_cache, _, _ = plan.get_read_blocks_and_cache(in_blocks,
+                                                         out_blocks, None,
+                                                         array)
+    assert({(k, v.origin, v.shape) for k, v in cache.match.items()} ==
+           {(k, v.origin, v.shape) for k, v in plan_cache.match.items()})
+
+
+def test_seek_model_sieve(cleanup_blocks):
+    array = Partition((12, 12, 12), name='array')
+    for sieve in (0, 1, 8, 30, 100, 1000):
+        in_blocks = Partition((6, 12, 12), name='in', array=array,
+                              fill='random', sieve=sieve)
+        for shape in ((12, 12, 4), (6, 4, 12), (4, 3, 6), (4, 6, 3)):
+            memory_blocks = Partition(shape, name='memory', array=array)
+            seeks = sum(in_blocks.read_block(b)[1]
+                        for b in memory_blocks.blocks.values())
+            assert(seeks == keep.seek_count(memory_blocks, in_blocks, sieve))
+
+
+def test_seek_model_4d(cleanup_blocks):
+    array = Partition((4, 6, 8, 10), name='array')
+    for sieve in (0, 8, 100):
+        in_blocks = Partition((2, 6, 8, 10), name='in', array=array,
+                              fill='random', sieve=sieve)
+        for shape in ((4, 6, 8, 5), (2, 3, 8, 10), (1, 2, 4, 5)):
+            memory_blocks = Partition(shape, name='memory', array=array)
+            seeks = sum(in_blocks.read_block(b)[1]
+                        for b in memory_blocks.blocks.values())
+            assert(seeks == keep.seek_count(memory_blocks, in_blocks, sieve))
@@ -1,8 +1,26 @@
 import glob
+import math
 import os
 import pytest
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from keep import keep
+from keep.backend import MemoryBackend, SimulatedBackend
+from keep.block import Block
+from keep.blockcache import BlockCache
+from keep.checksum import (MODULUS, InlineChecksum, partition_checksum,
+                           verify)
+from keep.container import read_index
+from keep.dtype import get_dtype
+from keep.files import FilePool, IOQueues
+from keep.generate import generate
+from keep.journal import Journal
+from keep.memory import MemoryTracker, calibrate
+from keep.objectstore import ObjectStoreBackend, ObjectStoreServer
 from keep.partition import Partition
+from keep.pyramid import Pyramid, downsample
+from keep.transform import Transform
 
 
 @pytest.fixture
@@ -133,6 +151,82 @@ def test_repartition_keep_2(cleanup_blocks):
     assert(rein_data == in_data)
 
 
+def test_repartition_4d(cleanup_blocks):
+    # a time series of 4 volumes, repartitioned in a single pass
+    array = Partition((4, 6, 8, 10), name='array')
+    in_blocks = Partition((2, 3, 4, 5), name='in', array=array,
+                          fill='random')
+    expected = partition_checksum(in_blocks)
+    out_blocks = Partition((4, 2, 8, 2), name='out', array=array)
+    for method, m in ((keep.baseline, None), (keep.keep, None),
+                      (keep.keep, 800), (keep.two_phase, None)):
+        # repartition also checks the seek and memory estimates
+        in_blocks.repartition(out_blocks, m, method)
+        assert(partition_checksum(out_blocks) == expected)
+        out_blocks.delete()
+
+    # F blocks after F0 along dimension 0 go to the next volumes
+    volumes = Partition((12, 4, 4, 10), name='volumes')
+    in_volumes = Partition((2, 2, 2, 5), name='in_volumes', array=volumes,
+                           fill='random')
+    out_volumes = Partition((3, 4, 2, 5), name='out_volumes', array=volumes)
+    in_volumes.repartition(out_volumes, None, keep.keep)
+    assert(partition_checksum(out_volumes) == partition_checksum(in_volumes))
+
+    rein_blocks = Partition((2, 3, 4, 5), name='rein', array=array)
+    in_blocks.repartition(out_blocks, None, keep.keep)
+    out_blocks.repartition(rein_blocks, None, keep.baseline)
+    for origin in in_blocks.blocks:
+        in_blocks.blocks[origin].read()
+        rein_blocks.blocks[origin].read()
+        assert(in_blocks.blocks[origin].data.get() ==
+               rein_blocks.blocks[origin].data.get())
+
+
+def test_repartition_dtype(cleanup_blocks):
+    assert(get_dtype('int16').itemsize == 2)
+    assert(get_dtype('>f4').name == '>f4')
+    assert(get_dtype('uint8').name == '|u1')
+    assert(len({get_dtype('int16'), get_dtype('<i2'), get_dtype('i2')}) == 1)
+    array = Partition((12, 8, 10), name='array', dtype='int16')
+    in_blocks = Partition((2, 4, 5), name='in', array=array, fill='random')
+    assert(in_blocks.itemsize == 2)
+    assert(os.path.getsize(in_blocks.blocks[(0, 0, 0)].file_name) == 80)
+    expected = partition_checksum(in_blocks)
+    out_blocks = Partition((3, 8, 2), name='out', array=array)
+    for method, m in ((keep.baseline, None), (keep.keep, 640),
+                      (keep.two_phase, 480)):
+        # repartition also checks the seek and memory estimates, in bytes
+        _, _, peak_mem, _, _ = in_blocks.repartition(out_blocks, m, method)
+        assert(m is None or peak_mem == m)
+        assert(partition_checksum(out_blocks) == expected)
+        out_blocks.delete()
+    with pytest.raises(AssertionError):
+        Partition((3, 8, 2), name='out', array=array, dtype='int32')
+
+
+def test_repartition_ragged(cleanup_blocks):
+    # array dimensions aren't multiples of the block shapes
+    array = Partition((13, 7, 11), name='array')
+    in_blocks = Partition((4, 3, 5), name='in', array=array, fill='random')
+    assert(in_blocks.blocks[(12, 6, 10)].shape == (1, 1, 1))
+    assert(sum(b.nbytes for b in in_blocks.blocks.values()) == 13 * 7 * 11)
+    expected = partition_checksum(in_blocks)
+    for shape in ((5, 5, 5), (2, 7, 11)):
+        out_blocks = Partition(shape, name='out', array=array)
+        for method, m in ((keep.baseline, None), (keep.keep, None),
+                          (keep.keep, 500), (keep.two_phase, None)):
+            # repartition also checks the seek and memory estimates
+            in_blocks.repartition(out_blocks, m, method)
+            assert(partition_checksum(out_blocks) == expected)
+            out_blocks.delete()
+
+    container = Partition((5, 5, 5), name='container', array=array,
+                          layout='container')
+    in_blocks.repartition(container, None, keep.keep)
+    assert(partition_checksum(container) == expected)
+
+
 def test_repartition_baseline_3(cleanup_blocks):
     array = Partition((12, 12, 12), name='array', fill='random')
     in_blocks = Partition((4, 4, 4), name='in', array=array)
@@ -184,6 +278,724 @@ def test_repartition_keep_3(cleanup_blocks):
     assert(rein_data == array_data)
 
 
+def test_repartition_two_phase(cleanup_blocks):
+    array = Partition((12, 8, 10), name='array')
+    in_blocks = Partition((2, 4, 5), name='in', array=array, fill='random')
+    out_blocks = Partition((3, 8, 2), name='out', array=array)
+    expected = partition_checksum(in_blocks)
+    # read blocks are slabs of complete planes
+    for m, r0 in ((None, 12), (1000, 12), (400, 3)):
+        r, _, _, _ = keep.two_phase(in_blocks, out_blocks, m, array)
+        assert(r.shape == (r0, 8, 10))
+        _, _, peak_mem, _, _ = in_blocks.repartition(out_blocks, m,
+                                                     keep.two_phase)
+        assert(m is None or peak_mem <= m)
+        assert(partition_checksum(out_blocks) == expected)
+    # a row of output blocks has to fit in memory
+    with pytest.raises(AssertionError):
+        keep.two_phase(in_blocks, out_blocks, 200, array)
+
+
+def test_repartition_fan_out(cleanup_blocks):
+    array = Partition((12, 12, 12), name='array')
+    in_blocks = Partition((4, 4, 4), name='in', array=array, fill='random')
+    expected = partition_checksum(in_blocks)
+    slices = Partition((1, 12, 12), name='slices', array=array)
+    cubes = Partition((3, 3, 3), name='cubes', array=array)
+    seeks = [in_blocks.repartition(o, None, keep.keep)[1]
+             for o in (slices, cubes)]
+    for m in (None, 1000):
+        checksum = InlineChecksum(array.shape, outputs=2)
+        # repartition also checks the seek and memory estimates
+        total_bytes, fan_out_seeks, peak_mem, _, _ = in_blocks.repartition(
+            [slices, cubes], m, keep.fan_out, checksum=checksum)
+        assert(total_bytes == 3 * math.prod(array.shape))
+        assert(m is None or peak_mem <= m)
+        assert(checksum.diff() == [])
+        assert(partition_checksum(slices) == expected)
+        assert(partition_checksum(cubes) == expected)
+    # input blocks are read once
+    _, _, fan_out_seeks, _ = keep.fan_out(in_blocks, [slices, cubes], None,
+                                          array)
+    assert(fan_out_seeks < sum(seeks))
+    with pytest.raises(Exception):
+        in_blocks.repartition([slices, cubes], None, keep.two_phase)
+
+
+def test_repartition_pyramid(cleanup_blocks):
+    for shape, dtype in (((12, 12, 12), None), ((13, 7, 11), 'int16')):
+        array = Partition(shape, name='array', dtype=dtype)
+        in_blocks = Partition((4, 3, 5), name='in', array=array,
+                              fill='random')
+        whole = Block((0, 0, 0), shape, itemsize=array.itemsize)
+        in_blocks.read_block(whole)
+        out_blocks = Partition((5, 5, 5), name='out', array=array)
+        for method in (keep.baseline, keep.keep):
+            t, s, peak_mem, _, _ = in_blocks.repartition(out_blocks, None,
+                                                         method)
+            out_blocks.delete()
+            pyramid = Pyramid(out_blocks, 3)
+            # levels count in memory and in the writes
+            total_bytes, seeks, pyramid_mem, _, _ = in_blocks.repartition(
+                out_blocks, None, method, pyramid=pyramid)
+            assert(pyramid.total_bytes == sum(b.nbytes
+                                              for level in pyramid.levels
+                                              for b in level.blocks.values()))
+            assert(total_bytes == t + pyramid.total_bytes)
+            assert(seeks == s + pyramid.seeks)
+            assert(pyramid_mem > peak_mem)
+            assert(pyramid.complete())
+            expected = whole
+            for level in pyramid.levels:
+                expected = downsample(expected)
+                assert(expected.shape == level.array.shape)
+                block = Block((0, 0, 0), expected.shape,
+                              itemsize=array.itemsize)
+                level.read_block(block)
+                assert(block.data.get() == expected.data.get())
+            pyramid.delete()
+            out_blocks.delete()
+
+
+def test_repartition_transform(cleanup_blocks):
+    array = Partition((12, 10, 11), name='array')
+    in_blocks = Partition((4, 5, 11), name='in', array=array, fill='random')
+    whole = Block((0, 0, 0), array.shape)
+    in_blocks.read_block(whole)
+    data = whole.data.get()
+
+    def invert(data, block):
+        data[:] = data.translate(bytes(range(255, -1, -1)))
+
+    def widen(data, block):
+        # uint8 to little-endian uint16
+        wide = bytearray(2 * len(data))
+        wide[::2] = data
+        return wide
+
+    inverted = bytes(255 - x for x in data)
+    widened = bytearray(2 * len(data))
+    widened[::2] = data
+    wide_array = Partition(array.shape, name='wide_array', dtype='<u2')
+    for transform, expected in ((Transform(invert), inverted),
+                                (Transform(invert, stage='write'), inverted),
+                                (Transform(widen, '<u2'), widened)):
+        out_array = array if transform.dtype is None else wide_array
+        out_blocks = Partition((3, 3, 3), name='out', array=out_array)
+        for method, m in ((keep.baseline, None), (keep.keep, None),
+                          (keep.keep, 2000), (keep.two_phase, None)):
+            checksum = InlineChecksum(array.shape, out_blocks.itemsize)
+            # repartition also checks the memory estimates, computed with
+            # the transformed elements
+            in_blocks.repartition(out_blocks, m, method, checksum=checksum,
+                                  transform=transform)
+            assert(checksum.diff() == [])
+            block = Block((0, 0, 0), array.shape,
+                          itemsize=out_blocks.itemsize)
+            out_blocks.read_block(block)
+            assert(block.data.get() == expected)
+            out_blocks.delete()
+
+    # read blocks of 220B fit in 300B, but not once widened: they are split
+    out_blocks = Partition((3, 3, 3), name='out', array=wide_array)
+    _, _, peak_mem, _, _ = in_blocks.repartition(
+        out_blocks, 300, keep.baseline, transform=Transform(widen, '<u2'))
+    assert(peak_mem <= 300)
+    block = Block((0, 0, 0), array.shape, itemsize=2)
+    out_blocks.read_block(block)
+    assert(block.data.get() == widened)
+
+    with pytest.raises(AssertionError):
+        # output partitions must have the type of the transformed elements
+        in_blocks.repartition(out_blocks, None, keep.keep,
+                              transform=Transform(invert))
+    with pytest.raises(AssertionError):
+        in_blocks.repartition(out_blocks, None, keep.keep,
+                              transform=Transform(widen, '<u2', 'write'))
+
+
+def test_repartition_order(cleanup_blocks):
+    array = Partition((12, 10, 11), name='array', dtype='int16')
+    in_blocks = Partition((4, 5, 11), name='in', array=array, fill='random')
+    expected = partition_checksum(in_blocks)
+    whole = Block((0, 0, 0), array.shape, itemsize=2)
+    in_blocks.read_block(whole)
+    for order in ('F', (1, 2, 0)):
+        for kwargs in ({}, {'layout': 'container'}, {'codec': 'zlib'}):
+            out_blocks = Partition((3, 5, 4), name='out', array=array,
+                                   order=order, **kwargs)
+            for method, m in ((keep.baseline, None), (keep.keep, None),
+                              (keep.keep, 4000), (keep.two_phase, None)):
+                # repartition also checks the seek model, in the axis
+                # order of out_blocks
+                in_blocks.repartition(out_blocks, m, method)
+                assert(partition_checksum(out_blocks) == expected)
+                block = out_blocks.blocks[(3, 5, 4)]
+                block.read()
+                assert(block.order == out_blocks.order)
+                assert(block.transpose().data.get() ==
+                       whole.get_data_block(block).data.get())
+                block.clear()
+                out_blocks.delete()
+
+    # ordered partitions are also read in C order, with data sieving
+    f_blocks = Partition((4, 5, 11), name='f_in', array=array, order='F',
+                         sieve=100)
+    in_blocks.repartition(f_blocks, None, keep.keep)
+    out_blocks = Partition((3, 5, 4), name='out', array=array)
+    f_blocks.repartition(out_blocks, None, keep.keep)
+    assert(partition_checksum(out_blocks) == expected)
+
+
+def test_repartition_halo(cleanup_blocks):
+    array = Partition((12, 10, 11), name='array', dtype='int16')
+    in_blocks = Partition((4, 5, 11), name='in', array=array, fill='random')
+    expected = partition_checksum(in_blocks)
+    whole = Block((0, 0, 0), array.shape, itemsize=2)
+    in_blocks.read_block(whole)
+
+    halos = Partition((5, 5, 4), name='halos', array=array, halo=2)
+    assert(halos.blocks[(5, 5, 4)].origin == (3, 3, 2))
+    assert(halos.blocks[(5, 5, 4)].shape == (9, 7, 8))
+    assert(halos.blocks[(10, 0, 8)].shape == (4, 7, 5))
+    for kwargs in ({}, {'layout': 'container'}, {'codec': 'zlib'},
+                   {'order': 'F'}):
+        out_blocks = Partition((5, 5, 4), name='out', array=array, halo=2,
+                               **kwargs)
+        for method, m in ((keep.baseline, None), (keep.keep, None),
+                          (keep.keep, 4000)):
+            # repartition also checks the seek model, halos included
+            in_blocks.repartition(out_blocks, m, method)
+            # checksums ignore the halos
+            assert(partition_checksum(out_blocks) == expected)
+            for b in out_blocks.blocks.values():
+                b.read()
+                assert(b.transpose().data.get() ==
+                       whole.get_data_block(b).data.get())
+                b.clear()
+            out_blocks.delete()
+    with pytest.raises(AssertionError):
+        in_blocks.repartition(out_blocks, None, keep.two_phase)
+    with pytest.raises(AssertionError):
+        out_blocks.repartition(in_blocks, None, keep.keep)
+
+    # halos of several outputs in one pass
+    cubes = Partition((3, 3, 3), name='cubes', array=array, halo=1)
+    in_blocks.repartition([out_blocks, cubes], None, keep.fan_out)
+    for o in (out_blocks, cubes):
+        assert(partition_checksum(o) == expected)
+        for b in o.blocks.values():
+            b.read()
+            assert(b.transpose().data.get() ==
+                   whole.get_data_block(b).data.get())
+            b.clear()
+
+
+def test_read_region_block(cleanup_blocks):
+    array = Partition((12, 10, 11), name='array', dtype='int16')
+    in_blocks = Partition((4, 5, 11), name='in', array=array, fill='random')
+    whole = Block((0, 0, 0), array.shape, itemsize=2)
+    in_blocks.read_block(whole)
+    assert(in_blocks.overlapping((3, 5, 2), (2, 1, 1)) ==
+           [(0, 5, 0), (4, 5, 0)])
+    partitions = [in_blocks]
+    for name, kwargs in (('halo', {'halo': 2}), ('f', {'order': 'F'}),
+                         ('c', {'layout': 'container'}),
+                         ('z', {'codec': 'zlib'}), ('s', {'sieve': 1000})):
+        p = Partition((5, 3, 4), name=name, array=array, **kwargs)
+        in_blocks.repartition(p, None, keep.baseline)
+        partitions += [p]
+    for p in partitions:
+        for origin, shape in (((0, 0, 0), array.shape),
+                              ((3, 2, 1), (6, 7, 5)),
+                              ((11, 9, 10), (1, 1, 1))):
+            region = p.read_region_block(origin, shape)
+            assert(region.shape == shape)
+            assert(region.data.get() ==
+                   whole.get_data_block(region).data.get())
+        assert(p.read_region_block((2, 2, 2), (0, 3, 3)).data.get() == b'')
+    with pytest.raises(AssertionError):
+        in_blocks.read_region_block((10, 0, 0), (3, 1, 1))
+
+
+def test_read_region(cleanup_blocks):
+    numpy = pytest.importorskip('numpy')
+    array = Partition((12, 10, 11), name='array', dtype='>i2')
+    in_blocks = Partition((4, 5, 11), name='in', array=array, fill='random')
+    region = in_blocks.read_region((3, 2, 1), (6, 7, 5))
+    assert(region.shape == (6, 7, 5))
+    assert(region.dtype == numpy.dtype('>i2'))
+    assert(region.tobytes() ==
+           in_blocks.read_region_block((3, 2, 1), (6, 7, 5)).data.get())
+    whole = in_blocks.read_region((0, 0, 0), array.shape)
+    assert((whole[3:9, 2:9, 1:6] == region).all())
+
+
+def test_block_cache(cleanup_blocks):
+    array = Partition((12, 10, 11), name='array', dtype='int16')
+    in_blocks = Partition((4, 5, 11), name='in', array=array, fill='random')
+    whole = Block((0, 0, 0), array.shape, itemsize=2)
+    in_blocks.read_block(whole)
+    block_size = 4 * 5 * 11 * 2
+    cache = BlockCache(3 * block_size)
+    cached = Partition((4, 5, 11), name='in', array=array, block_cache=cache)
+    region = Block((2, 3, 0), (4, 5, 11), itemsize=2)
+    # the region overlaps 4 blocks, one is evicted
+    assert(cached.read_block(region)[1] == 4)
+    assert((cache.misses, cache.evictions) == (4, 1))
+    assert(region.data.get() == whole.get_data_block(region).data.get())
+    for _ in range(2):
+        block = cached.read_region_block((4, 3, 0), (2, 4, 11))
+        assert(block.data.get() == whole.get_data_block(block).data.get())
+    assert((cache.hits, cache.misses) == (4, 4))
+    assert(cache.nbytes == 3 * block_size)
+    assert(cache.hit_ratio() == 0.5)
+
+    # modified blocks are read again
+    modified = Block((4, 5, 0), (4, 5, 11), data=bytearray(block_size),
+                     itemsize=2)
+    in_blocks.write_block(modified)
+    block = cached.read_region_block((4, 4, 0), (1, 2, 11))
+    assert(cache.invalidations == 1)
+    # the second row of the region is in the modified block
+    assert(block.data.get()[22:] == bytes(22))
+
+    # cached partitions can be repartitioned, without the seek check
+    out_blocks = Partition((3, 3, 3), name='out', array=array)
+    cached.repartition(out_blocks, None, keep.keep)
+    assert(partition_checksum(out_blocks) == partition_checksum(in_blocks))
+
+    # compressed blocks are cached decompressed, in any backend
+    backend = MemoryBackend()
+    cache = BlockCache(10 ** 6)
+    z_blocks = Partition((3, 5, 4), name='z', array=array, codec='zlib',
+                         backend=backend, block_cache=cache)
+    in_blocks.repartition(z_blocks, None, keep.baseline)
+    for _ in range(2):
+        block = z_blocks.read_region_block((0, 0, 0), array.shape)
+        assert(block.data.get() == in_blocks.read_region_block(
+            (0, 0, 0), array.shape).data.get())
+    assert(cache.hits == cache.misses == len(z_blocks.blocks))
+    z_blocks.delete()
+    # blocks written by the partition are dropped from the cache
+    in_blocks.repartition(z_blocks, None, keep.baseline)
+    assert(cache.invalidations == len(z_blocks.blocks))
+    assert(cache.nbytes == 0)
+
+    # also when they are written through a file kept open by a pool
+    for backend in (None, MemoryBackend()):
+        cache = BlockCache(10 ** 6)
+        m_blocks = Partition((4, 5, 11), name='m', array=array,
+                             backend=backend, block_cache=cache)
+        in_blocks.repartition(m_blocks, None, keep.baseline)
+        origin = (4, 5, 0)
+        m_blocks.read_region_block(origin, (1, 1, 1))
+        files = FilePool()
+        for value in (1, 2):
+            m_blocks.write_block(Block(origin, (1, 1, 1),
+                                       data=bytearray([value, 0]),
+                                       itemsize=2), files)
+            block = m_blocks.read_region_block(origin, (1, 1, 1))
+            assert(block.data.get() == bytes([value, 0]))
+        assert(files.opens == 1)
+        assert(cache.invalidations == 2)
+        files.close()
+
+
 def test_partition_clear(cleanup_blocks):
     array = Partition((12, 12, 12), name='array', fill='random')
     array.clear()
+
+
+def test_repartition_memory_tracker(cleanup_blocks):
+    array = Partition((20, 20, 20), name='array', fill='random')
+    in_blocks = Partition((2, 2, 2), name='in', array=array)
+    array.repartition(in_blocks, None, keep.baseline)
+
+    out_blocks = Partition((10, 10, 10), name='out', array=array)
+    tracker = MemoryTracker(trace=True)
+    _, _, peak_mem, _, _ = in_blocks.repartition(out_blocks, 3000, keep.keep,
+                                                 tracker=tracker)
+    assert(peak_mem <= 3000)
+    assert(tracker.peak_logical == peak_mem)
+    assert(tracker.peak_measured > 0)
+    assert(tracker.overhead() == tracker.peak_measured / peak_mem)
+    # one sample after each cache insertion and after each write
+    assert(len(tracker.steps) == 2*8)
+
+    rein_blocks = Partition((20, 20, 20), name='rein', array=array)
+    out_blocks.repartition(rein_blocks, None, keep.keep)
+    rein_blocks.blocks[(0, 0, 0)].read()
+    array.blocks[(0, 0, 0)].read()
+    assert(rein_blocks.blocks[(0, 0, 0)].data.get() ==
+           array.blocks[(0, 0, 0)].data.get())
+
+
+def test_calibrate():
+    assert(calibrate(None, 2) is None)
+    assert(calibrate(1000, 2.5) == 400)
+
+
+def test_repartition_backpressure(cleanup_blocks):
+    array = Partition((12, 12, 12), name='array', fill='random')
+    in_blocks = Partition((12, 12, 12), name='in', array=array)
+    array.repartition(in_blocks, None, keep.baseline)
+
+    # baseline writes each slab as soon as it is read
+    out_blocks = Partition((3, 3, 3), name='out', array=array)
+    _, _, peak_mem, _, _ = in_blocks.repartition(out_blocks, 500,
+                                                 keep.baseline)
+    assert(peak_mem == 432)  # 3 planes of 144B
+
+    # keep plans without memory constraint, constraint enforced at runtime
+    def unconstrained_keep(in_blocks, out_blocks, m, array):
+        return keep.keep(in_blocks, out_blocks, None, array)
+
+    in_blocks = Partition((6, 6, 6), name='in', array=array)
+    array.repartition(in_blocks, None, keep.baseline)
+    out_blocks = Partition((4, 4, 4), name='out', array=array)
+    out_blocks.delete()
+    assert(keep.peak_memory((6, 6, 6), in_blocks, out_blocks) == 592)
+    _, seeks, _, _, _ = in_blocks.repartition(out_blocks, 450,
+                                              unconstrained_keep)
+    # read blocks were split
+    assert(seeks > keep.keep(in_blocks, out_blocks, None, array)[2])
+
+    rein_blocks = Partition((12, 12, 12), name='rein', array=array)
+    out_blocks.repartition(rein_blocks, None, keep.keep)
+    rein_blocks.blocks[(0, 0, 0)].read()
+    array.blocks[(0, 0, 0)].read()
+    assert(rein_blocks.blocks[(0, 0, 0)].data.get() ==
+           array.blocks[(0, 0, 0)].data.get())
+
+
+def test_repartition_resume(cleanup_blocks):
+    array = Partition((12, 12, 12), name='array', fill='random')
+    in_blocks = Partition((4, 4, 4), name='in', array=array)
+    array.repartition(in_blocks, None, keep.baseline)
+    out_blocks = Partition((3, 3, 3), name='out', array=array)
+
+    # interrupt the repartitioning after a few writes
+    write_block = out_blocks.write_block
+    writes = []
+
+    def interrupted_write_block(block, files=None):
+        if len(writes) == 5:
+            raise KeyboardInterrupt
+        writes.append(block.origin)
+        return write_block(block, files)
+
+    out_blocks.write_block = interrupted_write_block
+    journal = Journal('journal.txt')
+    with pytest.raises(KeyboardInterrupt):
+        in_blocks.repartition(out_blocks, None, keep.keep, journal=journal)
+    journal.close()
+    out_blocks.write_block = write_block
+
+    journal = Journal('journal.txt', resume=True)
+    assert(journal.writes == set(writes))
+    total_bytes, _, _, _, _ = in_blocks.repartition(out_blocks, None,
+                                                    keep.keep,
+                                                    journal=journal)
+    assert(journal.resumed)
+    assert(total_bytes < 2*math.prod(array.shape))
+    journal.delete()
+    assert(not os.path.isfile('journal.txt'))
+
+    rein_blocks = Partition((12, 12, 12), name='rein', array=array)
+    out_blocks.repartition(rein_blocks, None, keep.keep)
+    rein_blocks.blocks[(0, 0, 0)].read()
+    array.blocks[(0, 0, 0)].read()
+    assert(rein_blocks.blocks[(0, 0, 0)].data.get() ==
+           array.blocks[(0, 0, 0)].data.get())
+
+
+def test_generate(cleanup_blocks):
+    array = Partition((12, 12, 12), name='array')
+    in_blocks = Partition((4, 6, 12), name='in', array=array)
+
+    seed = generate(in_blocks, 'random', seed=42, processes=2)
+    assert(seed == 42)
+    in_blocks.blocks[(4, 6, 0)].read()
+    data = in_blocks.blocks[(4, 6, 0)].data.get()
+    in_blocks.clear()
+
+    # data only depends on the seed
+    generate(in_blocks, 'random', seed=42, processes=1)
+    in_blocks.blocks[(4, 6, 0)].read()
+    assert(in_blocks.blocks[(4, 6, 0)].data.get() == data)
+    in_blocks.clear()
+    generate(in_blocks, 'random', seed=43, processes=1)
+    in_blocks.blocks[(4, 6, 0)].read()
+    assert(in_blocks.blocks[(4, 6, 0)].data.get() != data)
+    in_blocks.clear()
+
+    generate(in_blocks, 'zeros', processes=1)
+    for b in in_blocks.blocks.values():
+        b.read()
+        assert(b.data.get() == bytearray(math.prod(b.shape)))
+
+
+def test_checksum(cleanup_blocks):
+    array = Partition((6, 8, 10), name='array', fill='random')
+    in_blocks = Partition((3, 4, 5), name='in', array=array)
+    array.repartition(in_blocks, None, keep.baseline)
+    out_blocks = Partition((2, 8, 2), name='out', array=array)
+    in_blocks.repartition(out_blocks, None, keep.keep)
+
+    array.blocks[(0, 0, 0)].read()
+    data = array.blocks[(0, 0, 0)].data.get()
+    checksum = partition_checksum(in_blocks, processes=1)
+    assert(checksum.planes[1] == int.from_bytes(data[80:160], 'big') %
+           MODULUS)
+    assert(checksum == partition_checksum(out_blocks, processes=2))
+    assert(verify(array, out_blocks) == [])
+
+    # a swap of two bytes is detected
+    b = out_blocks.blocks[(4, 0, 2)]
+    b.read()
+    data = bytearray(b.data.get())
+    b.clear()
+    data[0:2] = b'\x01\x02'
+    Block(b.origin, b.shape, data=data, file_name=b.file_name).write()
+    checksum = partition_checksum(out_blocks, processes=1)
+    data[0:2] = b'\x02\x01'
+    Block(b.origin, b.shape, data=data, file_name=b.file_name).write()
+    assert(checksum.diff(partition_checksum(out_blocks, processes=1)) ==
+           [4])
+
+
+def test_repartition_container(cleanup_blocks):
+    array = Partition((6, 8, 10), name='array')
+    in_blocks = Partition((3, 4, 5), name='in', array=array,
+                          layout='container')
+    generate(in_blocks, 'random', seed=1, processes=2)
+    assert(glob.glob('in*.bin') == ['in_container.bin'])
+    array_shape, shape, index = read_index('in_container.bin')
+    assert((array_shape, shape) == ((6, 8, 10), (3, 4, 5)))
+    assert(index == {b: in_blocks.blocks[b].file_offset
+                     for b in in_blocks.blocks})
+
+    # container to files, and files to container
+    out_blocks = Partition((2, 8, 2), name='out', array=array)
+    in_blocks.repartition(out_blocks, 300, keep.keep)
+    assert(verify(in_blocks, out_blocks, processes=1) == [])
+    rein_blocks = Partition((6, 4, 10), name='rein', array=array,
+                            layout='container')
+    out_blocks.repartition(rein_blocks, None, keep.baseline)
+    assert(verify(in_blocks, rein_blocks, processes=1) == [])
+
+    # blocks are found from the index
+    rein_blocks = Partition((6, 4, 10), name='rein', array=array,
+                            layout='container')
+    block = rein_blocks.blocks[(0, 4, 0)]
+    block.read()
+    in_block = in_blocks.blocks[(3, 4, 5)]
+    in_block.read()
+    assert(block.get_data_block(in_block).data.get() ==
+           in_block.data.get())
+    rein_blocks.delete()
+    assert(not os.path.exists('rein_container.bin'))
+
+
+def test_repartition_codec(cleanup_blocks):
+    array = Partition((6, 8, 10), name='array')
+    in_blocks = Partition((3, 4, 5), name='in', array=array, codec='zlib')
+    generate(in_blocks, 'random', seed=1, processes=1)
+    b = in_blocks.blocks[(3, 4, 5)]
+    with open(b.file_name, 'rb') as f:
+        assert(len(zlib.decompress(f.read())) == 60)
+
+    # compressed blocks are read whole, and updated by partial writes
+    out_blocks = Partition((2, 8, 2), name='out', array=array, codec='lzma',
+                           threads=2)
+    in_blocks.repartition(out_blocks, None, keep.keep)
+    assert(verify(in_blocks, out_blocks, processes=1) == [])
+    plain_blocks = Partition((6, 4, 10), name='plain', array=array)
+    out_blocks.repartition(plain_blocks, None, keep.baseline)
+    assert(verify(in_blocks, plain_blocks, processes=1) == [])
+    b.read()
+    c = Block((2, 3, 4), (3, 3, 3))
+    c.read_from(b)
+    assert(c.data.get() == b.get_data_block(c).data.get())
+
+    # read blocks don't cut compressed input blocks
+    array = Partition((12, 8, 10), name='array')
+    out_blocks = Partition((3, 8, 2), name='out', array=array)
+    in_blocks = Partition((2, 4, 5), name='in', array=array)
+    assert(keep.find_shape_with_constraint(in_blocks, out_blocks, 200) ==
+           ((3, 8, 5), 144))
+    in_blocks = Partition((2, 4, 5), name='in', array=array, codec='bz2')
+    assert(keep.find_shape_with_constraint(in_blocks, out_blocks, 200) ==
+           ((2, 8, 5), 160))
+
+
+def test_repartition_memory_backend(cleanup_blocks):
+    backend = MemoryBackend()
+    array = Partition((6, 8, 10), name='array')
+    in_blocks = Partition((3, 4, 5), name='in', array=array,
+                          backend=backend)
+    generate(in_blocks, 'random', seed=1)
+    out_blocks = Partition((2, 8, 2), name='out', array=array,
+                           layout='container', backend=backend)
+    in_blocks.repartition(out_blocks, None, keep.keep)
+    rein_blocks = Partition((6, 4, 10), name='rein', array=array,
+                            codec='zlib', backend=backend)
+    out_blocks.repartition(rein_blocks, None, keep.baseline)
+    assert(verify(in_blocks, out_blocks) == [])
+    assert(verify(in_blocks, rein_blocks) == [])
+    assert(glob.glob('*.bin') == [])
+    assert(len(backend.files) == 8 + 1 + 2)
+    out_blocks.delete()
+    assert('out_container.bin' not in backend.files)
+
+
+def test_simulated_backend(cleanup_blocks):
+    array = Partition((12, 12, 12), name='array')
+    clocks = {}
+    for method in ('baseline', 'keep'):
+        backend = SimulatedBackend(MemoryBackend(), latency=0.01,
+                                   bandwidth=1e6, sleep=False)
+        in_blocks = Partition((4, 4, 4), name='in', array=array,
+                              backend=backend)
+        generate(in_blocks, 'random', seed=1)
+        backend.clock = backend.seeks = 0
+        out_blocks = Partition((3, 3, 3), name='out', array=array,
+                               backend=backend)
+        _, seeks, _, _, _ = in_blocks.repartition(out_blocks, None,
+                                                  getattr(keep, method))
+        assert(backend.seeks <= seeks)
+        assert(backend.clock == pytest.approx(backend.seeks * 0.01 +
+                                              2 * 12**3 / 1e6))
+        clocks[method] = backend.clock
+    assert(clocks['keep'] < clocks['baseline'])
+
+    # requests from concurrent threads are all charged
+    backend = SimulatedBackend(MemoryBackend(), latency=0.01, sleep=False)
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda i: backend.request(f'f{i % 4}', 0, 1),
+                      range(4000)))
+    assert(backend.seeks == 4000)
+    assert(backend.clock == pytest.approx(40))
+
+
+@pytest.fixture
+def object_store():
+    server = ObjectStoreServer()
+    url = server.start()
+    yield server, url
+    server.stop()
+
+
+def test_object_store(object_store):
+    server, url = object_store
+    backend = ObjectStoreBackend(f'{url}/bucket/test', pool_size=2,
+                                 part_size=20, sieve=0)
+    array = Partition((6, 8, 10), name='array')
+    in_blocks = Partition((3, 4, 5), name='in', array=array,
+                          backend=backend)
+    generate(in_blocks, 'random', seed=1, processes=2)
+    assert(len(server.objects) == 8)
+    assert('/bucket/test/in_block_60.bin' in server.objects)
+
+    # reads are ranged GETs, out blocks are uploaded once, in parts
+    out_blocks = Partition((2, 8, 2), name='out', array=array,
+                           backend=backend)
+    backend.requests.clear()
+    _, seeks, _, _, _ = in_blocks.repartition(out_blocks, None, keep.keep)
+    write_seeks = keep.seek_count(out_blocks, out_blocks)
+    assert(backend.requests['GET'] ==
+           seeks - write_seeks + len(out_blocks.blocks))
+    assert(backend.requests['PUT'] == 2 * len(out_blocks.blocks))
+    assert(backend.requests['POST'] == 2 * len(out_blocks.blocks))
+    assert(backend.connections.created <= 2)
+    assert(verify(in_blocks, out_blocks, processes=1) == [])
+
+    # out blocks are uploaded as soon as they are complete, not when the
+    # pool evicts them
+    files = FilePool()
+    queues = IOQueues(files)
+    block = out_blocks.blocks[(0, 0, 0)]
+    backend.requests.clear()
+    for origin in ((0, 0, 0), (1, 0, 0)):
+        queues.write(Block(origin, (1, 8, 2), data=bytearray(16)), out_blocks)
+        queues.done()
+    assert(block.file_name not in files.files)
+    assert(backend.requests['GET'] == 1 and backend.requests['POST'] == 2)
+    assert(server.objects[f'/bucket/test/{block.file_name}'] == bytes(32))
+
+    # objects are uploaded on close only, so writes can't be journaled
+    backend.requests.clear()
+    with backend.open('flushed.bin', 'r+b') as f:
+        for _ in range(3):
+            f.write(b'abc')
+            f.flush()
+    assert(backend.requests['PUT'] == 1)
+    assert(server.objects['/bucket/test/flushed.bin'] == b'abcabcabc')
+    with pytest.raises(AssertionError):
+        in_blocks.repartition(out_blocks, None, keep.keep,
+                              journal=Journal('journal.txt'))
+
+    # cached blocks are validated with a HEAD request, read with a GET
+    cache = BlockCache(10 ** 6)
+    cached = Partition((3, 4, 5), name='in', array=array, backend=backend,
+                       block_cache=cache)
+    backend.requests.clear()
+    for _ in range(2):
+        cached.read_region_block((0, 0, 0), array.shape)
+    assert(backend.requests['GET'] == len(cached.blocks))
+    assert(backend.requests['HEAD'] == 2 * len(cached.blocks))
+    assert(cache.hits == len(cached.blocks))
+
+    # requests are signed if there are credentials
+    backend = ObjectStoreBackend(f'{url}/bucket/test',
+                                 credentials=('key', 'secret'))
+    b = Partition((3, 4, 5), name='in', array=array,
+                  backend=backend).blocks[(0, 0, 0)]
+    assert(backend.sieve > 0 and backend.exists(b.file_name))
+    assert(b.read()[0] == 60)
+    method, _, headers = server.log[-1]
+    assert(method == 'GET' and headers['authorization'].startswith(
+        'AWS4-HMAC-SHA256 Credential=key/'))
+    b.delete()
+    assert(not backend.exists(b.file_name))
+
+
+def test_repartition_striped(tmp_path):
+    dirs = [str(tmp_path / d) for d in ('a', 'b', 'c')]
+    for d in dirs:
+        os.mkdir(d)
+    array = Partition((6, 8, 10), name='array')
+    in_blocks = Partition((3, 4, 5), name='in', array=array, dirs=dirs)
+    generate(in_blocks, 'random', seed=1, processes=1)
+    assert([len(os.listdir(d)) for d in dirs] == [3, 3, 2])
+    assert(in_blocks.blocks[(0, 4, 0)].file_name ==
+           os.path.join(dirs[2], 'in_block_120.bin'))
+
+    # writes go through device queues, estimates are unchanged, write time
+    # is elapsed time
+    out_blocks = Partition((2, 8, 2), name='out', array=array, dirs=dirs,
+                           stripe='hash')
+    start = time.time()
+    _, _, _, read_time, write_time = in_blocks.repartition(out_blocks, 300,
+                                                           keep.keep)
+    assert(read_time + write_time <= time.time() - start)
+    assert(sum(len(os.listdir(d)) for d in dirs) == 8 + 15)
+    assert(verify(in_blocks, out_blocks, processes=1) == [])
+    rein_blocks = Partition((6, 4, 10), name='rein', array=array,
+                            dirs=dirs[:1])
+    journal = Journal(str(tmp_path / 'journal.txt'))
+    _, _, peak_mem, _, _ = out_blocks.repartition(rein_blocks, 300,
+                                                  keep.baseline,
+                                                  journal=journal)
+    assert(peak_mem <= 300)
+    assert(verify(in_blocks, rein_blocks, processes=1) == [])
+    # read blocks are journaled once their queued writes are done
+    with open(journal.file_name) as f:
+        entries = [line.split(' ', 1) for line in f]
+    reads = [i for i, (kind, _) in enumerate(entries) if kind == 'read']
+    assert(len(reads) == len(journal.reads) > 0)
+    for i in reads:
+        assert(['write', entries[i][1]] in entries[:i])
+    out_blocks.delete()
+    assert(sum(len(os.listdir(d)) for d in dirs) == 8 + 2)
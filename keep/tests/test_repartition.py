@@ -1,6 +1,7 @@
 import glob
 import pytest
 import os
+from keep.objectstore import ObjectStoreServer
 from keep.repartition import main
 
 
@@ -25,7 +26,188 @@ def test_repartition(cleanup_blocks):
 
     main(["--test-data", "(50, 50, 50)", "(5, 5, 5)", "(10, 10, 10)", "keep"])
 
+    # corrupt an output block
+    with open("out_block_1000.bin", "r+b") as f:
+        data = f.read(1)
+        f.seek(0)
+        f.write(bytes([(data[0] + 1) % 256]))
+    with pytest.raises(AssertionError):
+        main(
+            [
+                "--test-data",
+                "(50, 50, 50)",
+                "(5, 5, 5)",
+                "(10, 10, 10)",
+                "keep",
+            ]
+        )
+
+    main(
+        [
+            "--repartition",
+            "--inline-checksum",
+            "(50, 50, 50)",
+            "(5, 5, 5)",
+            "(10, 10, 10)",
+            "keep",
+        ]
+    )
+
     main(["--delete", "(50, 50, 50)", "(5, 5, 5)", "(10, 10, 10)", "keep"])
 
     # verify that all output blocks have been removed
     assert len(glob.glob("out*.bin")) == 0
+
+
+def test_create_seed(cleanup_blocks):
+    args = ["(20, 20, 20)", "(10, 10, 10)", "(5, 5, 5)", "keep"]
+    main(["--create", "--seed", "1", "--jobs", "1"] + args)
+    with open("in_block_0.bin", "rb") as f:
+        data = f.read()
+    main(["--create", "--seed", "1"] + args)
+    with open("in_block_0.bin", "rb") as f:
+        assert f.read() == data
+
+
+def test_two_phase(cleanup_blocks):
+    args = ["(20, 20, 20)", "(10, 10, 10)", "(5, 5, 5)", "two-phase"]
+    main(["--create"] + args)
+    main(["--repartition", "--max-mem", "4000"] + args)
+    main(["--test-data"] + args)
+
+
+def test_dtype(cleanup_blocks):
+    args = ["(20, 20, 20)", "(10, 10, 10)", "(5, 5, 5)", "keep"]
+    main(["--create", "--dtype", "float32"] + args)
+    assert os.path.getsize("in_block_0.bin") == 4000
+    main(["--repartition", "--dtype", "float32", "--inline-checksum"] + args)
+    main(["--test-data", "--dtype", "float32"] + args)
+
+
+def test_ragged(cleanup_blocks):
+    args = ["(23, 20, 17)", "(10, 10, 10)", "(5, 5, 5)", "keep"]
+    main(["--create"] + args)
+    main(["--repartition", "--max-mem", "4000"] + args)
+    main(["--test-data"] + args)
+
+
+def test_fan_out(cleanup_blocks):
+    args = ["(20, 20, 20)", "(10, 10, 10)", "(1, 20, 20)", "keep"]
+    main(["--create"] + args)
+    fan_out = ["--fan-out", "(5, 5, 5)"]
+    main(["--repartition", "--inline-checksum"] + fan_out + args)
+    assert os.path.isfile("out_block_0.bin")
+    assert os.path.isfile("out1_block_0.bin")
+    main(["--test-data"] + fan_out + args)
+    main(["--delete"] + fan_out + args)
+    assert glob.glob("out*.bin") == []
+
+
+def test_pyramid(cleanup_blocks):
+    args = ["(20, 20, 20)", "(10, 10, 10)", "(5, 5, 5)", "keep"]
+    main(["--create"] + args)
+    pyramid = ["--pyramid", "2"]
+    main(["--repartition", "--inline-checksum"] + pyramid + args)
+    # 10x10x10 level 1 array, in 8 blocks of 5x5x5
+    assert len(glob.glob("out_level1_block_*.bin")) == 8
+    assert os.path.getsize("out_level2_block_0.bin") == 125
+    main(["--delete"] + pyramid + args)
+    assert glob.glob("out*.bin") == []
+
+
+def test_order(cleanup_blocks):
+    args = ["(20, 20, 20)", "(10, 10, 10)", "(5, 20, 4)", "keep"]
+    main(["--create", "--in-order", "(1, 0, 2)"] + args)
+    orders = ["--in-order", "(1, 0, 2)", "--out-order", "F"]
+    main(["--repartition", "--inline-checksum"] + orders + args)
+    main(["--test-data"] + orders + args)
+
+
+def test_halo(cleanup_blocks):
+    args = ["(20, 20, 20)", "(10, 10, 10)", "(5, 5, 5)", "keep"]
+    main(["--create"] + args)
+    halo = ["--halo", "1"]
+    main(["--repartition", "--inline-checksum"] + halo + args)
+    # corner blocks have a halo on 3 sides only
+    assert os.path.getsize("out_block_0.bin") == 6 * 6 * 6
+    assert os.path.getsize("out_block_125.bin") == 6 * 6 * 7
+    main(["--test-data"] + halo + args)
+    with pytest.raises(Exception):
+        main(["--repartition"] + halo + args[:-1] + ["two-phase"])
+
+
+def test_container(cleanup_blocks):
+    args = ["(20, 20, 20)", "(10, 10, 10)", "(5, 5, 5)", "keep"]
+    layouts = ["--in-layout", "container", "--out-layout", "container"]
+    main(["--create"] + layouts + args)
+    main(["--repartition"] + layouts + args)
+
+    # each partition is stored in a single file
+    assert sorted(glob.glob("*.bin")) == [
+        "in_container.bin",
+        "out_container.bin",
+    ]
+    main(["--test-data"] + layouts + args)
+
+
+def test_codec(cleanup_blocks):
+    args = ["(20, 20, 20)", "(10, 10, 10)", "(5, 5, 5)", "keep"]
+    codecs = ["--in-codec", "zlib", "--out-codec", "lzma"]
+    main(["--create", "--fill", "zeros"] + codecs + args)
+    assert os.path.getsize("in_block_0.bin") < 1000
+    main(["--repartition", "--max-mem", "4000"] + codecs + args)
+    main(["--test-data"] + codecs + args)
+
+
+def test_simulated_backend(cleanup_blocks):
+    args = [
+        "--backend",
+        "lustre",
+        "(20, 20, 20)",
+        "(10, 10, 10)",
+        "(5, 5, 5)",
+        "keep",
+    ]
+    main(["--create"] + args)
+    main(["--repartition"] + args)
+    main(["--test-data"] + args)
+
+
+def test_object_store():
+    server = ObjectStoreServer()
+    url = server.start()
+    args = [
+        "--object-store",
+        f"{url}/bucket",
+        "(20, 20, 20)",
+        "(10, 10, 10)",
+        "(5, 5, 5)",
+        "keep",
+    ]
+    main(["--create", "--jobs", "1"] + args)
+    main(["--repartition"] + args)
+    main(["--test-data", "--jobs", "1"] + args)
+    assert len(server.objects) == 8 + 64
+    main(["--delete"] + args)
+    assert len(server.objects) == 8
+    server.stop()
+
+
+def test_striping(tmp_path):
+    dirs = [str(tmp_path / d) for d in ("a", "b")]
+    for d in dirs:
+        os.mkdir(d)
+    args = [
+        "--in-dirs",
+        ",".join(dirs),
+        "--out-dirs",
+        ",".join(reversed(dirs)),
+        "(20, 20, 20)",
+        "(10, 10, 10)",
+        "(5, 5, 5)",
+        "keep",
+    ]
+    main(["--create"] + args)
+    main(["--repartition"] + args)
+    main(["--test-data"] + args)
+    assert [len(os.listdir(d)) for d in dirs] == [4 + 32, 4 + 32]
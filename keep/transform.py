@@ -0,0 +1,64 @@
+import math
+from keep.block import Data
+from keep.dtype import get_dtype
+
+STAGES = ('read', 'write')
+
+
+class Transform():
+    '''
+    A function applied to the data of blocks by Partition.repartition, so
+    that data is converted (type cast, intensity rescaling, masking...) in
+    the same pass as it is repartitioned, without another read and write
+    of the array.
+
+    Transforms of the read stage are applied to the read blocks before they
+    are inserted in the cache: the cache holds transformed elements, and
+    its memory is counted with their size. Transforms of the write stage
+    are applied to the complete write blocks before they are written, and
+    can't change the size of the elements.
+
+    Attributes:
+        function: called with the data of a block, a bytearray, and the
+                  block. It modifies the data in place and returns None,
+                  or it returns the transformed data, a bytes-like object.
+        dtype: DType of the transformed elements, the type of the output
+               partitions. None if the type isn't changed.
+        stage: 'read' or 'write'
+    '''
+
+    def __init__(self, function, dtype=None, stage='read'):
+        assert(stage in STAGES), f'Invalid stage: {stage}'
+        self.function = function
+        self.dtype = None if dtype is None else get_dtype(dtype)
+        self.stage = stage
+
+    def __str__(self):
+        '''
+        Return a string representation for the transform
+        '''
+        dtype = '' if self.dtype is None else f' to {self.dtype.name}'
+        return f'Transform{dtype} at {self.stage} stage'
+
+    def output_dtype(self, dtype):
+        '''
+        Return the type of the transformed elements of type dtype
+        '''
+        return dtype if self.dtype is None else self.dtype
+
+    def apply(self, block):
+        '''
+        Transform the data of block. The itemsize of block is updated when
+        the size of the elements changes.
+        '''
+        result = self.function(block.data.buffer(), block)
+        if result is not None:
+            if not isinstance(result, bytearray):
+                result = bytearray(result)
+            block.data = Data(result)
+        if self.dtype is not None:
+            block.itemsize = self.dtype.itemsize
+            block.nbytes = math.prod(block.shape) * block.itemsize
+        assert(block.data.mem_usage() == block.nbytes), (
+            f'Transformed data of {block} has {block.data.mem_usage()}B, '
+            f'expected {block.nbytes}B')
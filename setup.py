@@ -19,6 +19,10 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.8',
+    extras_require={
+        # Partition.read_region returns numpy arrays
+        'numpy': ['numpy'],
+    },
     entry_points = {
         'console_scripts': ['repartition=keep.repartition:main'],
     }